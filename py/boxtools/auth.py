@@ -68,10 +68,24 @@ def refresh_tokens(client_id, client_secret, access_token, refresh_token, save_t
     access_token, refresh_token = oauth.refresh(access_token)
     return access_token, refresh_token
 
-def get_client(client_id, client_secret, access_token, refresh_token, save_tokens):
+# Points boxsdk at a server other than Box's own (such as boxtools.fakebox) whose API is rooted
+# at `base_url`, using the same URL layout as api.box.com.
+
+def set_api_base_url(base_url):
+    from boxsdk.config import API
+    base_url = base_url.rstrip('/')
+    API.BASE_API_URL = base_url + '/2.0'
+    API.UPLOAD_URL = base_url + '/api/2.0'
+    API.OAUTH2_API_URL = base_url + '/oauth2'
+
+def get_client(client_id, client_secret, access_token, refresh_token, save_tokens, network_layer=None):
     oauth = OAuth2(client_id=client_id, client_secret=client_secret,
                    access_token=access_token, refresh_token=refresh_token,
                    store_tokens=save_tokens)
-    client = Client(oauth)
+    if network_layer is not None:
+        from boxsdk.session.session import AuthorizedSession
+        client = Client(oauth, session=AuthorizedSession(oauth, network_layer=network_layer))
+    else:
+        client = Client(oauth)
     return client
 
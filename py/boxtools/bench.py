@@ -0,0 +1,299 @@
+import os, sys, argparse, json, time, shutil, subprocess, tempfile, statistics, contextlib, tracemalloc
+
+# Benchmarks for the hot paths of boxcli (listing, walking trees, searching, resolving IDs, and
+# transferring files), run against the local fake Box server in fakebox.py, so that the numbers
+# are reproducible and can be compared between versions. Run it with
+#
+#   python -m boxtools.bench [-n SIZES] [-l LATENCY] [-o results.json] [-c previous.json] [benchmarks...]
+#
+# For each dataset size a fakebox server is started with a synthetic tree of that many items,
+# and the benchmarks are run against it in a fresh worker process (since cli.py keeps its state
+# at module level), using a throwaway $BOXTOOLS_DIR. Each benchmark is run `repeat` times for
+# timing, and once more under tracemalloc to find its peak memory use.
+
+# Benchmarks {{{1
+
+# Each benchmark is a function taking a Dataset and returning the amount of work done, as a
+# (count, unit) tuple, from which the throughput is computed. Benchmarks run in the order in
+# which they're defined.
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.removeprefix('bench_')] = func
+    return func
+
+SEARCH_TERM = 'report'     # one of the words fakebox uses in file names
+TRANSLATE_LOOKUPS = 200
+
+@benchmark
+def bench_ls(ds):
+    ds.cli.invalidate_listing_cache()     # otherwise this times the cache filled by earlier listings
+    ds.cli.ls_cmd(['0'])
+    return ds.root_count, 'items'
+
+@benchmark
+def bench_tree(ds):
+    ds.cli.tree_cmd(['0'])
+    return ds.num_items, 'items'
+
+@benchmark
+def bench_search(ds):
+    ds.cli.search_cmd(['-l', '100', SEARCH_TERM])
+    return 1, 'queries'
+
+# Resolves references of each of the styles that scan the ID history (which `ls` fills)
+@benchmark
+def bench_translate_id(ds):
+    names = [entry['name'] for entry in ds.cli.item_history_map.values()]
+    refs = []
+    for i in range(TRANSLATE_LOOKUPS):
+        name = names[i % len(names)]
+        refs.append(('^' + name[:4], name[2:7] + '%', '/' + name[:3] + '.*/', name)[i % 4] + '!')
+    for ref in refs:
+        ds.cli.translate_id(ref)
+    return len(refs), 'lookups'
+
+@benchmark
+def bench_get(ds):
+    destdir = tempfile.mkdtemp(dir=ds.workdir)
+    try:
+        ds.cli.get_cmd(['-d', ds.get_folder_id, destdir])
+    finally:
+        shutil.rmtree(destdir)
+    return ds.get_bytes, 'bytes'
+
+@benchmark
+def bench_put(ds):
+    ds.put_count += 1
+    folder = ds.client.folder('0').create_subfolder(f'bench-put-{ds.put_count}')
+    ds.cli.put_cmd(['-d', folder.object_id] + ds.put_files)
+    return ds.put_bytes, 'bytes'
+
+# Worker {{{1
+
+PUT_NUM_FILES = 20
+
+# Everything the benchmarks need to know about the dataset being served
+
+class Dataset:
+    def __init__(self, cli, num_items, workdir, mean_size):
+        self.cli = cli
+        self.client = cli.get_ops_client()
+        self.num_items = num_items
+        self.workdir = workdir
+        self.root_count = self.client.folder('0').get().item_collection['total_count']
+        self.get_folder_id, self.get_bytes = self._find_get_folder()
+        self.put_files = []
+        for i in range(PUT_NUM_FILES):
+            path = os.path.join(workdir, f'put-{i}.bin')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(mean_size))
+            self.put_files.append(path)
+        self.put_bytes = PUT_NUM_FILES * mean_size
+        self.put_count = 0
+        cli.ls_cmd(['0'])   # warms up the connection, and fills the ID history for translate_id
+
+    # Finds a folder with a modest number of files in it to download, looking at most a few
+    # hundred folders into the tree.
+    def _find_get_folder(self, min_files=5, max_files=200, max_folders=300):
+        best = ('0', 0, 0)
+        queue = ['0']
+        for _ in range(max_folders):
+            if not queue:
+                break
+            folder_id = queue.pop(0)
+            items = self.cli.retrieve_all_folder_items(self.client, folder_id, fields=['type', 'id', 'size'])
+            files = [item for item in items if item.type == 'file']
+            queue.extend(item.id for item in items if item.type == 'folder')
+            if min_files <= len(files) <= max_files:
+                if len(files) > best[1]:
+                    best = (folder_id, len(files), sum(item.size for item in files))
+                if len(files) == max_files:
+                    break
+        return best[0], best[2]
+
+def run_worker(options):
+    workdir = tempfile.mkdtemp(prefix='boxtools-bench-')
+    config_dir = os.path.join(workdir, 'config')
+    os.mkdir(config_dir)
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(app_dir, 'resources/boxtools.toml')) as f:
+        config = f.read().replace('(your client-id)', 'bench').replace('(your client-secret)', 'bench')
+    with open(os.path.join(config_dir, 'boxtools.toml'), 'w') as f:
+        f.write(config)
+    with open(os.path.join(config_dir, 'auth-tokens.json'), 'w') as f:
+        json.dump({'access_token': 'bench', 'refresh_token': 'bench'}, f)
+    os.environ.update(BOXTOOLS_APP_DIR=app_dir, BOXTOOLS_DIR=config_dir, BOXTOOLS_PROGNAME='boxcli',
+                      BOXTOOLS_API_URL=options.worker)
+    os.environ.pop('BOXTOOLS_AUTH_NAME', None)
+    sys.argv = ['boxcli']
+    results = []
+    try:
+        from . import cli
+        from .network import RequestProfiler
+        with _stdout_discarded():
+            ds = Dataset(cli, options.items, workdir, options.mean_size)
+            for name in options.benchmarks:
+                func = BENCHMARKS[name]
+                times, num_requests = [], []
+                for _ in range(options.repeat):
+                    profiler = RequestProfiler()
+                    cli.network_observers.append(profiler)
+                    start = time.perf_counter()
+                    count, unit = func(ds)
+                    times.append(time.perf_counter() - start)
+                    cli.network_observers.remove(profiler)
+                    num_requests.append(profiler.num_requests)
+                tracemalloc.start()
+                func(ds)
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                wall_time = statistics.median(times)
+                results.append({'benchmark': name, 'items': options.items, 'latency': options.latency,
+                                'repeat': options.repeat, 'wall_time': wall_time, 'wall_time_min': min(times),
+                                'requests': round(statistics.median(num_requests)), 'peak_memory': peak_memory,
+                                'work': count, 'unit': unit,
+                                'throughput': count / wall_time if wall_time > 0 else None})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    with open(options.output, 'w') as f:
+        json.dump(results, f)
+
+# Sends whatever the commands print to /dev/null. This is done at the file descriptor level,
+# since some of cli.py's functions hold on to the original sys.stdout.
+@contextlib.contextmanager
+def _stdout_discarded():
+    sys.stdout.flush()
+    saved_fd = os.dup(1)
+    devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull_fd, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_fd, 1)
+        os.close(saved_fd)
+        os.close(devnull_fd)
+
+# Driver {{{1
+
+# Starts a fakebox server with `num_items` items in a subprocess, and returns it and its URL
+def start_fakebox(num_items, options):
+    cmd = [sys.executable, '-m', 'boxtools.fakebox', '-p', '0', '-n', str(num_items), '-s', str(options.seed),
+           '-z', str(options.mean_size), '-l', str(options.latency), '-j', str(options.jitter)]
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, env=_child_env())
+    line = server.stdout.readline()
+    if not line.startswith('Serving'):
+        server.kill()
+        sys.exit(f"fakebox failed to start: {line.strip()}")
+    return server, line.split()[-1]
+
+def _child_env():
+    pkg_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = pkg_parent + (os.pathsep + env['PYTHONPATH'] if env.get('PYTHONPATH') else '')
+    return env
+
+def run_dataset(num_items, options):
+    print(f"Generating {num_items} items...", file=sys.stderr, flush=True)
+    server, url = start_fakebox(num_items, options)
+    fd, results_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        cmd = [sys.executable, '-m', 'boxtools.bench', '--worker', url, '--items', str(num_items),
+               '-o', results_path, '-r', str(options.repeat), '-z', str(options.mean_size),
+               '-l', str(options.latency)] + options.benchmarks
+        subprocess.run(cmd, check=True, env=_child_env())
+        with open(results_path) as f:
+            return json.load(f)
+    finally:
+        server.terminate()
+        server.wait()
+        os.unlink(results_path)
+
+def _parse_count(s):
+    s = s.strip().upper()
+    multiplier = {'K': 1000, 'M': 1_000_000}.get(s[-1:], 1)
+    return int(float(s.rstrip('KM')) * multiplier)
+
+def _format_quantity(n, unit):
+    if unit == 'bytes':
+        unit = 'B'
+    for suffix, size in (('G', 1e9), ('M', 1e6), ('K', 1e3)):
+        if n >= size:
+            return f"{n / size:.1f}{suffix} {unit}"
+    return f"{n:.1f} {unit}"
+
+def _result_key(result):
+    return result['benchmark'], result['items'], result['latency']
+
+def print_results(results, previous=None):
+    previous = {_result_key(r): r for r in previous or ()}
+    header = f"{'benchmark':<14} {'items':>8} {'wall(s)':>9} {'min(s)':>9} {'requests':>9} {'peak mem':>10}  throughput"
+    if previous:
+        header += "  (vs. previous)"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        line = (f"{r['benchmark']:<14} {r['items']:>8} {r['wall_time']:>9.3f} {r['wall_time_min']:>9.3f} "
+                f"{r['requests']:>9} {r['peak_memory'] / 1e6:>8.1f}MB  "
+                f"{_format_quantity(r['throughput'] or 0, r['unit'])}/s")
+        if (old := previous.get(_result_key(r))) and old['wall_time']:
+            line += f"  ({(r['wall_time'] - old['wall_time']) / old['wall_time']:+.1%} time)"
+        print(line)
+
+def main():
+    cli_parser = argparse.ArgumentParser(prog='bench', description='Benchmark boxcli against a local fake Box server')
+    cli_parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                            help=f"Benchmarks to run (default all): {', '.join(BENCHMARKS)}")
+    cli_parser.add_argument('-n', '--sizes', default='100,1K,10K',
+                            help='Comma-separated dataset sizes, in items (e.g. "100,10K,1M"; default %(default)s)')
+    cli_parser.add_argument('-l', '--latency', type=float, default=0.02,
+                            help='Seconds of latency the server adds to each request (default %(default)s)')
+    cli_parser.add_argument('-j', '--jitter', type=float, default=0.0, help='Random extra latency, in seconds')
+    cli_parser.add_argument('-r', '--repeat', type=int, default=3,
+                            help='Timed runs of each benchmark; the median is reported (default %(default)s)')
+    cli_parser.add_argument('-z', '--mean-size', type=int, default=64*1024,
+                            help='Mean file size in bytes (default %(default)s)')
+    cli_parser.add_argument('-s', '--seed', type=int, default=0, help='Seed for the synthetic tree')
+    cli_parser.add_argument('-o', '--output', help='Write results to this JSON file '
+                            '(default bench-YYYYmmdd-HHMMSS.json)')
+    cli_parser.add_argument('-c', '--compare', metavar='FILE', help='Compare with the results in a previous JSON file')
+    cli_parser.add_argument('--worker', help=argparse.SUPPRESS)
+    cli_parser.add_argument('--items', type=int, help=argparse.SUPPRESS)
+    options = cli_parser.parse_args()
+    if unknown := [name for name in options.benchmarks if name not in BENCHMARKS]:
+        cli_parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+    options.benchmarks = options.benchmarks or list(BENCHMARKS)
+    if options.worker:
+        run_worker(options)
+        return
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)['results']
+    results = []
+    for num_items in map(_parse_count, options.sizes.split(',')):
+        results.extend(run_dataset(num_items, options))
+    output = options.output or time.strftime('bench-%Y%m%d-%H%M%S.json')
+    with open(output, 'w') as f:
+        json.dump({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   'python': sys.version.split()[0],
+                   'git_commit': _git_commit(),
+                   'options': {'sizes': options.sizes, 'latency': options.latency, 'jitter': options.jitter,
+                               'repeat': options.repeat, 'mean_size': options.mean_size, 'seed': options.seed},
+                   'results': results}, f, indent=2)
+    print()
+    print_results(results, previous)
+    print(f"\nResults written to {output}")
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import base64
+import http.client
+import io
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from urllib3 import HTTPResponse
+from boxsdk.network.default_network import DefaultNetworkResponse
+
+from .network import ObservedNetwork
+
+# Recording of Box API traffic to a "cassette" file, and replay of it without a network.
+#
+# RecordingNetwork passes requests on to Box as usual and keeps each response, along with how
+# long it took; ReplayNetwork serves those responses back, waiting the recorded time multiplied
+# by `scale` (1.0 to preserve the timings, 0 to answer at once). Both are ObservedNetworks, so
+# --profile, --trace, and metrics work the same way during replay.
+#
+# Responses are matched to requests by method, URL path and query (but not host, so a cassette
+# recorded against fakebox.py is replayed just as well against the default URLs), and by the
+# Content-Range of chunked upload parts. Identical requests get their responses in the order in
+# which they were recorded. Request bodies aren't recorded; neither are request headers, so no
+# access tokens end up in a cassette, though the response bodies it holds are as private as the
+# account they came from.
+#
+# Cassette file format (JSON):
+#
+#   {"version": 1,
+#    "interactions": [{"method", "url", "content_range", "status", "headers",
+#                      "body" or "body_base64", "elapsed"}, ...]}
+
+CASSETTE_VERSION = 1
+
+# Raised during replay for a request that isn't in the cassette (or whose recorded responses
+# have all been used)
+class CassetteMiss(Exception):
+    pass
+
+def _request_key(method, url, params, headers):
+    url = requests.Request(method, url, params=params).prepare().url
+    parts = urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    return method.upper(), path, (headers or {}).get('Content-Range')
+
+# Returns a requests.Response whose body, already read, is `body`. Its `raw` stream is readable
+# too, since downloads are streamed from it.
+def _make_response(method, url, status, headers, body):
+    response = requests.Response()
+    response.status_code = status
+    response.reason = http.client.responses.get(status, '')
+    response.headers = CaseInsensitiveDict(headers)
+    response.headers['Content-Length'] = str(len(body))
+    response.raw = HTTPResponse(body=io.BytesIO(body), headers=response.headers, status=status,
+                                preload_content=False, decode_content=False)
+    response.url = url
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.request = requests.Request(method, url).prepare()
+    return response
+
+# Headers that described the body as it came over the wire, rather than as recorded
+_TRANSPORT_HEADERS = {'content-encoding', 'transfer-encoding', 'content-length', 'connection', 'keep-alive'}
+
+class RecordingNetwork(ObservedNetwork):
+    def __init__(self, observers, scheduler=None):
+        super().__init__(observers, scheduler)
+        self.lock = threading.Lock()
+        self.interactions = []
+
+    def _send(self, method, url, access_token, **kwargs):
+        t0 = time.monotonic()
+        response = super()._send(method, url, access_token, **kwargs)
+        body = response.content   # decoded, and read whole, even for downloads
+        elapsed = time.monotonic() - t0
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in _TRANSPORT_HEADERS}
+        # Responses to expired tokens are left out, since the refresh that follows them isn't
+        # made through this network layer and couldn't be replayed.
+        if response.status_code != 401:
+            method_, path, content_range = _request_key(method, url, kwargs.get('params'), kwargs.get('headers'))
+            interaction = {'method': method_, 'url': path, 'content_range': content_range,
+                           'status': response.status_code, 'headers': headers, 'elapsed': round(elapsed, 6)}
+            try:
+                interaction['body'] = body.decode('utf-8')
+            except UnicodeDecodeError:
+                interaction['body_base64'] = base64.b64encode(body).decode('ascii')
+            with self.lock:
+                self.interactions.append(interaction)
+        return DefaultNetworkResponse(_make_response(method, url, response.status_code, headers, body),
+                                      access_token_used=access_token, log_response_content=False)
+
+    def save(self, path):
+        with self.lock:
+            cassette = {'version': CASSETTE_VERSION, 'interactions': self.interactions}
+        with open(path, 'w') as f:
+            json.dump(cassette, f, indent=1)
+
+class ReplayNetwork(ObservedNetwork):
+    def __init__(self, observers, path, scale=1.0, scheduler=None):
+        super().__init__(observers, scheduler)
+        with open(path) as f:
+            cassette = json.load(f)
+        if cassette.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"{path}: unsupported cassette version {cassette.get('version')}")
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.responses = defaultdict(deque)   # request key -> deque of interactions
+        for interaction in cassette['interactions']:
+            key = (interaction['method'], interaction['url'], interaction.get('content_range'))
+            self.responses[key].append(interaction)
+
+    def _send(self, method, url, access_token, **kwargs):
+        key = _request_key(method, url, kwargs.get('params'), kwargs.get('headers'))
+        with self.lock:
+            queue = self.responses.get(key)
+            interaction = queue.popleft() if queue else None
+        if interaction is None:
+            raise CassetteMiss(f"No recorded response for {key[0]} {key[1]}")
+        # Consume an upload's body as sending it would, so that whatever counts or throttles
+        # the data as it's read (see TransferStream in cli.py) still sees it.
+        if hasattr(data := kwargs.get('data'), 'read'):
+            while data.read(64 * 1024):
+                pass
+        if 'body_base64' in interaction:
+            body = base64.b64decode(interaction['body_base64'])
+        else:
+            body = interaction['body'].encode('utf-8')
+        if self.scale:
+            time.sleep(interaction['elapsed'] * self.scale)
+        return DefaultNetworkResponse(_make_response(method, url, interaction['status'], interaction['headers'], body),
+                                      access_token_used=access_token, log_response_content=False)
+
+    def retry_after(self, delay, request_method, *args, **kwargs):
+        self._notify('request_retried', delay)
+        time.sleep(delay * self.scale)
+        return request_method(*args, **kwargs)
@@ -1,10 +1,13 @@
 import os, os.path, sys, argparse, re, io, ast, time
-import shutil, shlex, subprocess, logging, readline, pprint
+import shutil, shlex, subprocess, logging, readline, pprint, threading
 from collections import OrderedDict, deque
-import json, pickle
+import json, pickle, hashlib, contextvars, contextlib
 
 import tomli
 
+from .tracing import span as trace_span
+from .scheduler import request_priority, request_waits
+
 # Preliminaries {{{1
 
 # The invoking shell script must set $BOXTOOLS_APP_DIR {{{2
@@ -36,6 +39,8 @@ tokens_file = os.path.join(config_dir,
 app_state_file = os.path.join(config_dir, "app-state.pickle")
 aliases_file = os.path.join(config_dir, "id-aliases.txt")
 readline_history_file = os.path.join(config_dir, "readline-history")
+metadata_cache_file = os.path.join(config_dir, "metadata-cache.pickle")
+snapshot_db_file = os.path.join(config_dir, "snapshot.sqlite")
 
 # Print help and exit if appropriate {{{2
 if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
@@ -61,11 +66,35 @@ id_history_size = config_table.get('id-history-size', 500)
 readline_history_size = config_table.get('readline-history-size', 500)
 ls_history_size = config_table.get('ls-history-size', 10)
 chunked_upload_size_threshold = config_table.get('chunked-upload-size-threshold', 20_971_520)
-chunked_upload_num_threads = config_table.get('chunked-upload-num-threads', 2)
+# chunked-upload-num-threads, found in older configs, used to fix the number of parts sent at
+# once; it's now taken as where an upload's adaptive concurrency starts.
+chunked_upload_initial_threads = config_table.get('chunked-upload-initial-threads',
+                                                  config_table.get('chunked-upload-num-threads', 2))
+chunked_upload_max_threads = max(config_table.get('chunked-upload-max-threads', 8), chunked_upload_initial_threads)
+chunked_upload_max_parts = config_table.get('chunked-upload-max-parts', 16)
 rclone_remote_name = config_table.get('rclone-remote-name', 'box')
 representation_max_attempts = config_table.get('representation-max-attempts', 15)
 representation_wait_time = config_table.get('representation-wait-time', 2.0)
 representation_aliases = dict(config_table.get('representation-aliases', []))
+download_max_attempts = config_table.get('download-max-attempts', 3)
+api_num_threads = config_table.get('api-num-threads', 8)
+transfer_num_threads = config_table.get('transfer-num-threads', 4)
+local_hash_num_threads = config_table.get('local-hash-num-threads', os.cpu_count() or 4)
+metadata_cache_size = config_table.get('metadata-cache-size', 100_000)
+listing_cache_ttl = config_table.get('listing-cache-ttl', 60)
+prefetch_num_threads = config_table.get('prefetch-num-threads', 2)
+api_max_requests = config_table.get('api-max-requests', 24)
+api_rate_limit = config_table.get('api-rate-limit', 0)
+background_max_requests = config_table.get('background-max-requests', 8)
+prefetch_max_requests = config_table.get('prefetch-max-requests', 2)
+bwlimit = str(config_table.get('bwlimit', ''))
+metrics_file = os.path.expanduser(config_table.get('metrics-file', ''))
+# Use a different API server, like boxtools.fakebox, rather than api.box.com
+api_base_url = os.environ.get('BOXTOOLS_API_URL') or config_table.get('api-base-url', '')
+# Record the API traffic of this run to a cassette file, or replay it from one (see cassette.py)
+record_file = os.environ.get('BOXTOOLS_RECORD')
+replay_file = os.environ.get('BOXTOOLS_REPLAY')
+replay_scale = float(os.environ.get('BOXTOOLS_REPLAY_SCALE', 1.0))
 
 # Get terminal size for use in default lengths {{{2
 screen_cols = shutil.get_terminal_size(fallback=(0, 0))[0] if sys.stdout.isatty() else 80
@@ -92,6 +121,10 @@ del _decode_length_val
 
 ls_history_deque = deque(maxlen = ls_history_size)
 
+# Held while updating, or iterating over, the item history, ls history, stash, numbered item list,
+# prefetch candidates and metadata cache, which shell background jobs may be changing at the same time.
+state_lock = threading.RLock()
+
 if os.path.exists(app_state_file):
     with open(app_state_file, 'rb') as f:
         _app_state = pickle.load(f)
@@ -109,7 +142,28 @@ else:
     item_stash = {}
     numeric_item_list = []
 
-current_cmd_last_id = last_id
+# The ID last referred to by the command being run, which becomes last_id when it's done. It's a
+# context variable so that commands running at the same time (in shell jobs, or `source -j`)
+# each have their own.
+current_cmd_last_id = contextvars.ContextVar('current_cmd_last_id', default=None)
+
+# If set (by `source -j`), a list to which the last ID of each command run in this context is
+# appended, rather than it becoming last_id at once.
+deferred_last_ids = contextvars.ContextVar('deferred_last_ids', default=None)
+
+# The metadata cache holds information gathered by commands like `du` that is expensive to
+# collect and worth keeping between runs. It's only written out by save_state() if modified.
+#
+#   'folders' : an OrderedDict (in LRU order) of folder_id -> {'name', 'size', 'folders',
+#               'files_size', 'file_count'}, where 'folders' is a list of (id, name, size)
+#               tuples for the folder's sub-folders, as of when the folder was last listed.
+
+if os.path.exists(metadata_cache_file):
+    with open(metadata_cache_file, 'rb') as f:
+        metadata_cache = pickle.load(f)
+else:
+    metadata_cache = {'folders': OrderedDict()}
+metadata_cache_modified = False
 
 readline.set_history_length(readline_history_size)
 if os.path.exists(readline_history_file):
@@ -171,18 +225,61 @@ def load_tokens_or_die():
 # to at the top of the module) because importing these modules is slow.
 
 ops_client = None
+ops_network = None   # The network layer of ops_client
+
+# Observers (see network.py) that are told about every API request made by the ops client
+network_observers = []
+
+# If a metrics file is configured, the metrics (see metrics.py) gathered over the whole run are
+# written to it by write_metrics() when the program exits.
+metrics = None
+if metrics_file:
+    from .metrics import BoxMetrics
+    metrics = BoxMetrics()
+    network_observers.append(metrics)
+
+# Requests of interactive commands are favoured over those of shell jobs and prefetching, which
+# have smaller concurrency budgets and weights (see scheduler.py).
+PRIORITY_WEIGHTS = {'interactive': 8, 'background': 2, 'prefetch': 1}
+
+# Commands running at once (shell jobs, `source -j` lines, prefetching) may all ask for the client
+# first; this makes sure just one is created, so that they share its network layer and scheduler.
+ops_client_lock = threading.Lock()
 
 def get_ops_client():
-    global ops_client, BoxAPIException
-    if ops_client is None:
-        access_token, refresh_token = load_tokens_or_die()
-        from .auth import get_client
-        ops_client = get_client(client_id, client_secret, access_token, refresh_token, save_tokens)
+    global ops_client, ops_network, BoxAPIException
+    if ops_client is not None:
+        return ops_client
+    with ops_client_lock:
+        if ops_client is not None:
+            return ops_client
+        from .auth import get_client, set_api_base_url
+        from .scheduler import RequestScheduler
+        from boxsdk.exception import BoxAPIException
+        if api_base_url:
+            set_api_base_url(api_base_url)
+        scheduler = RequestScheduler(api_max_requests,
+                                     budgets={'background': background_max_requests,
+                                              'prefetch': prefetch_max_requests},
+                                     weights=PRIORITY_WEIGHTS, rate=api_rate_limit)
+        if replay_file:
+            from .cassette import ReplayNetwork
+            network = ReplayNetwork(network_observers, replay_file, replay_scale, scheduler=scheduler)
+            access_token, refresh_token = 'replay', 'replay'   # The tokens are never checked
+        else:
+            if record_file:
+                from .cassette import RecordingNetwork as network_class
+            else:
+                from .network import ObservedNetwork as network_class
+            network = network_class(network_observers, scheduler=scheduler)
+            access_token, refresh_token = load_tokens_or_die()
+        client = get_client(client_id, client_secret, access_token, refresh_token, save_tokens,
+                            network_layer=network)
         # Prevent the Box SDK from spewing logging messages
         logging.getLogger('boxsdk').setLevel(logging.CRITICAL)
-        import boxsdk.config
-        boxsdk.config.API.CHUNK_UPLOAD_THREADS = chunked_upload_num_threads
-        from boxsdk.exception import BoxAPIException
+        # ops_client is set last, since other threads take it as a sign that all of these are set
+        ops_network = network
+        ops_client = client
     return ops_client
 
 # print_table()    {{{2
@@ -203,7 +300,8 @@ def get_ops_client():
 #   is_sequence      : True if the elements of `items` are sequences
 #   field_val_func   : If provided, will be called when retrieving the field value for each item,
 #                      so that the value may be transformed, if desired. (See code below for usage)
-#   output_file      : the file object where output will be printed; default sys.stdout
+#   output_file      : the file object where output will be printed; if None, whatever
+#                      sys.stdout is when the table is printed (which may be a job's output)
 #
 # If both is_dict and is_sequence are False, `items` will be treated as a namespace,
 # and fields will be accessed via getattr()
@@ -213,7 +311,7 @@ def get_ops_client():
 def print_table(items, fields, *, colgap=2, print_header=True,
                 clip_fields=None, no_leader_fields=(),
                 is_dict=False, is_sequence=False,
-                field_val_func=None, output_file=sys.stdout):
+                field_val_func=None, output_file=None):
     numcols = len(fields)
     # Helper function so we can work with all sorts of items
     def _get_field_val(item, idx, field):
@@ -273,6 +371,13 @@ KB = 1024
 MB = KB * 1024
 GB = MB * 1024
 
+# Format a byte count compactly, like `du -h`
+def format_size(ival):
+    for unit, size in (('G', GB), ('M', MB), ('K', KB)):
+        if ival >= size:
+            return f"{ival / size:.1f}{unit}"
+    return str(int(ival))
+
 def print_stat_info(item, add_history=True, fields=None):
     fieldset = None if fields is None else set(fields)
     statlist = []
@@ -319,8 +424,6 @@ def print_stat_info(item, add_history=True, fields=None):
 # Box ID number, by searching ID aliases, item history, and ls history.
 
 def translate_id(id_):
-    global current_cmd_last_id
-    #
     if not id_:
         return None
     use_most_recent = False
@@ -397,13 +500,14 @@ def translate_id(id_):
         term = id_.casefold()
         retid = _choose_history_entry(id_, lambda entry : term == entry['name'].casefold(), use_most_recent)
     if retid:
-        current_cmd_last_id = retid
+        current_cmd_last_id.set(retid)
     return retid
 
 def _choose_history_entry(id_, entry_filter_func, use_most_recent):
     if not id_:
         return None
-    matched_ids = list(filter(entry_filter_func, item_history_map.values()))
+    with state_lock:
+        matched_ids = list(filter(entry_filter_func, item_history_map.values()))
     numchoices = len(matched_ids)
     if numchoices == 0:
         print(f'"{id_}" did not match any previous IDs')
@@ -442,12 +546,13 @@ def add_history_item(item, parent=None):
     entry = {'id': item.id, 'name': item.name, 'type': item.type,
              'parent_id' : p.id if p else None,
              'parent_name' : p.name if p else None }
-    if item.id in item_history_map:
-        item_history_map.move_to_end(item.id)
-    item_history_map[item.id] = entry
-    if (n := len(item_history_map) - id_history_size) > 0:
-        for i in range(n):
-            item_history_map.popitem(last=False)
+    with state_lock:
+        if item.id in item_history_map:
+            item_history_map.move_to_end(item.id)
+        item_history_map[item.id] = entry
+        if (n := len(item_history_map) - id_history_size) > 0:
+            for i in range(n):
+                item_history_map.popitem(last=False)
 
 # determine_item_type() {{{2
 
@@ -510,17 +615,18 @@ def retrieve_folder_items(client, folder, fields=['type', 'name', 'id', 'parent'
     try:
         while num_items > 0:
             pagesize = min(num_items, pagesize_limit)
-            item_iter = folder.get_items(fields=fields, limit=pagesize, offset=offset,
-                                         sort=sort, direction=direction)
-            for i in range(pagesize):
-                item = next(item_iter, None)
-                if not item:
-                    raise IndexError('Premature end to folder item_collection')
-                if filter_func and not filter_func(item):
-                    if break_on_filter:
-                        raise StopIteration()
-                else:
-                    items.append(item)
+            with trace_span('folder page', 'listing', folder=folder.object_id, offset=offset, limit=pagesize):
+                item_iter = folder.get_items(fields=fields, limit=pagesize, offset=offset,
+                                             sort=sort, direction=direction)
+                for i in range(pagesize):
+                    item = next(item_iter, None)
+                    if not item:
+                        raise IndexError('Premature end to folder item_collection')
+                    if filter_func and not filter_func(item):
+                        if break_on_filter:
+                            raise StopIteration()
+                    else:
+                        items.append(item)
             num_items -= pagesize
             offset += pagesize
     except IndexError as ex:
@@ -529,6 +635,185 @@ def retrieve_folder_items(client, folder, fields=['type', 'name', 'id', 'parent'
         pass
     return items
 
+# Retrieves all items in the folder with ID `folder_id`. Unlike retrieve_folder_items(), this
+# doesn't need the folder's item_collection to know how many items to page through, which saves
+# a request per folder when walking a tree.
+
+def retrieve_all_folder_items(client, folder_id, fields=['type', 'name', 'id', 'parent'], sort=None):
+    with trace_span('folder listing', 'listing', folder=folder_id) as args:
+        items = list(client.folder(folder_id).get_items(limit=BOX_GET_ITEMS_LIMIT, fields=fields, sort=sort))
+        args['items'] = len(items)
+    return items
+
+# Folder listing cache and prefetch {{{2
+
+# Listings of folders as shown by `ls`, kept for listing_cache_ttl seconds so that going back to
+# a folder, or into one the shell has prefetched, doesn't wait on the network. Each entry maps
+# folder_id -> (time fetched, (folder, items, parent)), in LRU order. Commands that change items
+# invalidate the whole cache; `listing_cache_generation` is bumped when they do, so that a
+# fetch that was already in flight doesn't put back a listing from before the change.
+
+LISTING_FIELDS = ['type', 'name', 'id', 'parent', 'description']
+LISTING_CACHE_SIZE = 500
+
+listing_cache = OrderedDict()
+listing_cache_lock = threading.Lock()
+listing_cache_generation = 0
+
+# Returns the cached (folder, items, parent) listing of `folder_id`, if it's fresh, or None
+def cached_folder_listing(folder_id):
+    with listing_cache_lock:
+        if (entry := listing_cache.get(folder_id)) and time.monotonic() - entry[0] < listing_cache_ttl:
+            listing_cache.move_to_end(folder_id)
+            return entry[1]
+    return None
+
+# Retrieves the folder, all its items, and its parent (or None for the root), and caches them.
+# If the caller already has the parent (with at least id, name, type, and parent), it can pass
+# it as `parent` to save fetching it again.
+def fetch_folder_listing(client, folder_id, parent=None):
+    generation = listing_cache_generation
+    fetched = time.monotonic()
+    folder = client.folder(folder_id=folder_id).get()
+    items = retrieve_folder_items(client, folder, fields=LISTING_FIELDS)
+    if parent is None and folder.parent:
+        parent = folder.parent.get(fields=['id', 'name', 'type', 'parent'])
+    listing = (folder, items, parent)
+    with listing_cache_lock:
+        if listing_cache_ttl > 0 and generation == listing_cache_generation:
+            listing_cache[folder.id] = (fetched, listing)
+            listing_cache.move_to_end(folder.id)
+            while len(listing_cache) > LISTING_CACHE_SIZE:
+                listing_cache.popitem(last=False)
+    return listing
+
+def invalidate_listing_cache():
+    global listing_cache_generation
+    with listing_cache_lock:
+        listing_cache.clear()
+        listing_cache_generation += 1
+
+# While the shell waits for input, fetches the listings of folders that are likely to be listed
+# next (set by `ls` in prefetch_candidates, as (folder ID, parent or None) tuples, the parent
+# being passed to fetch_folder_listing()) into the listing cache, using at most
+# prefetch_num_threads threads. Prefetching is cancelled as soon as the next command is entered;
+# fetches already in flight finish, but no new ones are started.
+
+prefetch_candidates = []
+
+class ListingPrefetcher:
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.cancelled = None
+
+    def start(self, candidates):
+        self.cancel()
+        if self.num_threads <= 0 or listing_cache_ttl <= 0:
+            return
+        self.cancelled = threading.Event()
+        queue = deque(candidates)
+        for _ in range(min(self.num_threads, len(queue))):
+            threading.Thread(target=self._prefetch, args=(queue, self.cancelled),
+                             name='prefetch', daemon=True).start()
+
+    def cancel(self):
+        if self.cancelled:
+            self.cancelled.set()
+            self.cancelled = None
+
+    def _prefetch(self, queue, cancelled):
+        request_priority.set('prefetch')
+        client = get_ops_client()
+        while not cancelled.is_set():
+            try:
+                folder_id, parent = queue.popleft()
+            except IndexError:
+                return
+            if cached_folder_listing(folder_id) is None:
+                try:
+                    fetch_folder_listing(client, folder_id, parent)
+                except Exception:
+                    pass   # Prefetching is only an optimization; `ls` will report any error
+
+listing_prefetcher = ListingPrefetcher(prefetch_num_threads)
+
+# walk_folder_tree() {{{2
+
+# Traverses the tree of folders rooted at `folder`, listing up to api_num_threads folders
+# concurrently. Yields a tuple of (folder, path, items) for each folder as its listing arrives,
+# where `path` is the tuple of folder names leading from (but not including) the root `folder`,
+# and `items` is the list returned by retrieve_all_folder_items(). The order in which folders are
+# yielded is not deterministic.
+#
+#   fields       : item fields to request; these must include 'type', 'name', and 'id'
+#   max_levels   : if given, don't list folders more than max_levels - 1 levels below `folder`
+#   recurse_func : if given, a sub-folder is only traversed if recurse_func(subfolder) is True
+#
+# Folders waiting to be listed are kept on a stack, so the traversal proceeds depth-first and the
+# number of listings held in memory stays small even for very large trees.
+
+def walk_folder_tree(client, folder, fields=['type', 'name', 'id'], max_levels=None, recurse_func=None):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    stack = [(folder, (), 0)]
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=api_num_threads)
+    try:
+        while stack or pending:
+            while stack and len(pending) < api_num_threads:
+                entry = stack.pop()
+                pending[executor.submit(contextvars.copy_context().run,
+                                        retrieve_all_folder_items, client, entry[0].id, fields)] = entry
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                _folder, path, level = pending.pop(future)
+                items = future.result()
+                if max_levels is None or level + 1 < max_levels:
+                    for item in reversed(items):
+                        if item.type == 'folder' and (not recurse_func or recurse_func(item)):
+                            stack.append((item, path + (item.name,), level + 1))
+                yield _folder, path, items
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# bounded_map() {{{2
+
+# Calls func(arg) for every arg in `iterable` on a pool of `num_threads` threads, yielding
+# (arg, result) tuples. No more than `max_pending` calls (by default twice the number of threads)
+# are in flight at once, and `iterable` is consumed only as calls complete, so it can be a
+# generator over millions of items without them all being held in memory.
+#
+#   ordered - if True, results are yielded in the order of `iterable`, which gives read-ahead
+#             of up to max_pending items; otherwise they're yielded as soon as they complete.
+#
+# Exceptions raised by func are re-raised when the corresponding result would be yielded.
+
+def bounded_map(func, iterable, num_threads, max_pending=None, ordered=False):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    max_pending = max_pending or num_threads * 2
+    args = iter(iterable)
+    pending = {}  # future -> arg, kept in submission order
+    executor = ThreadPoolExecutor(max_workers=num_threads)
+    try:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    arg = next(args)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(contextvars.copy_context().run, func, arg)] = arg
+            if not pending:
+                break
+            if ordered:
+                future = next(iter(pending))
+            else:
+                future = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+            arg = pending.pop(future)
+            yield arg, future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
 # expand_all() {{{2
 
 # Expand both environment variables and the user home dir '~' in path
@@ -536,6 +821,26 @@ def retrieve_folder_items(client, folder, fields=['type', 'name', 'id', 'parent'
 def expand_all(path):
     return os.path.expandvars(os.path.expanduser(path)) if path else None
 
+# local_sha1() and is_same_file() {{{2
+
+# Returns the hex SHA-1 digest of a local file, as Box reports in the 'sha1' field.
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def local_sha1(filepath):
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+# Returns True if the local file at `filepath` has the same contents as the Box file `item`,
+# which must have been retrieved with the 'size' and 'sha1' fields. The size is compared
+# first so that we only hash local files that have a chance of matching.
+
+def is_same_file(filepath, item):
+    return item.size == os.path.getsize(filepath) and item.sha1 == local_sha1(filepath)
+
 # print_name_header() {{{2
 
 # Prints a boxed header spanning the width of the terminal.
@@ -605,8 +910,6 @@ def list_aliases(filter_term=None):
 #             for example, by shlex.split()
 
 def process_cmdline(cmdline):
-    global last_id
-    #
     if len(cmdline) == 0:
         return
     if type(cmdline) == str:
@@ -615,6 +918,53 @@ def process_cmdline(cmdline):
         except ValueError as ex:
             print('shlex error:', ex)
             return
+    cmdline = list(cmdline)   # The caller's tokens (e.g. a job's) are left as they are
+    # Strip global options, which may precede any command
+    global_options = {}
+    while cmdline and cmdline[0] in GLOBAL_OPTIONS:
+        option = cmdline.pop(0)
+        if GLOBAL_OPTIONS[option]:
+            if not cmdline:
+                print(f"Global option {option} requires an argument")
+                return
+            global_options[option] = cmdline.pop(0)
+        else:
+            global_options[option] = True
+    if not cmdline:
+        return
+    # The profiler and tracer observe only this command's requests (including those made by its
+    # worker threads), not those of shell jobs or prefetching running at the same time.
+    profiler = tracer = None
+    if '--profile' in global_options:
+        from .network import RequestProfiler
+        profiler = RequestProfiler()
+    if trace_file := global_options.get('--trace'):
+        from . import tracing
+        tracer = tracing.Tracer()
+    def _run_observed():
+        if profiler or tracer:
+            from .network import context_observers
+            context_observers.set(context_observers.get() + tuple(filter(None, (profiler, tracer))))
+        if tracer:
+            tracing.active_tracer.set(tracer)
+        with trace_span(shlex.join(cmdline), 'command'):
+            _process_cmdline(cmdline)
+    try:
+        contextvars.copy_context().run(_run_observed)
+    finally:
+        if profiler:
+            print_request_profile(profiler)
+        if tracer:
+            try:
+                tracer.write(os.path.expanduser(trace_file))
+            except OSError as ex:
+                print(f"Unable to write trace file: {ex}", file=sys.stderr)
+
+# Global options, mapped to whether they take an argument
+GLOBAL_OPTIONS = {'--profile': False, '--trace': True}
+
+def _process_cmdline(cmdline):
+    global last_id
     #
     if cmdline == ['@']:
         print(f"Last ID: {last_id}")
@@ -627,38 +977,325 @@ def process_cmdline(cmdline):
     else:
         cmd, *args = cmdline
         if cmd in command_funcs:
+            start, outcome = time.monotonic(), 'error'
             try:
-                command_funcs[cmd](args)
+                # Run each command in a copy of the current context, so that context variables
+                # the command sets (like bwlimit_buckets) don't outlive it.
+                cmd_context = contextvars.copy_context()
+                try:
+                    cmd_context.run(command_funcs[cmd], args)
+                finally:
+                    if stats := cmd_context.get(transfer_stats):
+                        stats.summary()
+                outcome = 'ok'
             except SystemExit:
                 # We catch this so that the program doesn't exit when argparse.parse_args()
                 # gets a '--help' or incorrect arguments.
-                pass
+                outcome = 'usage'
             except argparse.ArgumentError as e:
+                outcome = 'usage'
                 print(e)
             except BoxAPIException as e:
                 print("# BoxAPIException #\n")
                 print(f"Message: {e.message}",
                       f" Status: {e.status}",
                       sep='\n')
-            last_id = current_cmd_last_id
+            finally:
+                if command_funcs[cmd] in mutating_command_funcs:
+                    invalidate_listing_cache()
+                if metrics:
+                    command = command_funcs[cmd].__name__.removesuffix('_cmd')
+                    metrics.commands.labels(command, outcome).inc()
+                    metrics.command_seconds.labels(command).observe(time.monotonic() - start)
+            if (cmd_last_id := cmd_context.get(current_cmd_last_id)) is not None:
+                if (deferred := deferred_last_ids.get()) is not None:
+                    deferred.append(cmd_last_id)
+                else:
+                    last_id = cmd_last_id
         else:
             print(f"Unknown command '{cmd}'")
     sys.stdout.flush()  # make sure output is visible even if sourcing a script
 
+# print_request_profile() {{{2
+
+# Prints the statistics gathered by a RequestProfiler for `--profile`, to stderr
+
+def print_request_profile(profiler):
+    print(f"\nAPI profile: {profiler.num_requests} requests, {profiler.retries} retries; "
+          f"{profiler.wall_time:.2f}s wall time, {profiler.network_time:.2f}s waiting on the network "
+          f"({profiler.request_time:.2f}s total request time)", file=sys.stderr)
+    if not profiler.endpoints:
+        return
+    rows = [(method, endpoint, str(stats['calls']), str(stats['errors']), f"{stats['time']:.3f}",
+             f"{stats['time'] / stats['calls'] * 1000:.1f}", f"{stats['max'] * 1000:.1f}",
+             format_size(stats['sent']), format_size(stats['recv']))
+            for (method, endpoint), stats in profiler.endpoint_stats()]
+    print_table(rows, ('method', 'endpoint', 'calls', 'errors', 'secs', 'avg_ms', 'max_ms', 'sent', 'recv'),
+                no_leader_fields=('method', 'calls', 'errors', 'secs', 'avg_ms', 'max_ms', 'sent', 'recv'),
+                is_sequence=True, output_file=sys.stderr)
+
+# Shell background jobs {{{2
+
+# The shell runs a command line ending in '&' as a job, in a thread of its own. While the shell
+# is running, sys.stdout and sys.stderr are OutputRouters, which send what's printed in a job's
+# context (including by the worker threads it starts, which run in copies of that context) to the
+# job's JobOutput, where it's kept until the user brings the job to the foreground with `fg`.
+
+job_output = contextvars.ContextVar('job_output', default=None)
+
+# Returns True when running in a job (or a `source -j` line). Commands running there leave the
+# numbered item list and prefetch candidates alone, since those belong to what the user last ran
+# in the foreground.
+def in_job():
+    return job_output.get() is not None
+
+class OutputRouter:
+    def __init__(self, stream, index):
+        self.stream = stream
+        self.index = index      # 0 for stdout, 1 for stderr
+
+    def _target(self):
+        output = job_output.get()
+        return output.streams[self.index] if output else self.stream
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+# Routes sys.stdout and sys.stderr through OutputRouters for the duration, unless they already are
+@contextlib.contextmanager
+def routed_output():
+    if isinstance(sys.stdout, OutputRouter):
+        yield
+        return
+    sys.stdout, sys.stderr = OutputRouter(sys.stdout, 0), OutputRouter(sys.stderr, 1)
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = sys.stdout.stream, sys.stderr.stream
+
+# Holds what a job writes to stdout and stderr, in the order it was written, until attach() is
+# called; after that, it's written straight to the attached streams. Bytes written to a stream's
+# `buffer` (by commands like `cat` and `get ... -`) are kept as bytes, and written to the
+# attached stream's own buffer.
+class JobOutput:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks = []        # (stream index, str or bytes)
+        self.attached = None    # the (stdout, stderr) output goes to, while in the foreground
+        self.streams = (self._Stream(self, 0), self._Stream(self, 1))
+
+    class _Stream:
+        def __init__(self, output, index):
+            self.output = output
+            self.index = index
+            self.buffer = JobOutput._BinaryWriter(self)
+
+        def write(self, s):
+            return self.output._write(self.index, s)
+
+        def flush(self):
+            self.output._flush(self.index)
+
+        def isatty(self):
+            return False
+
+    # Lets commands that write bytes to sys.stdout.buffer, like `cat`, run as jobs
+    class _BinaryWriter:
+        def __init__(self, stream):
+            self.stream = stream
+
+        def write(self, data):
+            return self.stream.output._write(self.stream.index, bytes(data))
+
+        def flush(self):
+            self.stream.flush()
+
+        def isatty(self):
+            return False
+
+    @staticmethod
+    def _write_to(stream, chunk):
+        if isinstance(chunk, bytes):
+            stream.flush()
+            stream.buffer.write(chunk)
+        else:
+            stream.write(chunk)
+
+    def _write(self, index, chunk):
+        with self.lock:
+            if self.attached:
+                self._write_to(self.attached[index], chunk)
+            else:
+                self.chunks.append((index, chunk))
+        return len(chunk)
+
+    def _flush(self, index):
+        with self.lock:
+            if self.attached:
+                stream = self.attached[index]
+                stream.flush()
+                if hasattr(stream, 'buffer'):
+                    stream.buffer.flush()
+
+    @property
+    def pending(self):
+        with self.lock:
+            return sum(len(chunk) for _, chunk in self.chunks)
+
+    # Writes out what's been captured so far, and sends further output straight to `stdout` and
+    # `stderr`
+    def attach(self, stdout, stderr):
+        with self.lock:
+            streams = (stdout, stderr)
+            for index, chunk in self.chunks:
+                if index == 1:
+                    stdout.flush()
+                    stdout.buffer.flush()
+                self._write_to(streams[index], chunk)
+                if index == 1:
+                    stderr.flush()
+            stdout.flush()
+            stdout.buffer.flush()
+            self.chunks.clear()
+            self.attached = streams
+
+    def detach(self):
+        with self.lock:
+            self.attached = None
+
+# Raised in a job's thread to stop it. It's not an Exception, so commands can't swallow it.
+class JobKilled(BaseException):
+    pass
+
+class Job:
+    def __init__(self, job_id, cmdline):
+        self.id = job_id
+        self.cmdline = cmdline
+        self.output = JobOutput()
+        self.state = 'Running'
+        self.notified = False   # whether the shell has reported that the job ended
+        self.thread = threading.Thread(target=self._run, name=f'job-{job_id}', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        job_output.set(self.output)
+        request_priority.set('background')
+        try:
+            process_cmdline(self.cmdline)
+            self.state = 'Done'
+        except BaseException as ex:
+            # An except clause that was being matched against the JobKilled can itself raise
+            # (e.g. a NameError for BoxAPIException before the client is created)
+            cause = ex
+            while cause is not None and not isinstance(cause, JobKilled):
+                cause = cause.__context__
+            if cause is not None:
+                print("** Killed **")
+                self.state = 'Killed'
+            else:
+                print(f"** {type(ex).__name__}: {ex} **")
+                self.state = 'Failed'
+
+    # A job can only be stopped between Python instructions, so a request in progress finishes
+    # first; worker threads the job started stop when their current task is done.
+    def kill(self):
+        import ctypes
+        if self.thread.is_alive():
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.thread.ident),
+                                                       ctypes.py_object(JobKilled))
+
+    def __str__(self):
+        return f"[{self.id}] {self.state:<8} {shlex.join(self.cmdline)}"
+
+shell_jobs = OrderedDict()   # job ID -> Job
+
+def start_job(cmdline):
+    job_id = max(shell_jobs, default=0) + 1
+    shell_jobs[job_id] = job = Job(job_id, cmdline)
+    print(f"[{job_id}] started")
+    return job
+
+# Prints a line for each job that has ended since the last time this was called, and forgets
+# those that have nothing left to show.
+def report_ended_jobs():
+    for job in list(shell_jobs.values()):
+        if job.state != 'Running' and not job.notified:
+            job.notified = True
+            pending = job.output.pending
+            print(str(job) + (f"  ({format_size(pending)}B of output; 'fg {job.id}' to see it)" if pending else ""))
+            if not pending:
+                del shell_jobs[job.id]
+
+# Returns the job referred to by `args` (a job ID, optionally preceded by '%'), or the most
+# recently started job if `args` is empty.
+def get_job(args):
+    if not args:
+        if not shell_jobs:
+            print("No jobs")
+            return None
+        return next(reversed(shell_jobs.values()))
+    try:
+        job_id = int(args[0].lstrip('%'))
+    except ValueError:
+        job_id = None
+    if (job := shell_jobs.get(job_id)) is None:
+        print(f"No such job: {args[0]}")
+    return job
+
+def jobs_builtin(args):
+    for job in shell_jobs.values():
+        pending = job.output.pending
+        print(str(job) + (f"  ({format_size(pending)}B of output)" if pending else ""))
+
+# Brings a job to the foreground: prints its output so far, and then its output as it happens,
+# until it ends. A Ctrl-C sends it back to the background.
+def fg_builtin(args):
+    if (job := get_job(args)) is None:
+        return
+    print(shlex.join(job.cmdline))
+    job.output.attach(sys.stdout.stream, sys.stderr.stream)
+    try:
+        while job.thread.is_alive():
+            job.thread.join(0.2)
+    except KeyboardInterrupt:
+        job.output.detach()
+        print(f"\n[{job.id}] continuing in the background")
+        return
+    del shell_jobs[job.id]
+    if job.state != 'Done':
+        print(job)
+
+def kill_builtin(args):
+    if not args:
+        print("Usage: kill job_id")
+    elif job := get_job(args):
+        job.kill()
+
 # save_state() {{{2
 
 # Writes all persistent program state to their respective files.
 
 def save_state():
     # Save "app state"
-    _lshist = list(ls_history_deque)
-    with open(app_state_file, "wb") as f:
+    with state_lock, open(app_state_file, "wb") as f:
+        _lshist = list(ls_history_deque)
         pickle.dump(file=f,
                     obj={ 'item_history_map'  : item_history_map,
                           'last_id'           : last_id,
                           'ls_history'        : _lshist,
                           'item_stash'        : item_stash,
                           'numeric_item_list' : numeric_item_list })
+    # Save the metadata cache
+    with state_lock:
+        if metadata_cache_modified:
+            with open(metadata_cache_file, "wb") as f:
+                pickle.dump(metadata_cache, f)
     # Save readline history
     readline.write_history_file(readline_history_file)
     # Save ID aliases
@@ -668,6 +1305,25 @@ def save_state():
                 _commentstr = "  " + comment if comment else ""
                 print(f"{alias} = {id}{_commentstr}", file=f)
 
+# write_metrics() {{{2
+
+# Writes the metrics gathered during this run to the configured metrics file, if any.
+
+def write_metrics():
+    if metrics:
+        try:
+            metrics.write(metrics_file)
+        except OSError as ex:
+            print(f"Unable to write metrics file: {ex}", file=sys.stderr)
+
+# save_recording() {{{2
+
+# Writes the API traffic recorded during this run, if $BOXTOOLS_RECORD is set, to its cassette file.
+
+def save_recording():
+    if record_file and ops_network:
+        ops_network.save(record_file)
+
 # get_name_len() and get_id_len() {{{2
 
 # Used to determine max name and ID length for commands like ls, search, etc.
@@ -735,7 +1391,9 @@ def get_repr_info(client, rep, silent=False):
     state = None
     attempts = 0
     while attempts < representation_max_attempts and state != 'success':
-        response = client.session.get(rep['url']).json()
+        with trace_span('representation poll', 'repr', attempt=attempts) as args:
+            response = client.session.get(rep['url']).json()
+            args['state'] = response['status']['state']
         state = response['status']['state']
         if state == 'pending':
             if not silent:
@@ -786,6 +1444,597 @@ def download_repr(client, repr_info, item_name, savedir, silent=False):
                 f.write(response.content)
             if not silent: print('done.')
 
+# stream_response_chunks() {{{2
+
+# Issues a GET for `url` and yields the body in chunks as it arrives. If the caller stops
+# iterating early, the connection is closed rather than left to drain the rest of the body.
+
+def stream_response_chunks(client, url, headers=None):
+    response = client.session.get(url, expect_json_response=False, stream=True, headers=headers)
+    stream = response.network_response.response_as_stream
+    try:
+        yield from stream.stream(decode_content=True)
+    finally:
+        stream.close()
+
+# Bandwidth limiting {{{2
+
+# A token bucket shared by all the threads transferring in one direction. Each transfer takes
+# tokens (bytes) before moving its data; when the bucket is overdrawn, the caller sleeps until the
+# debt would be repaid at `rate` bytes/sec. `burst` is the most that can accumulate while idle.
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate / 4, 64*KB)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+# Parses a bandwidth limit: either a single rate for both directions, or UP:DOWN. A rate is a
+# number of bytes/sec with an optional K, M, or G suffix, and 0 or "off" means unlimited.
+# Returns a dict of 'up' and 'down' to TokenBucket (or None).
+
+def parse_bwlimit(spec):
+    ####
+    def _rate(s):
+        s = s.strip().upper()
+        if s in ('', '0', 'OFF'):
+            return None
+        multiplier = {'K': KB, 'M': MB, 'G': GB}.get(s[-1], 1)
+        rate = float(s[:-1] if multiplier != 1 else s) * multiplier
+        return TokenBucket(rate) if rate > 0 else None
+    ####
+    up, _, down = spec.partition(':')
+    return {'up': _rate(up), 'down': _rate(down if _ else up)}
+
+try:
+    config_bwlimit_buckets = parse_bwlimit(bwlimit)
+except ValueError:
+    print(f"Invalid bwlimit \"{bwlimit}\" in '{config_file}'", file=sys.stderr)
+    sys.exit(1)
+
+# The buckets in effect: those from the config file, unless a command has given --bwlimit.
+# Commands run in their own context (see process_cmdline()), and worker threads started through
+# bounded_map() inherit it, so an override lasts only for the command that set it.
+bwlimit_buckets = contextvars.ContextVar('bwlimit_buckets', default=config_bwlimit_buckets)
+
+def add_bwlimit_argument(cli_parser):
+    cli_parser.add_argument('--bwlimit', metavar='RATE',
+                            help='Limit transfer bandwidth to RATE bytes/sec (K, M, G suffixes allowed), '
+                                 'or UP:DOWN rates, overriding the bwlimit config setting. 0 means no limit')
+
+# For commands' --bwlimit option. Returns False if `spec` is invalid.
+def set_command_bwlimit(spec):
+    if spec is not None:
+        try:
+            bwlimit_buckets.set(parse_bwlimit(spec))
+        except ValueError:
+            print(f'Invalid bandwidth limit "{spec}"')
+            return False
+    return True
+
+# Transfer statistics {{{2
+
+# Gathers the numbers for one command's transfers: bytes moved, and the time and size of each
+# file. While transfers are running a progress line with the aggregate rate and an ETA is kept
+# up to date on stderr (if it's a terminal), and summary() reports on the whole command.
+
+class TransferStats:
+    SLOWEST_FILES = 3
+
+    def __init__(self, show_progress=True):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.show_progress = show_progress and sys.stderr.isatty()
+        self.expected_files = self.expected_bytes = 0
+        self.bytes = 0
+        self.files = []   # (name, size, elapsed)
+        self.last_render = 0.0
+
+    # Registers a file that will be transferred, for the ETA
+    def expect(self, size):
+        with self.lock:
+            self.expected_files += 1
+            self.expected_bytes += size or 0
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes += n
+            if self.show_progress and (now := time.monotonic()) - self.last_render >= 0.25:
+                self.last_render = now
+                self._render(now)
+
+    def file_done(self, name, size, elapsed):
+        with self.lock:
+            self.files.append((name, size or 0, elapsed))
+
+    def _render(self, now):
+        elapsed = now - self.start
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+        progress = f"{len(self.files)}/{max(self.expected_files, len(self.files))} files, " \
+                   f"{format_size(self.bytes)}"
+        eta = ""
+        if self.expected_bytes > self.bytes and rate > 0:
+            progress += f"/{format_size(self.expected_bytes)}"
+            eta = f", ETA {format_duration((self.expected_bytes - self.bytes) / rate)}"
+        sys.stderr.write(f"\033[2K\r[{progress} at {format_size(rate)}/s{eta}]\r")
+        sys.stderr.flush()
+
+    def summary(self, file=None):
+        file = file or sys.stderr
+        if self.show_progress:
+            file.write("\033[2K\r")
+        if not self.files:
+            return
+        elapsed = time.monotonic() - self.start
+        print(f"Transferred {len(self.files)} file(s), {format_size(self.bytes)} in {format_duration(elapsed)} "
+              f"({format_size(self.bytes / elapsed if elapsed > 0 else 0)}/s)", file=file)
+        if len(self.files) > 1:
+            slowest = sorted(self.files, key=lambda f: f[2], reverse=True)[:self.SLOWEST_FILES]
+            print("Slowest:", ", ".join(f"{name} {format_duration(t)} ({format_size(size / t if t > 0 else 0)}/s)"
+                                        for name, size, t in slowest), file=file)
+
+# Format a duration in seconds as [H:]M:SS, or in seconds with a decimal if under a minute
+def format_duration(secs):
+    if secs < 60:
+        return f"{secs:.1f}s"
+    m, s = divmod(int(secs), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02}:{s:02}" if h else f"{m}:{s:02}"
+
+# The TransferStats for the command running in this context, if it transfers files. Like
+# bwlimit_buckets, this is set by the command and inherited by its worker threads.
+transfer_stats = contextvars.ContextVar('transfer_stats', default=None)
+
+# Called by transferring commands, unless they've been told to be quiet
+def start_transfer_stats(show_progress=True):
+    transfer_stats.set(TransferStats(show_progress))
+
+# Times the transfer of a file called `name`, of `size` bytes, done in the with-block.
+@contextlib.contextmanager
+def timed_transfer(name, size):
+    stats = transfer_stats.get()
+    start = time.monotonic()
+    if stats:
+        stats.expect(size)
+    with trace_span(name, 'transfer', size=size):
+        yield
+    if stats:
+        stats.file_done(name, size, time.monotonic() - start)
+
+# TransferStream {{{2
+
+# A wrapper for a binary stream being uploaded from or downloaded into, that throttles the data
+# read from or written to it through a TokenBucket, and counts it in a TransferStats (either of
+# which may be None). It also provides seek() and tell(), which boxsdk uses to rewind uploads for
+# retries, and a `len` attribute giving the number of bytes left to read, which the multipart
+# encoder uses to size uploads.
+
+class TransferStream:
+    def __init__(self, f, bucket, stats, counter=None):
+        self.f = f
+        self.bucket = bucket
+        self.stats = stats
+        self.counter = counter
+
+    def _transfer(self, n):
+        if self.bucket:
+            self.bucket.consume(n)
+        if self.stats:
+            self.stats.add_bytes(n)
+        if self.counter:
+            self.counter.inc(n)
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self._transfer(len(data))
+        return data
+
+    def write(self, data):
+        self._transfer(len(data))
+        return self.f.write(data)
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+    def tell(self):
+        return self.f.tell()
+
+    @property
+    def len(self):
+        pos = self.f.tell()
+        end = self.f.seek(0, os.SEEK_END)
+        self.f.seek(pos)
+        return end - pos
+
+    def flush(self):
+        self.f.flush()
+
+# Returns `f` wrapped in a TransferStream if there's a bandwidth limit for `direction` ('up' or
+# 'down'), the command is gathering transfer statistics, or metrics are being kept, or else `f`
+# itself.
+def transfer_stream(f, direction):
+    bucket, stats = bwlimit_buckets.get()[direction], transfer_stats.get()
+    counter = metrics.transfer_bytes.labels(direction) if metrics else None
+    return TransferStream(f, bucket, stats, counter) if bucket or stats or counter else f
+
+# download_file() and co. {{{2
+
+# A write-only stream wrapper that feeds everything written through it into a SHA-1 hash,
+# so that downloads can be verified as they stream rather than by re-reading the file.
+
+class HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.sha1.update(data)
+        return self.f.write(data)
+
+# Download `file` into the binary stream `f`, verifying its contents against the file's 'sha1'
+# field (if `file` was retrieved with that field) while the data is being written.
+#
+#   max_attempts - how many times to try the download if the digest doesn't match. Since a retry
+#                  rewinds and truncates `f`, use 1 for streams that can't be rewound, like stdout.
+#
+# Returns True if the download was verified (or there was no SHA-1 to check against).
+
+def download_file(file, f, max_attempts=download_max_attempts):
+    expected_sha1 = getattr(file, 'sha1', None)
+    with timed_transfer(file.name, getattr(file, 'size', None)):
+        return _download_file(file, f, max_attempts, expected_sha1)
+
+def _download_file(file, f, max_attempts, expected_sha1):
+    for attempt in range(1, max_attempts + 1):
+        writer = HashingWriter(transfer_stream(f, 'down'))
+        file.download_to(writer)
+        actual_sha1 = writer.sha1.hexdigest()
+        if expected_sha1 is None or actual_sha1 == expected_sha1:
+            return True
+        retry_msg = ", retrying" if attempt < max_attempts else ""
+        print(f'SHA-1 mismatch for "{file.name}" (expected {expected_sha1}, got {actual_sha1}){retry_msg}',
+              file=sys.stderr)
+        if attempt < max_attempts:
+            f.seek(0)
+            f.truncate()
+    return False
+
+# download_tar() {{{2
+
+# Files fetched ahead of the one being written to the archive are held in memory up to this
+# size, and spooled to a temporary file beyond it.
+TAR_SPOOL_MAX_SIZE = 8*1024*1024
+
+# Writes the Box files and folders in `items` to `f` as a tar stream. Folders are archived with
+# all their contents, under a top-level directory of the folder's name.
+#
+#   filter_func - if given, a file is only included if filter_func(file) is True
+#   unspace     - unspace the names of archive members
+#   quiet       - don't print the name of each member (to stderr) as it's added
+#
+# The folder trees are first listed concurrently by walk_folder_tree(), and the members are then
+# written in a deterministic order (sorted by name within each folder, depth-first), regardless of
+# the order in which listings and downloads complete. Files are downloaded by up to
+# transfer_num_threads workers, reading ahead of the member currently being written.
+#
+# Returns the number of files that failed to download or failed SHA-1 verification.
+
+def download_tar(client, items, f, filter_func=None, unspace=False, quiet=False):
+    import tarfile, tempfile
+    from datetime import datetime
+    from requests.exceptions import RequestException
+    fields = ['type', 'name', 'id', 'size', 'sha1', 'content_modified_at', 'modified_at']
+    ####
+    def _member_name(name):
+        return unspace_name(name) if unspace else name
+    ####
+    # Items without a timestamp get a fixed one, so that the same items always make the same archive
+    def _mtime(item):
+        timestamp = getattr(item, 'content_modified_at', None) or getattr(item, 'modified_at', None)
+        return datetime.fromisoformat(timestamp).timestamp() if timestamp else 0
+    ####
+    def _sorted_listing(folder):
+        return sorted(retrieve_all_folder_items(client, folder.id, fields=fields), key=lambda it: it.name)
+    ####
+    # Yields (item, member_path) in archive order: a folder, then its files, then each of its
+    # sub-folders in turn, all sorted by name. Folders are listed as the archive reaches them, with
+    # the listings of the sub-folders that come next read ahead.
+    def _entries(folder, folder_items, dirpath):
+        yield folder, dirpath
+        subfolders = []
+        for item in folder_items:
+            if item.type == 'folder':
+                subfolders.append(item)
+            elif item.type == 'file' and (not filter_func or filter_func(item)):
+                yield item, dirpath + '/' + _member_name(item.name)
+        for subfolder, subfolder_items in bounded_map(_sorted_listing, subfolders, api_num_threads,
+                                                      ordered=True):
+            yield from _entries(subfolder, subfolder_items, dirpath + '/' + _member_name(subfolder.name))
+    ####
+    def _archive_entries():
+        for item in items:
+            if item.type == 'folder':
+                yield from _entries(item, _sorted_listing(item), _member_name(item.name))
+            elif item.type == 'file':
+                yield item, _member_name(item.name)
+    ####
+    # Runs on a worker thread: returns a rewound file object holding the contents, or the exception
+    # (from the API, the connection, or the spool file) that kept it from being downloaded.
+    def _fetch(entry):
+        item, _ = entry
+        if item.type != 'file':
+            return None
+        tmp = tempfile.SpooledTemporaryFile(max_size=TAR_SPOOL_MAX_SIZE)
+        try:
+            if not download_file(item, tmp):
+                raise ValueError("failed SHA-1 verification")
+            tmp.seek(0)
+            return tmp
+        except (BoxAPIException, ValueError, RequestException, OSError) as ex:
+            tmp.close()
+            return ex
+    ####
+    failures = 0
+    with tarfile.open(fileobj=f, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        for (item, member_path), result in bounded_map(_fetch, _archive_entries(),
+                                                       transfer_num_threads, ordered=True):
+            if isinstance(result, Exception):
+                print(f"** Failed to download {member_path}: {getattr(result, 'message', result)} **",
+                      file=sys.stderr)
+                failures += 1
+                continue
+            tarinfo = tarfile.TarInfo(member_path)
+            tarinfo.mtime = _mtime(item)
+            if not quiet: print(f"Adding {member_path}", file=sys.stderr)
+            if result is None:
+                tarinfo.type = tarfile.DIRTYPE
+                tarinfo.mode = 0o755
+                tar.addfile(tarinfo)
+            else:
+                with result:
+                    result.seek(0, os.SEEK_END)
+                    tarinfo.size = result.tell()
+                    tarinfo.mode = 0o644
+                    result.seek(0)
+                    tar.addfile(tarinfo, result)
+    return failures
+
+# stream_file_range() {{{2
+
+# Ranges streamed by stream_file_range() are fetched in segments of this size
+STREAM_SEGMENT_SIZE = 1024*1024
+
+# Writes bytes [start, end) of `file` to the binary stream `f`. The range is fetched as a series
+# of STREAM_SEGMENT_SIZE segments by up to transfer_num_threads workers, and each segment is
+# written (in order) as soon as it and those before it have arrived, so output begins right away
+# and at most a few segments are held in memory, no matter how large the range.
+#
+# Returns the last byte written, or b'' if nothing was written.
+
+def stream_file_range(file, f, start, end):
+    ####
+    def _fetch(segment):
+        # byte_range is inclusive at both ends
+        return file.content(byte_range=(segment, min(segment + STREAM_SEGMENT_SIZE, end) - 1))
+    ####
+    last_byte = b''
+    for _, data in bounded_map(_fetch, range(start, end, STREAM_SEGMENT_SIZE), transfer_num_threads,
+                               ordered=True):
+        f.write(data)
+        f.flush()
+        last_byte = data[-1:] or last_byte
+    return last_byte
+
+# upload_file() {{{2
+
+# Upload the local file at `filepath` into `folder`, using a chunked upload if the file is larger
+# than chunked_upload_size_threshold. If `existing` (a File already in `folder`) is given, the
+# file is uploaded as a new version of it instead; a plain upload that gets a 409 conflict because
+# the name was taken since `folder` was listed likewise falls back to a new version.
+#
+# Returns a tuple of (file, new_version).
+
+def upload_file(client, folder, filepath, existing=None):
+    with timed_transfer(os.path.basename(filepath), os.path.getsize(filepath)):
+        return _upload_file(client, folder, filepath, existing)
+
+def _upload_file(client, folder, filepath, existing):
+    use_chunked = os.path.getsize(filepath) > chunked_upload_size_threshold
+    if existing is None:
+        try:
+            if use_chunked:
+                return chunked_upload_file(
+                    lambda size: folder.create_upload_session(size, os.path.basename(filepath)), filepath), False
+            else:
+                with open(filepath, 'rb') as f:
+                    return folder.upload_stream(transfer_stream(f, 'up'), os.path.basename(filepath)), False
+        except BoxAPIException as ex:
+            if ex.status != 409:
+                raise ex
+            existing = client.file(ex.context_info['conflicts']['id'])
+    file = client.file(existing.id)
+    if use_chunked:
+        file = chunked_upload_file(file.create_upload_session, filepath)
+    else:
+        with open(filepath, 'rb') as f:
+            file = file.update_contents_with_stream(transfer_stream(f, 'up'))
+    return file, True
+
+# upload_stream() and co. {{{2
+
+# Reads exactly `n` bytes from `stream` (fewer only at EOF), since reads from pipes may
+# return short.
+
+def read_exactly(stream, n):
+    chunks = []
+    while n > 0:
+        chunk = stream.read(n)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+# Chooses how many parts of a chunked upload to send at once. Starting from `initial`, after
+# each window of completed parts the level is moved up while doing so raises throughput, and
+# moved back down when throughput falls or per-part latency climbs without any gain in
+# throughput (a sign that the link is saturated and parts are just queueing).
+
+class AdaptiveConcurrency:
+    def __init__(self, initial, maximum):
+        self.maximum = maximum
+        self.level = max(1, min(initial, maximum))
+        self.prev_rate = self.prev_latency = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.monotonic()
+        self.window_bytes = self.window_parts = 0
+        self.window_latency = 0.0
+
+    def record(self, nbytes, latency):
+        self.window_bytes += nbytes
+        self.window_parts += 1
+        self.window_latency += latency
+        if self.window_parts < max(2, self.level):
+            return
+        rate = self.window_bytes / max(time.monotonic() - self.window_start, 1e-6)
+        latency = self.window_latency / self.window_parts
+        if self.prev_rate is None or rate > self.prev_rate * 1.1:
+            self.level = min(self.level + 1, self.maximum)
+        elif rate < self.prev_rate * 0.9 or latency > self.prev_latency * 1.5:
+            self.level = max(self.level - 1, 1)
+        self.prev_rate, self.prev_latency = rate, latency
+        self._reset_window()
+
+# Limits the number of chunked-upload parts in flight across all uploads running at once
+upload_parts_semaphore = threading.BoundedSemaphore(chunked_upload_max_parts)
+
+# Uploads `size` bytes from `stream` through a chunked upload session, which is created by
+# calling create_session(size). Returns the uploaded File.
+#
+# Parts are read from the stream, hashed, and handed to worker threads to send, with the number
+# sent at once chosen by AdaptiveConcurrency (between 1 and chunked_upload_max_threads) and
+# bounded overall by upload_parts_semaphore. One part beyond those being sent is read and
+# hashed ahead, so that hashing overlaps the network sends rather than alternating with them,
+# and the whole-file SHA-1 needed for the commit is computed as the data passes through.
+
+def upload_session_from_stream(create_session, stream, size):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    session = create_session(size)
+    sha1 = hashlib.sha1()
+    num_parts = -(-size // session.part_size)
+    concurrency = AdaptiveConcurrency(chunked_upload_initial_threads, min(chunked_upload_max_threads, num_parts))
+    ####
+    def _parts():
+        for offset in range(0, size, session.part_size):
+            data = read_exactly(stream, min(session.part_size, size - offset))
+            if len(data) < min(session.part_size, size - offset):
+                raise ValueError(f"stream ended after {offset + len(data)} of {size} bytes")
+            sha1.update(data)
+            yield offset, data, hashlib.sha1(data).digest()
+        if stream.read(1):
+            raise ValueError(f"stream is longer than {size} bytes")
+    ####
+    # Parts are sent as bytes, since boxsdk can't rewind a stream for a retry unless it's part of
+    # a multipart upload, so a bandwidth limit is applied to each part as a whole before it's sent.
+    bucket, stats = bwlimit_buckets.get()['up'], transfer_stats.get()
+    counter = metrics.transfer_bytes.labels('up') if metrics else None
+    def _upload_part(offset, data, part_sha1):
+        if bucket:
+            bucket.consume(len(data))
+        if stats:
+            stats.add_bytes(len(data))
+        if counter:
+            counter.inc(len(data))
+        with upload_parts_semaphore:
+            # Time spent waiting behind other requests for a scheduler slot isn't network latency,
+            # and mustn't make the upload back off
+            request_waits.set(waits := [])
+            start = time.monotonic()
+            part = session.upload_part_bytes(data, offset, size, part_content_sha1=part_sha1)
+            return part, len(data), time.monotonic() - start - sum(waits)
+    ####
+    executor = ThreadPoolExecutor(max_workers=concurrency.maximum)
+    try:
+        parts, pending = [], set()
+        part_iter = _parts()
+        next_part = next(part_iter, None)
+        while next_part or pending:
+            while next_part and len(pending) < concurrency.level:
+                pending.add(executor.submit(contextvars.copy_context().run, _upload_part, *next_part))
+                next_part = next(part_iter, None)   # Read and hash ahead while the parts are sent
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                part, nbytes, latency = future.result()
+                parts.append(part)
+                concurrency.record(nbytes, latency)
+        parts.sort(key=lambda part: part['offset'])
+        for attempt in range(5):
+            # commit() returns None while Box is still processing the parts
+            if (file := session.commit(sha1.digest(), parts)) is not None:
+                return file
+            time.sleep(attempt + 1)
+        raise ValueError("upload session commit was not processed")
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        session.abort()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+# Uploads the local file at `filepath` through a chunked upload session created by
+# create_session(size), as for upload_session_from_stream().
+
+def chunked_upload_file(create_session, filepath):
+    with open(filepath, 'rb') as f:
+        return upload_session_from_stream(create_session, f, os.path.getsize(filepath))
+
+# Uploads the contents of the binary `stream`, whose length need not be known, either as a new
+# file `name` in `folder`, or as a new version of `file`. If `size` is given, the data is sent
+# in parts through a chunked upload session as it arrives; otherwise, a stream of up to
+# chunked_upload_size_threshold bytes is buffered in memory and uploaded directly, and a longer
+# one is spooled to a temporary file, since Box needs to know the size of a chunked upload
+# before it can begin.
+#
+# Returns the uploaded File.
+
+def upload_stream(stream, name=None, folder=None, file=None, size=None):
+    import tempfile
+    if folder:
+        create_session = lambda _size: folder.create_upload_session(_size, name)
+    else:
+        create_session = lambda _size: file.create_upload_session(_size)
+    if size is not None and size > chunked_upload_size_threshold:
+        return upload_session_from_stream(create_session, stream, size)
+    data = read_exactly(stream, chunked_upload_size_threshold + 1)
+    if len(data) <= chunked_upload_size_threshold:
+        if size is not None and len(data) != size:
+            raise ValueError(f"stream length {len(data)} does not match the given size {size}")
+        if folder:
+            return folder.upload_stream(transfer_stream(io.BytesIO(data), 'up'), name)
+        else:
+            return file.update_contents_with_stream(transfer_stream(io.BytesIO(data), 'up'))
+    with tempfile.TemporaryFile() as tmp:
+        tmp.write(data)
+        del data
+        shutil.copyfileobj(stream, tmp)
+        size = tmp.tell()
+        tmp.seek(0)
+        return upload_session_from_stream(create_session, tmp, size)
+
 # expand_item_ids() {{{2
 
 # Used in commands that accept multiple Box item IDs. Expands a list of IDs as
@@ -798,7 +2047,8 @@ def expand_item_ids(ids):
     item_ids = []
     for id in ids:
         if id == '@@':
-            item_ids.extend(v[1] for v in item_stash.values())
+            with state_lock:
+                item_ids.extend(v[1] for v in item_stash.values())
         elif match := NUMERIC_RANGE_REGEX.fullmatch(id):
             start, end = int(match[1]), int(match[2])
             for n in range(start, end + 1):
@@ -818,9 +2068,22 @@ def expand_item_ids(ids):
 # Prints a table of items currently in the stash.
 
 def print_item_stash():
-    items = tuple(v for v in item_stash.values())
+    with state_lock:
+        items = tuple(v for v in item_stash.values())
     print_table(items, ('Name', 'Id', 'Type'), is_sequence=True)
 
+# update_item_stash() {{{2
+
+# Adds `entries`, a dict of ID -> (name, ID, type), to the item stash, replacing its contents
+# unless `append` is true. Commands that stash what they find gather it first and call this
+# once, so that a background job never leaves the stash half-built.
+
+def update_item_stash(entries, append=False):
+    with state_lock:
+        if not append:
+            item_stash.clear()
+        item_stash.update(entries)
+
 # }}}1
 
 # Define command functions {{{1
@@ -834,7 +2097,9 @@ def auth_cmd(args):  # {{{2
     cli_parser.add_argument('-e', '--external-redirect', action='store_true',
                             help="Redirect to an external address to retrieve the auth code")
     options = cli_parser.parse_args(args)
-    from .auth import retrieve_tokens
+    from .auth import retrieve_tokens, set_api_base_url
+    if api_base_url:
+        set_api_base_url(api_base_url)
     redirect_url = redirect_urls['external' if options.external_redirect else 'internal']
     retrieve_tokens(client_id, client_secret, redirect_url, save_tokens,
                     run_server=not options.external_redirect, open_browser=not options.no_browser)
@@ -846,7 +2111,9 @@ def refresh_cmd(args):  # {{{2
                "Manually refresh access tokens")
         return
     access_token, refresh_token = load_tokens_or_die()
-    from .auth import refresh_tokens
+    from .auth import refresh_tokens, set_api_base_url
+    if api_base_url:
+        set_api_base_url(api_base_url)
     refresh_tokens(client_id, client_secret, access_token, refresh_token, save_tokens)
     print(f"Tokens refreshed and saved")
 
@@ -915,7 +2182,8 @@ def history_cmd(args):  # {{{2
         max_count = int(filter_word)
         filter_word = None
     #
-    history_view = item_history_map.values()
+    with state_lock:
+        history_view = list(item_history_map.values())
     if max_count:
         history_view = reversed(history_view)
     if filter_word:
@@ -986,16 +2254,18 @@ def ls_cmd(args):  # {{{2
     max_name_len = get_name_len(options.max_name_length)
     max_id_len = get_id_len(options.max_id_length)
     if options.clear_history:
-        ls_history_deque.clear()
+        with state_lock:
+            ls_history_deque.clear()
         print("ls history cleared")
         return
     if options.history:
         _printlist = []
-        numeric_item_list.clear()
-        for n, histitem in enumerate(ls_history_deque, start=1):
-            _name, _id, _parname, _parid = histitem
-            _printlist.append((str(n), _name, _id, _parname, _parid))
-            numeric_item_list.append(_id)
+        with state_lock:
+            for n, histitem in enumerate(ls_history_deque, start=1):
+                _name, _id, _parname, _parid = histitem
+                _printlist.append((str(n), _name, _id, _parname, _parid))
+            if not in_job():
+                numeric_item_list[:] = [entry[2] for entry in _printlist]
         print_table(_printlist, is_sequence=True,
                     fields=('n', 'name', 'id', 'parent', 'parent_id'),
                     clip_fields={'name': (max_name_len, 'r'), 'id': (max_id_len, 'l'),
@@ -1003,31 +2273,43 @@ def ls_cmd(args):  # {{{2
         return
     if len(folder_ids) == 0:
         if len(ls_history_deque) > 0:
-            global current_cmd_last_id
-            current_cmd_last_id = ls_history_deque[-1][1]
-            folder_ids = (current_cmd_last_id,)
+            folder_ids = (ls_history_deque[-1][1],)
+            current_cmd_last_id.set(folder_ids[0])
         else:
             print("No folder ID given and history is empty")
             return
     client = get_ops_client()
+    # Only whole listings in the default order are cached
+    use_cache = limit is None and offset == 0 and sort is None
     for i, folder_id in enumerate(folder_ids):
-        folder = client.folder(folder_id=folder_id).get()
-        items = retrieve_folder_items(client, folder, limit=limit, start_offset=offset,
-                                      fields=['type', 'name', 'id', 'parent', 'description'],
-                                      sort=sort, direction=direction, filter_func=filter_func)
+        if use_cache:
+            folder, items, _parent = cached_folder_listing(folder_id) or fetch_folder_listing(client, folder_id)
+            if filter_func:
+                items = list(filter(filter_func, items))
+        else:
+            folder = client.folder(folder_id=folder_id).get()
+            items = retrieve_folder_items(client, folder, limit=limit, start_offset=offset, fields=LISTING_FIELDS,
+                                          sort=sort, direction=direction, filter_func=filter_func)
+            if _parent := folder.parent:
+                _parent = _parent.get(fields=['id', 'name', 'type', 'parent'])
         add_history_item(folder)
-        if len(ls_history_deque) == 0 or ls_history_deque[-1][1] != folder.id:
-            if _p := folder.parent:
-                _parname, _parid = _p.name, _p.id
-            else:
-                _parname, _parid = None, None
-            if not options.skip_history:
-                ls_history_deque.append((folder.name, folder.id, _parname, _parid))
-        if _parent := folder.parent:
-            _parent = _parent.get(fields=['id', 'name', 'type', 'parent'])
+        with state_lock:
+            if len(ls_history_deque) == 0 or ls_history_deque[-1][1] != folder.id:
+                if _p := folder.parent:
+                    _parname, _parid = _p.name, _p.id
+                else:
+                    _parname, _parid = None, None
+                if not options.skip_history:
+                    ls_history_deque.append((folder.name, folder.id, _parname, _parid))
+        if _parent:
             add_history_item(_parent)
         for item in items:
             add_history_item(item, parent=folder)
+        if not in_job():
+            with state_lock:
+                prefetch_candidates[:] = [(item.id, folder) for item in items if item.type == 'folder']
+                if _parent:
+                    prefetch_candidates.append((_parent.id, None))
         if print_header:
             print_name_header(f"{folder.name} [{folder.id}]", leading_blank=i != 0,
                               context_info=f'(Parent: {_parent.name} [{_parent.id}])' if _parent else
@@ -1038,12 +2320,11 @@ def ls_cmd(args):  # {{{2
                 print('~' * (screen_cols//2))
         elif i != 0:
             print()
-        if not options.skip_history:
-            numeric_item_list.clear()
         for n, item in enumerate(items, start=1):
             item.n = str(n) + '.'
-            if not options.skip_history:
-                numeric_item_list.append(item.id)
+        if not options.skip_history and not in_job():
+            with state_lock:
+                numeric_item_list[:] = [item.id for item in items]
         # We use the field_val_func to indicate if an item has a description, similar to the web interface
         print_table(items, ('n', 'type', 'name', 'id'), print_header=print_header, no_leader_fields=('type',),
                     clip_fields={'name': (max_name_len, 'r'), 'id': (max_id_len, 'l')},
@@ -1074,6 +2355,12 @@ def search_cmd(args):  # {{{2
                             help='Clip the names of items in the displayed table to N characters')
     cli_parser.add_argument('-M', '--max-id-length', metavar='N', type=int,
                             help='Clip the item IDs in the displayed table to N characters')
+    cli_parser.add_argument('-L', '--local', action='store_true',
+                            help="Search item names in the local snapshot (see the 'snapshot' command) "
+                                 "rather than using the Box search API")
+    cli_parser.add_argument('-r', '--regex', action='store_true',
+                            help="With --local, TERM is a regular expression to search for in item names "
+                                 "(rather than a case-insensitive substring)")
     options = cli_parser.parse_args(args)
     term = options.term
     do_files, do_folders = options.files, options.folders
@@ -1096,15 +2383,28 @@ def search_cmd(args):  # {{{2
     fields=['name', 'id', 'type', 'parent']
     max_name_len = get_name_len(options.max_name_length)
     max_id_len = get_id_len(options.max_id_length)
-    client = get_ops_client()
-    ancestors = [client.folder(id) for id in ancestor_ids] if ancestor_ids else None
-    results = client.search().query(query=term, limit=limit, offset=offset,
-                                    ancestor_folders=ancestors, file_extensions=extensions,
-                                    result_type=result_type, content_types=content_types, fields=fields)
+    if options.regex and not options.local:
+        print("--regex can only be used with --local")
+        return
+    if options.local:
+        if not os.path.exists(snapshot_db_file):
+            print("No snapshot has been taken: use the 'snapshot' command first")
+            return
+        try:
+            results = search_snapshot(term, options.regex, result_type, extensions, ancestor_ids, limit, offset)
+        except re.error as ex:
+            print(f"Invalid pattern: {ex}")
+            return
+    else:
+        client = get_ops_client()
+        ancestors = [client.folder(id) for id in ancestor_ids] if ancestor_ids else None
+        results = client.search().query(query=term, limit=limit, offset=offset,
+                                        ancestor_folders=ancestors, file_extensions=extensions,
+                                        result_type=result_type, content_types=content_types, fields=fields)
     # We can't just throw the iterator returned by query() into a list(), because it stalls,
     # so we need to manually retrieve 'limit' items
     items = []
-    numeric_item_list.clear()
+    result_ids = []
     for i, result_item in enumerate(results, start=1):
         item = { 'n'    : str(i) + '.',
                  'type' : result_item.type,
@@ -1117,8 +2417,11 @@ def search_cmd(args):  # {{{2
         else:
             item['parent'] = item['parent_id'] = None
         items.append(item)
-        numeric_item_list.append(result_item.id)
+        result_ids.append(result_item.id)
         if i == limit: break
+    if not in_job():
+        with state_lock:
+            numeric_item_list[:] = result_ids
     fields = ['name', 'id']
     if result_type is None:
         fields.insert(0, 'type')
@@ -1173,8 +2476,7 @@ def tree_cmd(args):  # {{{2
     stash_folders = options.stash_folders
     stash_initial_folder = options.stash_initial_folder
     append_stash = options.append_stash
-    if (stash_files or stash_folders) and not append_stash:
-        item_stash.clear()
+    stash_entries = {}
     indent_str = " " * 2
     client = get_ops_client()
     tree_entries = []
@@ -1197,9 +2499,9 @@ def tree_cmd(args):  # {{{2
                 # We could have arrived here because --force-recurse was used, but we only want to add the folder
                 # to the stash if it actually passes any filters that may be active.
                 if not force_recurse or _item_passes_filters(folder):
-                    item_stash[folder.id] = (folder.name, folder.id, 'folder')
+                    stash_entries[folder.id] = (folder.name, folder.id, 'folder')
             elif stash_initial_folder:
-                item_stash[folder.id] = (folder.name, folder.id, 'folder')
+                stash_entries[folder.id] = (folder.name, folder.id, 'folder')
         if level < max_levels:
             if sys.stdout.isatty():  # Display a progress report
                 sys.stdout.write('\033[2K\033[1G') # erase and go to beginning of line
@@ -1229,7 +2531,7 @@ def tree_cmd(args):  # {{{2
                     add_history_item(item)
                     tree_entries.append((file_entry_prefix + item.name, item.id))
                     if stash_files and item.type == 'file':
-                        item_stash[item.id] = (item.name, item.id, 'file')
+                        stash_entries[item.id] = (item.name, item.id, 'file')
             level -= 1
         if level == 0 and sys.stdout.isatty():
             sys.stdout.write('\033[2K\033[1G')  # Erase the progress report text
@@ -1247,10 +2549,547 @@ def tree_cmd(args):  # {{{2
         sys.stdout.write('\033[2K\033[1G')
         print("Cancelled")
         # But we'll print out what we have anyway, so the user knows why it was taking a long time
+    if stash_files or stash_folders:
+        update_item_stash(stash_entries, append_stash)
     print_table(tree_entries, ('name_part', 'id_part'), print_header=False, is_sequence=True)
 
 _tree_item_markers = ['*', '-']
 
+def du_cmd(args):  # {{{2
+    cli_parser = argparse.ArgumentParser(exit_on_error=False,
+                                         prog=progname, usage='%(prog)s du [options] folder_ids...',
+                                         description='Summarize the space used by folders and their sub-folders')
+    cli_parser.add_argument('folder_ids', nargs='+', help='Folder IDs')
+    cli_parser.add_argument('-L', '--max-depth', type=int, default=1, metavar='N',
+                            help='Show sub-folders at most N levels below each folder (default %(default)s)')
+    cli_parser.add_argument('-s', '--sort-size', action='store_true',
+                            help='Sort folders by size, largest first, rather than by path')
+    cli_parser.add_argument('-b', '--bytes', action='store_true', help='Print sizes in bytes')
+    cli_parser.add_argument('-r', '--refresh', action='store_true',
+                            help='List every folder again, rather than reusing cached results for '
+                                 'folders whose size has not changed')
+    options = cli_parser.parse_args(args)
+    if options.max_depth < 0:
+        print('--max-depth must be >= 0')
+        return
+    folder_ids = expand_item_ids(options.folder_ids)
+    if not folder_ids:
+        return
+    client = get_ops_client()
+    for i, folder_id in enumerate(folder_ids):
+        folder = client.folder(folder_id).get(fields=['id', 'name', 'type', 'size', 'parent'])
+        add_history_item(folder)
+        rows = du_folder_tree(client, folder, options.max_depth, options.refresh)
+        if options.sort_size:
+            rows.sort(key=lambda row: row[0], reverse=True)
+        rows = [(str(size) if options.bytes else format_size(size), '/'.join(path), id)
+                for size, path, id in rows]
+        if i != 0: print()
+        print_table(rows, ('size', 'path', 'id'), no_leader_fields=('size',), is_sequence=True)
+
+# Gathers the sizes of `folder` and its sub-folders down to `max_depth` levels below it, for
+# du_cmd(). Returns a list of (size, path, folder_id) tuples, where `path` is a tuple of folder
+# names starting with folder.name, in depth-first order.
+#
+# Box aggregates a folder's `size` over all its contents, so a folder's listing gives the totals
+# for each of its sub-folders and we need only list the folders above the deepest level shown.
+# Those are listed a level at a time, concurrently. A folder's listing is cached in
+# metadata_cache['folders'], and while its size is unchanged (and `refresh` is False) its cached
+# sub-folder sizes are reused instead of listing it again. A move or rename entirely inside a
+# folder leaves its size unchanged, so use `refresh` after reorganizing a tree.
+
+def du_folder_tree(client, folder, max_depth, refresh=False):
+    global metadata_cache_modified
+    folder_cache = metadata_cache['folders']
+    ####
+    def _list_folder(folder_id):
+        try:
+            items = retrieve_all_folder_items(client, folder_id, fields=['type', 'name', 'id', 'size'])
+        except BoxAPIException as ex:
+            return ex
+        subfolders = [(it.id, it.name, it.size) for it in items if it.type == 'folder']
+        files = [it for it in items if it.type != 'folder']
+        return {'folders': subfolders, 'files_size': sum(getattr(it, 'size', 0) or 0 for it in files),
+                'file_count': len(files)}
+    ####
+    subfolders = {}   # folder_id -> list of (id, name, size)
+    level = [(folder.id, folder.name, folder.size)]
+    for depth in range(max_depth):
+        to_list = []
+        for folder_id, name, size in level:
+            with state_lock:
+                entry = folder_cache.get(folder_id)
+                if not refresh and entry and entry['size'] == size:
+                    folder_cache.move_to_end(folder_id)
+                    subfolders[folder_id] = entry['folders']
+                else:
+                    to_list.append((folder_id, name, size))
+        for (folder_id, name, size), result in bounded_map(lambda f: _list_folder(f[0]), to_list, api_num_threads):
+            if isinstance(result, BoxAPIException):
+                print(f'** Unable to list "{name}": {result.message} **', file=sys.stderr)
+                continue
+            with state_lock:
+                folder_cache[folder_id] = dict(result, name=name, size=size)
+                folder_cache.move_to_end(folder_id)
+                metadata_cache_modified = True
+            subfolders[folder_id] = result['folders']
+        level = [child for folder_id, _, _ in level for child in subfolders.get(folder_id, ())]
+    with state_lock:
+        while len(folder_cache) > metadata_cache_size:
+            folder_cache.popitem(last=False)
+    ####
+    rows = []
+    def _collect(folder_id, name, size, path):
+        path = path + (name,)
+        rows.append((size, path, folder_id))
+        for child in sorted(subfolders.get(folder_id, ()), key=lambda c: c[1]):
+            _collect(*child, path)
+    _collect(folder.id, folder.name, folder.size, ())
+    return rows
+
+def snapshot_cmd(args):  # {{{2
+    cli_parser = argparse.ArgumentParser(exit_on_error=False,
+                                         prog=progname, usage='%(prog)s snapshot [options]',
+                                         description='Build or refresh a local index of all items in the account')
+    group = cli_parser.add_mutually_exclusive_group()
+    group.add_argument('-F', '--full', action='store_true',
+                       help='Crawl the whole account again, rather than refreshing only the folders '
+                            'that have changed since the last snapshot')
+    group.add_argument('-i', '--info', action='store_true', help='Print information about the current snapshot')
+    options = cli_parser.parse_args(args)
+    have_snapshot = os.path.exists(snapshot_db_file)
+    if options.info:
+        if not have_snapshot:
+            print("No snapshot has been taken")
+            return
+        db = open_snapshot_db()
+        try:
+            counts = dict(db.execute("SELECT type, COUNT(*) FROM items GROUP BY type").fetchall())
+            meta = dict(db.execute("SELECT key, value FROM meta").fetchall())
+        finally:
+            db.close()
+        print_table([('Files:', str(counts.get('file', 0))),
+                     ('Folders:', str(counts.get('folder', 0))),
+                     ('Web links:', str(counts.get('web_link', 0))),
+                     ('Crawled:', meta.get('crawled_at', 'N/A')),
+                     ('Refreshed:', meta.get('refreshed_at', 'N/A'))],
+                    ('field', 'value'), print_header=False, is_sequence=True, no_leader_fields=('field',))
+        return
+    client = get_ops_client()
+    try:
+        if have_snapshot and not options.full:
+            if snapshot_refresh(client):
+                return
+            print("The snapshot is too old to refresh from the event stream; taking a full snapshot")
+        snapshot_crawl(client)
+    except KeyboardInterrupt:
+        print("Cancelled")
+
+# Snapshot support {{{2
+
+# The snapshot is an SQLite database of every item in the account, with these tables:
+#
+#   items : one row per item (id, type, name, parent_id, size, sha1, modified_at)
+#   meta  : key/value pairs, including the events 'stream_position' that the snapshot is current to
+#
+# It is built by snapshot_crawl() and kept up to date by snapshot_refresh(), which re-lists only
+# the folders touched by events since the last snapshot.
+
+SNAPSHOT_FIELDS = ['type', 'name', 'id', 'size', 'sha1', 'modified_at']
+
+def open_snapshot_db(path=snapshot_db_file):
+    import sqlite3
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, type TEXT, name TEXT, parent_id TEXT,
+                                          size INTEGER, sha1 TEXT, modified_at TEXT);
+        CREATE INDEX IF NOT EXISTS items_parent_id ON items (parent_id);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """)
+    return db
+
+def _snapshot_rows(parent_id, items):
+    return [(item.id, item.type, item.name, parent_id, getattr(item, 'size', None),
+             getattr(item, 'sha1', None), getattr(item, 'modified_at', None)) for item in items]
+
+# Inserts the rows for everything beneath `folder` into `db`, listing folders concurrently.
+# Returns the number of items added.
+def _snapshot_add_tree(client, db, folder):
+    count = 0
+    for _folder, path, items in walk_folder_tree(client, folder, fields=SNAPSHOT_FIELDS):
+        db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       _snapshot_rows(_folder.id, items))
+        count += len(items)
+        if sys.stdout.isatty() and count % 1000 < len(items):
+            sys.stdout.write('\033[2K\033[1G')
+            print(f"{count} items...", end="", flush=True)
+    if sys.stdout.isatty():
+        sys.stdout.write('\033[2K\033[1G')
+    return count
+
+# Builds a new snapshot of the whole account. The snapshot is written to a temporary database
+# that replaces the current one only once the crawl is complete.
+def snapshot_crawl(client):
+    stream_position = client.events().get_latest_stream_position()
+    tmp_file = snapshot_db_file + ".tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    db = open_snapshot_db(tmp_file)
+    try:
+        root = client.folder('0').get(fields=['id', 'name', 'type'])
+        db.execute("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?)", (root.id, 'folder', root.name, None, None, None, None))
+        count = _snapshot_add_tree(client, db, root)
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                       [('stream_position', str(stream_position)), ('crawled_at', now), ('refreshed_at', now)])
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp_file, snapshot_db_file)
+    print(f"Snapshot complete: {count} items")
+
+# Brings the snapshot up to date using the events that have occurred since it was taken. Each
+# folder containing a changed item is listed again (concurrently), items that have left a folder
+# are removed along with their subtrees, and new sub-folders are crawled.
+#
+# Returns False if the events needed to refresh the snapshot are no longer available.
+def snapshot_refresh(client):
+    db = open_snapshot_db()
+    try:
+        stream_position = db.execute("SELECT value FROM meta WHERE key = 'stream_position'").fetchone()
+        if stream_position is None:
+            return False
+        stream_position = stream_position[0]
+        changed_folders = set()
+        num_events = 0
+        events = client.events()
+        try:
+            while True:
+                result = events.get_events(limit=500, stream_position=stream_position)
+                for event in result['entries']:
+                    source = event.get('source')
+                    if not source or getattr(source, 'type', None) not in ('file', 'folder', 'web_link'):
+                        continue
+                    num_events += 1
+                    if source.type == 'folder':
+                        changed_folders.add(source.id)
+                    if parent := getattr(source, 'parent', None):
+                        changed_folders.add(parent.id)
+                    # If the item was moved or trashed, its old parent has changed too
+                    if row := db.execute("SELECT parent_id FROM items WHERE id = ?", (source.id,)).fetchone():
+                        if row[0]:
+                            changed_folders.add(row[0])
+                stream_position = result['next_stream_position']
+                if result['chunk_size'] == 0:
+                    break
+        except BoxAPIException as ex:
+            if ex.status in (400, 404):
+                return False
+            raise ex
+        # Only folders already in the snapshot need to be re-listed: new folders are reached
+        # through their (changed) parents.
+        changed_folders = [id for id in changed_folders
+                           if db.execute("SELECT 1 FROM items WHERE id = ? AND type = 'folder'", (id,)).fetchone()]
+        ####
+        def _list_folder(folder_id):
+            try:
+                return retrieve_all_folder_items(client, folder_id, fields=SNAPSHOT_FIELDS)
+            except BoxAPIException as ex:
+                return ex
+        ####
+        num_added = 0
+        new_folders = []
+        for folder_id, result in bounded_map(_list_folder, changed_folders, api_num_threads):
+            if isinstance(result, BoxAPIException):
+                if result.status != 404:
+                    raise result
+                result = []   # The folder is gone; its own row goes when its parent is re-listed
+            old_ids = {row[0] for row in db.execute("SELECT id FROM items WHERE parent_id = ?", (folder_id,))}
+            new_ids = {item.id for item in result}
+            for item in result:
+                if item.type == 'folder' and \
+                        not db.execute("SELECT 1 FROM items WHERE id = ?", (item.id,)).fetchone():
+                    new_folders.append(item)
+            db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           _snapshot_rows(folder_id, result))
+            num_added += len(new_ids - old_ids)
+            _snapshot_remove_items(db, old_ids - new_ids, folder_id)
+        for folder in new_folders:
+            num_added += _snapshot_add_tree(client, db, folder)
+        db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                       [('stream_position', str(stream_position)),
+                        ('refreshed_at', time.strftime('%Y-%m-%d %H:%M:%S'))])
+        db.commit()
+        print(f"Snapshot refreshed: {num_events} events, {len(changed_folders)} folders re-listed, "
+              f"{num_added} items added")
+        return True
+    finally:
+        db.close()
+
+# Searches the names of items in the snapshot for `term`, which is either a case-insensitive
+# substring or, if `regex` is True, a regular expression. The other arguments are as for Box
+# search queries. Returns a list of namespaces with the attributes type, name, id, and parent,
+# like the items returned by the Box search API.
+
+def search_snapshot(term, regex, result_type, extensions, ancestor_ids, limit, offset):
+    from types import SimpleNamespace
+    clauses, params = [], []
+    if regex:
+        pattern = re.compile(term)
+        clauses.append("regexp(items.name)")
+    else:
+        clauses.append("instr(lower(items.name), ?) > 0")
+        params.append(term.lower())
+    if result_type:
+        clauses.append("items.type = ?")
+        params.append(result_type)
+    if extensions:
+        clauses.append("(" + " OR ".join("lower(items.name) LIKE ? ESCAPE '\\'" for ext in extensions) + ")")
+        params.extend('%.' + ext.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                      for ext in extensions)
+    scope = ""
+    if ancestor_ids:
+        scope = f"""WITH RECURSIVE scope(id) AS (
+                        SELECT id FROM items WHERE id IN ({",".join("?" * len(ancestor_ids))})
+                        UNION ALL
+                        SELECT items.id FROM items JOIN scope ON items.parent_id = scope.id
+                        WHERE items.type = 'folder'
+                    ) """
+        params[:0] = ancestor_ids
+        clauses.append("items.parent_id IN scope")
+    query = f"""{scope}SELECT items.type, items.name, items.id, parents.id, parents.name
+                FROM items LEFT JOIN items AS parents ON items.parent_id = parents.id
+                WHERE {" AND ".join(clauses)} ORDER BY items.name LIMIT ? OFFSET ?"""
+    params.extend((limit, offset))
+    db = open_snapshot_db()
+    try:
+        if regex:
+            db.create_function("regexp", 1, lambda name: pattern.search(name) is not None, deterministic=True)
+        rows = db.execute(query, params).fetchall()
+    finally:
+        db.close()
+    return [SimpleNamespace(type=_type, name=name, id=id,
+                            parent=SimpleNamespace(type='folder', id=parent_id, name=parent_name) if parent_id else None)
+            for _type, name, id, parent_id, parent_name in rows]
+
+# Removes the items with `item_ids`, if they're still children of `parent_id` (an item that was
+# moved may already have been re-parented by its new folder's listing), and their subtrees.
+def _snapshot_remove_items(db, item_ids, parent_id):
+    for item_id in item_ids:
+        db.execute("""
+            WITH RECURSIVE subtree(id) AS (
+                SELECT id FROM items WHERE id = ? AND parent_id = ?
+                UNION ALL
+                SELECT items.id FROM items JOIN subtree ON items.parent_id = subtree.id
+            )
+            DELETE FROM items WHERE id IN subtree""", (item_id, parent_id))
+
+def dupes_cmd(args):  # {{{2
+    cli_parser = argparse.ArgumentParser(exit_on_error=False,
+                                         prog=progname, usage='%(prog)s dupes [options] folder_id',
+                                         description='Find files with identical contents')
+    cli_parser.add_argument('folder_id', help='Folder ID (searched recursively)')
+    cli_parser.add_argument('-L', '--local', action='store_true',
+                            help="Use the local snapshot (see the 'snapshot' command) rather than "
+                                 "traversing the folder tree")
+    cli_parser.add_argument('-m', '--min-size', metavar='BYTES', type=int, default=1,
+                            help='Ignore files smaller than BYTES (default %(default)s)')
+    cli_parser.add_argument('-l', '--limit', metavar='N', type=int,
+                            help='Show only the N groups with the most reclaimable space')
+    cli_parser.add_argument('-q', '--quiet', action='store_true',
+                            help='Only print the summary, not each group of duplicates')
+    cli_parser.add_argument('-s', '--stash', action='store_true',
+                            help='Add the redundant copies (all but the oldest in each group) to the item stash')
+    cli_parser.add_argument('-a', '--append-stash', action='store_true',
+                            help='Append items to the current stash, rather than replacing it')
+    options = cli_parser.parse_args(args)
+    folder_id = translate_id(options.folder_id)
+    if not folder_id:
+        return
+    if options.local and not os.path.exists(snapshot_db_file):
+        print("No snapshot has been taken: use the 'snapshot' command first")
+        return
+    # The files are gathered into an SQLite table (a temporary on-disk database, or the snapshot)
+    # so that grouping millions of files doesn't need to hold them all in memory.
+    try:
+        db = open_snapshot_db() if options.local else dupes_collect_files(folder_id)
+    except KeyboardInterrupt:
+        print("Cancelled")
+        return
+    try:
+        if options.local:
+            db.execute("""
+                CREATE TEMP TABLE files AS
+                WITH RECURSIVE scope(id, path) AS (
+                    SELECT id, name FROM items WHERE id = ? AND type = 'folder'
+                    UNION ALL
+                    SELECT items.id, scope.path || '/' || items.name
+                    FROM items JOIN scope ON items.parent_id = scope.id WHERE items.type = 'folder'
+                )
+                SELECT items.id, items.sha1, items.size, items.modified_at,
+                       scope.path || '/' || items.name AS path
+                FROM items JOIN scope ON items.parent_id = scope.id WHERE items.type = 'file'""",
+                (folder_id,))
+        db.execute("CREATE INDEX files_sha1_size ON files (sha1, size)")
+        groups = db.execute("""
+            SELECT sha1, size, COUNT(*) AS n FROM files
+            WHERE size >= ? AND sha1 IS NOT NULL
+            GROUP BY sha1, size HAVING n > 1 ORDER BY size * (n - 1) DESC, sha1""",
+            (options.min_size,)).fetchall()
+        stash_entries = {}
+        total_groups, total_redundant, total_reclaimable = len(groups), 0, 0
+        for i, (sha1, size, n) in enumerate(groups):
+            total_redundant += n - 1
+            total_reclaimable += size * (n - 1)
+            if options.limit is not None and i >= options.limit:
+                continue
+            copies = db.execute("SELECT id, path FROM files WHERE sha1 = ? AND size = ? "
+                                "ORDER BY modified_at, path", (sha1, size)).fetchall()
+            if options.stash:
+                for id, path in copies[1:]:
+                    stash_entries[id] = (path.rsplit('/', 1)[-1], id, 'file')
+            if not options.quiet:
+                print(f"{sha1}  {n} x {format_size(size)} ({format_size(size * (n - 1))} reclaimable)")
+                print_table(copies, ('id', 'path'), print_header=False, is_sequence=True)
+                print()
+        if options.stash:
+            update_item_stash(stash_entries, options.append_stash)
+        print(f"{total_groups} groups of duplicates, {total_redundant} redundant copies, "
+              f"{format_size(total_reclaimable)} reclaimable")
+    finally:
+        db.close()
+
+# Collects the id, sha1, size, modified_at, and path of every file beneath `folder_id` into the
+# `files` table of a temporary on-disk SQLite database, which is returned.
+def dupes_collect_files(folder_id):
+    import sqlite3
+    client = get_ops_client()
+    folder = client.folder(folder_id).get(fields=['id', 'name', 'type'])
+    add_history_item(folder)
+    db = sqlite3.connect("")   # An empty name gives a private, temporary on-disk database
+    db.execute("CREATE TABLE files (id TEXT, sha1 TEXT, size INTEGER, modified_at TEXT, path TEXT)")
+    for _folder, path, items in walk_folder_tree(client, folder,
+                                                 fields=['type', 'name', 'id', 'size', 'sha1', 'modified_at']):
+        dirpath = '/'.join((folder.name,) + path)
+        db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                       [(item.id, item.sha1, item.size, item.modified_at, dirpath + '/' + item.name)
+                        for item in items if item.type == 'file'])
+    return db
+
+def diff_cmd(args):  # {{{2
+    cli_parser = argparse.ArgumentParser(exit_on_error=False,
+                    prog=progname, usage='%(prog)s diff [options] local_dir folder_id',
+                    description='Compare the files in a local directory and a Box folder',
+                    epilog='Entries are reported as A (only in the Box folder), D (only in the local '
+                           'directory), M (in both, with different contents), or R (moved: a local file '
+                           'whose contents are found only at a different path in the Box folder).')
+    cli_parser.add_argument('local_dir', help='Local directory')
+    cli_parser.add_argument('folder_id', help='Box folder ID')
+    cli_parser.add_argument('-j', '--json', action='store_true',
+                            help='Print each entry as a line of JSON, and no summary')
+    cli_parser.add_argument('-N', '--no-moves', action='store_true',
+                            help='Report moved files as separate D and A entries, which avoids '
+                                 'hashing local files that have no counterpart in the Box folder')
+    options = cli_parser.parse_args(args)
+    local_dir = expand_all(options.local_dir)
+    if not os.path.isdir(local_dir):
+        print(f"{local_dir} is not a directory!")
+        return
+    folder_id = translate_id(options.folder_id)
+    if not folder_id:
+        return
+    client = get_ops_client()
+    folder = client.folder(folder_id).get(fields=['id', 'name', 'type'])
+    add_history_item(folder)
+    ####
+    def _remote_manifest():
+        manifest = {}
+        for _folder, path, items in walk_folder_tree(client, folder, fields=['type', 'name', 'id', 'size', 'sha1']):
+            for item in items:
+                if item.type == 'file':
+                    manifest['/'.join(path + (item.name,))] = item
+        return manifest
+    ####
+    # The remote folders are listed while the local tree is scanned
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        remote_future = executor.submit(contextvars.copy_context().run, _remote_manifest)
+        local_manifest = {}   # relative path -> (local path, size)
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            reldir = os.path.relpath(dirpath, local_dir)
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                if os.path.isfile(filepath):
+                    relpath = filename if reldir == '.' else os.path.join(reldir, filename).replace(os.sep, '/')
+                    local_manifest[relpath] = (filepath, os.path.getsize(filepath))
+        remote_manifest = remote_future.result()
+    ####
+    # Only hash the local files whose hashes could matter: those the same size as the remote file
+    # at the same path, and (for move detection) local-only files the same size as some
+    # remote-only file.
+    remote_only_sizes = {item.size for relpath, item in remote_manifest.items() if relpath not in local_manifest}
+    to_hash = []
+    for relpath, (filepath, size) in local_manifest.items():
+        item = remote_manifest.get(relpath)
+        if item is not None and item.size == size:
+            to_hash.append(relpath)
+        elif item is None and not options.no_moves and size in remote_only_sizes:
+            to_hash.append(relpath)
+    # Runs on a worker thread, so it reports errors by returning them rather than printing.
+    def _hash_task(relpath):
+        try:
+            return local_sha1(local_manifest[relpath][0])
+        except OSError as ex:
+            return ex
+    ####
+    # Files that can't be read are reported and left out of the comparison on both sides
+    local_hashes = {}
+    for relpath, result in bounded_map(_hash_task, to_hash, local_hash_num_threads):
+        if isinstance(result, OSError):
+            print(f"** Unable to read {local_manifest[relpath][0]}: {result.strerror} **", file=sys.stderr)
+            del local_manifest[relpath]
+            remote_manifest.pop(relpath, None)
+        else:
+            local_hashes[relpath] = result
+    ####
+    entries = []   # (status, path, item, old_path)
+    remote_only_by_sha1 = {}
+    for relpath, item in remote_manifest.items():
+        if relpath not in local_manifest:
+            remote_only_by_sha1.setdefault((item.sha1, item.size), []).append(relpath)
+    moved_remote = set()
+    for relpath, (filepath, size) in local_manifest.items():
+        item = remote_manifest.get(relpath)
+        if item is not None:
+            if item.size != size or local_hashes[relpath] != item.sha1:
+                entries.append(('M', relpath, item, None))
+        elif (candidates := remote_only_by_sha1.get((local_hashes.get(relpath), size))):
+            new_path = candidates.pop()
+            moved_remote.add(new_path)
+            entries.append(('R', new_path, remote_manifest[new_path], relpath))
+        else:
+            entries.append(('D', relpath, None, None))
+    for relpath, item in remote_manifest.items():
+        if relpath not in local_manifest and relpath not in moved_remote:
+            entries.append(('A', relpath, item, None))
+    entries.sort(key=lambda e: e[1])
+    ####
+    status_names = {'A': 'added', 'D': 'removed', 'M': 'modified', 'R': 'moved'}
+    for status, path, item, old_path in entries:
+        if options.json:
+            entry = {'status': status_names[status], 'path': path}
+            if old_path: entry['old_path'] = old_path
+            if item: entry.update(id=item.id, size=item.size, sha1=item.sha1)
+            print(json.dumps(entry))
+        elif status == 'R':
+            print(f"R  {old_path} -> {path}")
+        else:
+            print(f"{status}  {path}")
+    if not options.json:
+        counts = {status: sum(1 for e in entries if e[0] == status) for status in status_names}
+        print(f"{len(entries)} differences: {counts['A']} added, {counts['D']} removed, "
+              f"{counts['M']} modified, {counts['R']} moved")
+
 def unspace_cmd(args):  # {{{2
     cli_parser = argparse.ArgumentParser(exit_on_error=False,
                     prog=progname, usage='%(prog)s unspace ids',
@@ -1290,17 +3129,18 @@ def stash_cmd(args):  # {{{2
         client = get_ops_client()
         for item_id in ids:
             _type, item = get_api_item(client, item_id)
-            item_stash[item.id] = (item.name, item.id, item.type)
+            update_item_stash({item.id: (item.name, item.id, item.type)}, append=True)
             print("Added:", item.name)
     elif options.remove:
         ids = expand_item_ids(options.remove)
         if not ids: return
         for item_id in ids:
-            entry = item_stash.pop(item_id, None)
+            with state_lock:
+                entry = item_stash.pop(item_id, None)
             if entry is not None:
                 print("Removed:", entry[0])
     elif options.clear:
-        item_stash.clear()
+        update_item_stash({})
         print("Stash cleared")
 
 def get_cmd(args):  # {{{2
@@ -1312,6 +3152,9 @@ def get_cmd(args):  # {{{2
                                               'This is useful to pipe the output to pv to see progress.)')
     cli_parser.add_argument('-d', '--folders', action='store_true',
                             help="Item IDs specify folders from which to download files")
+    cli_parser.add_argument('-R', '--recursive', action='store_true',
+                            help="With -d/--folders, also download the files in all sub-folders, "
+                                 "recreating the folder structure under the destination directory")
     cli_parser.add_argument('-i', '--re-include', metavar='RE',
                             help="Applies when -d/--folders is used: rather than downloading all files "
                                  "from the specified folders, only download those files whose names "
@@ -1323,17 +3166,35 @@ def get_cmd(args):  # {{{2
                                  "by REPR. (Use the 'repr' command to find possible values of REPR)")
     cli_parser.add_argument('-n', '--include-repname', action='store_true',
                             help="With --representation, include the representation name in the downloaded file name")
+    cli_parser.add_argument('-t', '--tar', action='store_true',
+                            help="Write the files and folders (with all their contents) to a tar archive "
+                                 "named by the destination argument, or \"-\" for stdout")
     cli_parser.add_argument('-u', '--unspace', action='store_true', help='unspace file names when saving locally')
     cli_parser.add_argument('-q', '--quiet', action='store_true', help='Do not print status messages')
+    add_bwlimit_argument(cli_parser)
     options = cli_parser.parse_args(args)
+    if not set_command_bwlimit(options.bwlimit):
+        return
+    if not options.quiet:
+        start_transfer_stats()
     item_ids = expand_item_ids(options.ids)
     if not item_ids:
         return
+    if options.tar:
+        if options.folders or options.recursive or options.representation:
+            print("-t/--tar cannot be used with -d/--folders, -R/--recursive, or -r/--representation")
+            return
+        get_tar(item_ids, options)
+        return
     repname = options.representation
     include_repname = options.include_repname
     if repname:
         repname = representation_aliases.get(repname, repname)
     do_folders = options.folders
+    recursive = options.recursive
+    if recursive and (not do_folders or repname):
+        print("-R/--recursive can only be used with -d/--folders, and not with -r/--representation")
+        return
     include_pattern = options.re_include and re.compile(options.re_include)
     exclude_pattern = options.re_exclude and re.compile(options.re_exclude)
     unspace = options.unspace
@@ -1345,26 +3206,62 @@ def get_cmd(args):  # {{{2
             print(f"{target_dir} is not a directory!")
             return
     client = get_ops_client()
+    ####
+    def _file_passes_filters(item):
+        return item.type == 'file' and \
+               (not include_pattern or include_pattern.fullmatch(item.name)) and \
+               (not exclude_pattern or not exclude_pattern.fullmatch(item.name))
+    ####
+    # Yields (file, local_path) for each file to be downloaded from `folder` (and its sub-folders,
+    # if recursive), creating local directories as their listings arrive.
+    def _folder_download_tasks(folder):
+        for _folder, path, items in walk_folder_tree(client, folder, fields=['type', 'name', 'id', 'sha1', 'size'],
+                                                     max_levels=None if recursive else 1):
+            dirpath = os.path.join(target_dir, *(unspace_name(p) if unspace else p for p in path))
+            try:
+                os.makedirs(dirpath, exist_ok=True)
+            except OSError as ex:
+                print(f"** Unable to create {dirpath}: {ex.strerror} **", file=sys.stderr)
+                continue
+            if not quiet: print(f'== Retrieving files from "{"/".join((folder.name,) + path)}" ==')
+            for item in items:
+                if _file_passes_filters(item):
+                    filename = unspace_name(item.name) if unspace else item.name
+                    if not quiet: print(f"Downloading {filename}...")
+                    yield item, os.path.join(dirpath, filename)
+    ####
+    # Runs on a worker thread, so it reports errors by returning them rather than printing.
+    def _download_task(task):
+        file, filepath = task
+        try:
+            with open(filepath, "wb") as f:
+                return download_file(file, f)
+        except (BoxAPIException, OSError) as ex:
+            return ex
+    ####
+    if do_folders and not repname:
+        for item_id in item_ids:
+            folder = client.folder(folder_id=item_id).get(fields=['id', 'name'])
+            for (file, filepath), result in bounded_map(_download_task, _folder_download_tasks(folder),
+                                                        transfer_num_threads):
+                if isinstance(result, Exception):
+                    message = result.message if isinstance(result, BoxAPIException) else result
+                    print(f"** Failed to download {filepath}: {message} **", file=sys.stderr)
+                elif not result:
+                    print(f"** {filepath} failed SHA-1 verification; the local copy may be corrupt **",
+                          file=sys.stderr)
+        return
     for item_id in item_ids:
-        if do_folders:
+        if do_folders:  # Only representations are downloaded from folders here
             folder = client.folder(folder_id=item_id).get()
             if not quiet: print(f'== Retrieving files from "{folder.name}" ==')
-            def _filter_func(item):
-                if item.type != 'file':
-                    return False
-                elif include_pattern and not include_pattern.fullmatch(item.name):
-                    return False
-                elif exclude_pattern and exclude_pattern.fullmatch(item.name):
-                    return False
-                else:
-                    return True
             file_ids = [item.id for item in retrieve_folder_items(
-                            client, folder, fields=['type', 'name', 'id'], filter_func=_filter_func)]
+                            client, folder, fields=['type', 'name', 'id'], filter_func=_file_passes_filters)]
         else:
             file_ids = [item_id]
         for file_id in file_ids:
-            file = client.file(file_id)
-            filename = file.get(fields=['name']).name
+            file = client.file(file_id).get(fields=['name', 'sha1', 'size'])
+            filename = file.name
             if unspace:
                 filename = unspace_name(filename)
             if repname:
@@ -1386,10 +3283,192 @@ def get_cmd(args):  # {{{2
             else:
                 if not quiet: print(f"Downloading {filename}...")
                 if use_stdout:
-                    file.download_to(sys.stdout.buffer)
+                    verified = download_file(file, sys.stdout.buffer, max_attempts=1)
                 else:
                     with open(os.path.join(target_dir, filename), "wb") as f:
-                        file.download_to(f)
+                        verified = download_file(file, f)
+                if not verified:
+                    print(f"** {filename} failed SHA-1 verification; the local copy may be corrupt **",
+                          file=sys.stderr)
+
+# Handles `get --tar`
+def get_tar(item_ids, options):
+    include_pattern = options.re_include and re.compile(options.re_include)
+    exclude_pattern = options.re_exclude and re.compile(options.re_exclude)
+    ####
+    def _file_passes_filters(item):
+        return (not include_pattern or include_pattern.fullmatch(item.name)) and \
+               (not exclude_pattern or not exclude_pattern.fullmatch(item.name))
+    ####
+    use_stdout = options.directory == '-'
+    client = get_ops_client()
+    items = []
+    for item_id in item_ids:
+        _type, item = get_api_item(client, item_id)
+        if _type == 'file':
+            items.append(item.get(fields=['type', 'name', 'id', 'size', 'sha1', 'content_modified_at']))
+        elif _type == 'folder':
+            items.append(item.get(fields=['type', 'name', 'id', 'content_modified_at', 'modified_at']))
+    if not items:
+        return
+    args = (client, items)
+    kwargs = dict(filter_func=_file_passes_filters, unspace=options.unspace, quiet=options.quiet)
+    if use_stdout:
+        failures = download_tar(*args, sys.stdout.buffer, **kwargs)
+        sys.stdout.buffer.flush()
+    else:
+        with open(expand_all(options.directory), 'wb') as f:
+            failures = download_tar(*args, f, **kwargs)
+    if failures:
+        print(f"** {failures} file(s) could not be added to the archive **", file=sys.stderr)
+
+# Files with these extensions are searched through their extracted_text representation
+EXTRACTED_TEXT_EXTENSIONS = {'doc', 'docx', 'ppt', 'pptx', 'xls', 'xlsx', 'pdf', 'rtf', 'odt', 'odp', 'ods'}
+
+# Lines longer than this are searched in pieces of about this size (so a match that spans two
+# pieces is missed), and printed truncated to it
+GREP_MAX_LINE_LENGTH = 1024*1024
+
+def grep_cmd(args):  # {{{2
+    cli_parser = argparse.ArgumentParser(exit_on_error=False,
+                                         prog=progname, usage='%(prog)s grep [options] pattern ids...',
+                                         description='Search the contents of files for a regular expression')
+    cli_parser.add_argument('pattern', help='Regular expression (Python syntax)')
+    cli_parser.add_argument('ids', nargs='+', help='File or Folder IDs (folders are searched recursively)')
+    cli_parser.add_argument('-i', '--ignore-case', action='store_true', help='Ignore case distinctions')
+    cli_parser.add_argument('-l', '--files-with-matches', action='store_true',
+                            help='Only print the names of files that match, reading each no further '
+                                 'than its first match')
+    cli_parser.add_argument('-n', '--line-number', action='store_true', help='Prefix each match with its line number')
+    cli_parser.add_argument('-L', '--max-levels', type=int, metavar='LEVELS',
+                            help='Maximum number of folder levels to search (>= 1)')
+    cli_parser.add_argument('-I', '--re-include', metavar='RE',
+                            help='Only search files whose names fully match RE')
+    cli_parser.add_argument('-x', '--re-exclude', metavar='RE',
+                            help='Do not search files whose names fully match RE')
+    cli_parser.add_argument('-T', '--no-extracted-text', action='store_true',
+                            help='Search the raw contents of office documents and PDFs, rather than '
+                                 'their extracted_text representation')
+    cli_parser.add_argument('-s', '--stash', action='store_true', help='Add matching files to the item stash')
+    cli_parser.add_argument('-a', '--append-stash', action='store_true',
+                            help='Append items to the current stash, rather than replacing it')
+    options = cli_parser.parse_args(args)
+    flags = re.IGNORECASE if options.ignore_case else 0
+    try:
+        pattern = re.compile(options.pattern.encode(), flags)
+    except re.error as ex:
+        print(f"Invalid pattern: {ex}")
+        return
+    if options.max_levels is not None and options.max_levels <= 0:
+        print('--max-levels must be >= 1')
+        return
+    item_ids = expand_item_ids(options.ids)
+    if not item_ids:
+        return
+    include_pattern = options.re_include and re.compile(options.re_include)
+    exclude_pattern = options.re_exclude and re.compile(options.re_exclude)
+    files_only = options.files_with_matches
+    line_numbers = options.line_number
+    use_extracted_text = not options.no_extracted_text
+    stash_entries = {}
+    client = get_ops_client()
+    from requests.exceptions import RequestException
+    fields = ['type', 'name', 'id', 'extension']
+    ####
+    def _file_passes_filters(item):
+        return item.type == 'file' and \
+               (not include_pattern or include_pattern.fullmatch(item.name)) and \
+               (not exclude_pattern or not exclude_pattern.fullmatch(item.name))
+    ####
+    # Yields (file, display_path) for every file to be searched
+    def _grep_targets():
+        for item_id in item_ids:
+            _type, item = get_api_item(client, item_id)
+            if _type == 'file':
+                yield item.get(fields=fields), item.name
+            elif _type == 'folder':
+                for folder, path, items in walk_folder_tree(client, item, fields=fields,
+                                                            max_levels=options.max_levels):
+                    for it in items:
+                        if _file_passes_filters(it):
+                            yield it, '/'.join((item.name,) + path + (it.name,))
+    ####
+    def _content_chunks(file):
+        if use_extracted_text and getattr(file, 'extension', '').lower() in EXTRACTED_TEXT_EXTENSIONS:
+            rep = get_repr_map(file).get('extracted_text')
+            if rep is not None:
+                state, repr_info = get_repr_info(client, rep, silent=True)
+                if state != 'success':
+                    raise ValueError(f"extracted_text representation is {state}")
+                url = repr_info['content']['url_template'].replace('{+asset_path}', '')
+                return stream_response_chunks(client, url)
+        return stream_response_chunks(client, file.get_url('content'))
+    ####
+    # Runs on a worker thread: returns a tuple (matches, is_binary), where `matches` is a list of
+    # (line_number, line) tuples, or an exception. Like grep(1), a file whose first chunk contains
+    # a NUL byte is treated as binary, and reading stops at its first match.
+    def _grep_file(target):
+        file, _ = target
+        matches = []
+        is_binary = None
+        try:
+            chunks = _content_chunks(file)
+            # long_line_matched: the line in progress is too long to hold, and has already matched
+            partial, line_number, long_line_matched = b'', 0, False
+            for chunk in chunks:
+                if is_binary is None:
+                    is_binary = b'\0' in chunk
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    line_number += 1
+                    if long_line_matched:
+                        long_line_matched = False
+                    elif pattern.search(line):
+                        matches.append((line_number, line[:GREP_MAX_LINE_LENGTH]))
+                        if files_only or is_binary:
+                            chunks.close()
+                            return matches, is_binary
+                if len(partial) > GREP_MAX_LINE_LENGTH:
+                    if not long_line_matched and pattern.search(partial):
+                        matches.append((line_number + 1, partial[:GREP_MAX_LINE_LENGTH]))
+                        if files_only or is_binary:
+                            chunks.close()
+                            return matches, is_binary
+                        long_line_matched = True
+                    partial = b''
+            if partial and not long_line_matched and pattern.search(partial):
+                matches.append((line_number + 1, partial))
+            return matches, is_binary
+        except (BoxAPIException, ValueError, RequestException, OSError) as ex:
+            return ex
+    ####
+    try:
+        for (file, path), result in bounded_map(_grep_file, _grep_targets(), transfer_num_threads):
+            if isinstance(result, Exception):
+                print(f"** {path}: {getattr(result, 'message', result)} **", file=sys.stderr)
+                continue
+            matches, is_binary = result
+            if not matches:
+                continue
+            add_history_item(file)
+            if options.stash:
+                stash_entries[file.id] = (file.name, file.id, 'file')
+            if files_only:
+                print(path)
+            elif is_binary:
+                print(f"Binary file {path} matches")
+            else:
+                for line_number, line in matches:
+                    line_number_str = f"{line_number}:" if line_numbers else ""
+                    text = line.rstrip(b'\r').decode(errors='backslashreplace')
+                    print(f"{path}:{line_number_str}{text}")
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print("Cancelled")
+    finally:
+        if options.stash:
+            update_item_stash(stash_entries, options.append_stash)
 
 def zip_cmd(args): # {{{2
     cli_parser = argparse.ArgumentParser(exit_on_error=False,
@@ -1397,7 +3476,11 @@ def zip_cmd(args): # {{{2
                                          description='Download a ZIP file of items')
     cli_parser.add_argument('ids', nargs='+', help='File or Folder IDs')
     cli_parser.add_argument('zipfile', help='ZIP file destination')
+    add_bwlimit_argument(cli_parser)
     options = cli_parser.parse_args(args)
+    if not set_command_bwlimit(options.bwlimit):
+        return
+    start_transfer_stats()
     item_ids = expand_item_ids(options.ids)
     if not item_ids:
         return
@@ -1411,8 +3494,8 @@ def zip_cmd(args): # {{{2
     for item in items:
         print("  * ", item.name, '/' if item.type == 'folder' else "", sep="")
     print(flush=True)
-    with open(zipfile, 'wb') as f:
-        status_dict = client.download_zip(zipname, items, f)
+    with open(zipfile, 'wb') as f, timed_transfer(zipname, None):
+        status_dict = client.download_zip(zipname, items, transfer_stream(f, 'down'))
     total, downloaded, skipped = \
         (status_dict[k] for k in ('total_file_count', 'downloaded_file_count', 'skipped_file_count'))
     print(f"Total Files: {total} ({downloaded} downloaded, {skipped} skipped)")
@@ -1447,68 +3530,234 @@ def put_cmd(args):  # {{{2
     cli_parser = argparse.ArgumentParser(exit_on_error=False,
                                          prog=progname, usage='%(prog)s put [options] file(s)',
                                          description='Upload files')
-    cli_parser.add_argument('files', nargs='+', help='File(s) to upload')
+    cli_parser.add_argument('files', nargs='+', help='File(s) to upload, or "-" to upload from stdin')
     cli_parser.add_argument('-f', '--file-version', metavar='file_id',
                             help='Upload a new version of a file')
     cli_parser.add_argument('-d', '--folder', metavar='folder_id',
                             help='Upload a file into a given folder')
+    cli_parser.add_argument('-F', '--force', action='store_true',
+                            help='Upload files even if an identical copy already exists on Box')
+    cli_parser.add_argument('-R', '--recursive', action='store_true',
+                            help='Upload directories recursively, creating (or reusing) folders of the same name')
+    cli_parser.add_argument('-n', '--name', help='With "-", the name of the file to create in --folder')
+    cli_parser.add_argument('-s', '--size', type=int, metavar='N',
+                            help='With "-", the exact number of bytes that will be read from stdin. This allows '
+                                 'large streams to be uploaded in parts as they arrive, rather than being '
+                                 'spooled to a temporary file first')
+    add_bwlimit_argument(cli_parser)
     options = cli_parser.parse_args(args)
+    if not set_command_bwlimit(options.bwlimit):
+        return
+    start_transfer_stats()
     file_id = options.file_version
     folder_id = options.folder
-    files = [file for pathspec in options.files for file in glob.glob(expand_all(pathspec))]
+    force = options.force
+    recursive = options.recursive
     if not any((file_id, folder_id)) or all((file_id, folder_id)):
         print("You must supply exactly one of --file-version/-f or --folder/-d")
         return
-    if file_id and len(files) != 1:
+    if options.files == ['-']:
+        put_stdin(options)
+        return
+    files = [file for pathspec in options.files for file in glob.glob(expand_all(pathspec))]
+    if file_id and (recursive or len(files) != 1 or os.path.isdir(files[0])):
         print("You must supply exactly one file to upload a new version")
         return
+    dirs = [file for file in files if os.path.isdir(file)]
+    files = [file for file in files if not os.path.isdir(file)]
+    if dirs and not recursive:
+        for dirpath in dirs:
+            print(f'"{dirpath}" is a directory (use --recursive/-R) -- skipped')
     file_id = file_id and translate_id(file_id)
     folder_id = folder_id and translate_id(folder_id)
     if not any((file_id, folder_id)):
         return
     client = get_ops_client()
     if file_id:
-        file = client.file(file_id)
-        box_filename = file.get(fields=['name']).name
+        file = client.file(file_id).get(fields=['id', 'name', 'type', 'parent', 'size', 'sha1'])
+        box_filename = file.name
         filepath = files[0]
+        if not force and is_same_file(filepath, file):
+            print(f'"{filepath}" is identical to "{box_filename}" -- skipped')
+            add_history_item(file)
+            return
         use_chunked = os.path.getsize(filepath) > chunked_upload_size_threshold
         chunked_msg = " (chunked)" if use_chunked else ""
         print(f'Uploading{chunked_msg} "{filepath}" as a new version of "{box_filename}"...', end="", flush=True)
-        if use_chunked:
-            file = file.get_chunked_uploader(filepath).start()
-        else:
-            file = file.update_contents(filepath)
+        with timed_transfer(os.path.basename(filepath), os.path.getsize(filepath)):
+            if use_chunked:
+                file = chunked_upload_file(file.create_upload_session, filepath)
+            else:
+                with open(filepath, 'rb') as f:
+                    file = file.update_contents_with_stream(transfer_stream(f, 'up'))
         if os.path.basename(filepath) != box_filename:
             file = file.rename(os.path.basename(filepath))
         add_history_item(file)
         print("done")
     elif folder_id:
-        folder = client.folder(folder_id)
-        foldername = folder.get(fields=['name']).name
+        folder = client.folder(folder_id).get(fields=['id', 'name', 'type', 'parent', 'item_collection'])
+        foldername = folder.name
+        # Preflight: a single listing of the destination folder tells us which of our files are
+        # already there, so that identical files can be skipped and changed ones can be sent
+        # directly as new versions, rather than uploading everything and reacting to 409s.
+        existing_items = {}
+        if files or (dirs and recursive):
+            for item in retrieve_folder_items(client, folder, fields=['type', 'name', 'id', 'size', 'sha1']):
+                existing_items[item.name] = item
         for filepath in files:
             use_chunked = os.path.getsize(filepath) > chunked_upload_size_threshold
             chunked_msg = " (chunked)" if use_chunked else ""
+            existing = existing_items.get(os.path.basename(filepath))
+            if existing and existing.type != 'file':
+                print(f'"{filepath}": a {existing.type} of that name already exists in "{foldername}" -- skipped')
+                continue
+            if existing and not force and is_same_file(filepath, existing):
+                print(f'"{filepath}" is identical to the copy in "{foldername}" -- skipped')
+                add_history_item(existing, parent=folder)
+                continue
             print(f'Uploading{chunked_msg} "{filepath}" to "{foldername}"...', end="", flush=True)
-            try:
-                if use_chunked:
-                    file = folder.get_chunked_uploader(filepath).start()
-                else:
-                    file = folder.upload(filepath)
-                add_history_item(file)
+            file, new_version = upload_file(client, folder, filepath, existing)
+            add_history_item(file, parent=folder)
+            if new_version:
+                print("(new version)...done")
+            else:
                 print(f"done (ID: {file.id})")
-            except BoxAPIException as ex:
-                if ex.status == 409:
-                    _file_id = ex.context_info['conflicts']['id']
-                    print('(new version)...', end="", flush=True)
-                    file = client.file(_file_id)
-                    if use_chunked:
-                        file = file.get_chunked_uploader(filepath).start()
-                    else:
-                        file = file.update_contents(filepath)
-                    add_history_item(file)
-                    print("done")
-                else:
-                    raise ex
+        if dirs and recursive:
+            put_tree(client, folder, dirs, existing_items, force)
+
+# Handles `put -`
+def put_stdin(options):
+    if options.folder and not options.name:
+        print("You must supply a file name with --name/-n when uploading stdin to a folder")
+        return
+    if options.recursive:
+        print("-R/--recursive cannot be used when uploading stdin")
+        return
+    file_id = options.file_version and translate_id(options.file_version)
+    folder_id = options.folder and translate_id(options.folder)
+    if not any((file_id, folder_id)):
+        return
+    client = get_ops_client()
+    try:
+        with timed_transfer(options.name or 'stdin', options.size):
+            file = _put_stdin(client, file_id, folder_id, options.name, options.size)
+    except ValueError as ex:
+        print(f"\n** Upload failed: {ex} **")
+        return
+    if file:
+        add_history_item(file)
+        print(f"done (ID: {file.id})")
+
+def _put_stdin(client, file_id, folder_id, name, size):
+    if file_id:
+        file = client.file(file_id).get(fields=['id', 'name', 'type', 'parent'])
+        print(f'Uploading stdin as a new version of "{file.name}"...', end="", flush=True)
+        file = upload_stream(sys.stdin.buffer, file=file, size=size)
+        if name and name != file.name:
+            file = file.rename(name)
+    else:
+        folder = client.folder(folder_id).get(fields=['id', 'name', 'type', 'parent'])
+        existing = next((item for item in retrieve_all_folder_items(client, folder.id, fields=['type', 'name', 'id'])
+                         if item.name == name), None)
+        if existing and existing.type != 'file':
+            print(f'A {existing.type} named "{name}" already exists in "{folder.name}"')
+            return None
+        new_version_msg = " (new version)" if existing else ""
+        print(f'Uploading stdin as "{name}"{new_version_msg} to "{folder.name}"...',
+              end="", flush=True)
+        if existing:
+            file = upload_stream(sys.stdin.buffer, file=client.file(existing.id), size=size)
+        else:
+            file = upload_stream(sys.stdin.buffer, name, folder=folder, size=size)
+    return file
+
+# put_tree() {{{2
+
+# Mirrors the local directories `dirpaths` (and everything beneath them) into `folder`, for
+# `put --recursive`. `listing` is a dict of name -> item for the contents of `folder`.
+#
+# Folders are created one level of the tree at a time, with all the folders in a level created
+# (or, if a folder of that name already exists, listed) concurrently. The listing of each remote
+# folder is cached by folder ID, so that the next level can look up its parent's children and
+# the file uploads can tell which files are already present, without any further requests. Once
+# the whole hierarchy exists, the files are uploaded concurrently.
+
+def put_tree(client, folder, dirpaths, listing, force=False):
+    folder_listings = {folder.id: listing}   # remote folder ID -> {name: item}
+    ####
+    def _ensure_folder(task):
+        dirpath, parent_id, name = task
+        try:
+            existing = folder_listings[parent_id].get(name)
+            if existing and existing.type != 'folder':
+                raise ValueError(f'a {existing.type} named "{name}" is in the way')
+            created = False
+            if existing:
+                remote_folder = existing
+            else:
+                try:
+                    remote_folder = client.folder(parent_id).create_subfolder(name)
+                    created = True
+                except BoxAPIException as ex:
+                    if ex.status != 409:
+                        raise ex
+                    conflict_id = ex.context_info['conflicts'][0]['id']
+                    remote_folder = client.folder(conflict_id).get(fields=['id', 'name', 'type'])
+            items = [] if created else \
+                retrieve_all_folder_items(client, remote_folder.id, fields=['type', 'name', 'id', 'size', 'sha1'])
+            return remote_folder, {item.name: item for item in items}, created
+        except (BoxAPIException, ValueError) as ex:
+            return ex
+    ####
+    def _upload_task(task):
+        filepath, remote_folder, existing = task
+        try:
+            if existing and existing.type != 'file':
+                raise ValueError(f'a {existing.type} of that name is in the way')
+            if existing and not force and is_same_file(filepath, existing):
+                return existing, None
+            return upload_file(client, remote_folder, filepath, existing)
+        except (BoxAPIException, ValueError, OSError) as ex:
+            return ex
+    ####
+    upload_tasks = []
+    level = [(dirpath, folder.id, os.path.basename(os.path.abspath(dirpath))) for dirpath in dirpaths]
+    while level:
+        next_level = []
+        for (dirpath, parent_id, name), result in bounded_map(_ensure_folder, level, api_num_threads):
+            if isinstance(result, Exception):
+                print(f'** Unable to create folder for "{dirpath}": {getattr(result, "message", result)} **',
+                      file=sys.stderr)
+                continue
+            remote_folder, listing, created = result
+            folder_listings[remote_folder.id] = listing
+            if created:
+                print(f'Created folder "{dirpath}" (ID: {remote_folder.id})')
+                add_history_item(remote_folder)
+            try:
+                with os.scandir(dirpath) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as ex:
+                print(f'** Unable to read "{dirpath}": {ex.strerror} **', file=sys.stderr)
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    next_level.append((entry.path, remote_folder.id, entry.name))
+                elif entry.is_file():
+                    upload_tasks.append((entry.path, remote_folder, listing.get(entry.name)))
+        level = next_level
+    for (filepath, remote_folder, _), result in bounded_map(_upload_task, upload_tasks, transfer_num_threads):
+        if isinstance(result, Exception):
+            print(f'** Unable to upload "{filepath}": {getattr(result, "message", result)} **', file=sys.stderr)
+            continue
+        file, new_version = result
+        add_history_item(file, parent=remote_folder)
+        if new_version is None:
+            print(f'"{filepath}" is identical to the copy on Box -- skipped')
+        elif new_version:
+            print(f'Uploaded "{filepath}" (new version)')
+        else:
+            print(f'Uploaded "{filepath}" (ID: {file.id})')
 
 def cat_cmd(args):  # {{{2
     cli_parser = argparse.ArgumentParser(exit_on_error=False,
@@ -1517,15 +3766,29 @@ def cat_cmd(args):  # {{{2
     cli_parser.add_argument('ids', nargs='+', help='Item IDs to print')
     cli_parser.add_argument('-H', '--headers', action='store_true',
                             help="Print a header before each items's contents")
-    cli_parser.add_argument('-c', '--byte-count', metavar='N', type=int, default=4096,
-                            help='Print the first N bytes of files (default %(default)s)')
+    group = cli_parser.add_mutually_exclusive_group()
+    group.add_argument('-c', '--byte-count', metavar='N', type=int, default=4096,
+                       help='Print N bytes of files (default %(default)s)')
+    group.add_argument('-a', '--all', action='store_true', help='Print the entire contents of files')
+    group.add_argument('-t', '--tail', metavar='N', type=int,
+                       help='Print the last N bytes of files')
+    cli_parser.add_argument('-o', '--offset', metavar='N', type=int, default=0,
+                            help='With -c/--byte-count or -a/--all, start printing at byte offset N')
+    cli_parser.add_argument('-f', '--follow', action='store_true',
+                            help='After printing a file, wait for new versions of it and print any bytes '
+                                 'added to its end, until interrupted (only for a single file)')
+    cli_parser.add_argument('-s', '--sleep-interval', metavar='SECS', type=float, default=5.0,
+                            help='With -f/--follow, seconds between checks for a new version (default %(default)s)')
     options = cli_parser.parse_args(args)
     item_ids = expand_item_ids(options.ids)
     if not item_ids:
         return
-    byte_count = options.byte_count
+    if options.follow and len(item_ids) != 1:
+        print("-f/--follow can only be used with a single file")
+        return
     headers = options.headers
     client = get_ops_client()
+    out = sys.stdout.buffer
     for i, item_id in enumerate(item_ids):
         _type, item = get_api_item(client, item_id)
         if not _type: continue
@@ -1535,16 +3798,45 @@ def cat_cmd(args):  # {{{2
                 print_name_header(web_link.name, leading_blank=i != 0)
             print(web_link.url)
         elif _type == 'file':
-            file = item.get(fields=['name'])
-            filename = file.name
+            file = item.get(fields=['name', 'size'])
             if headers:
-                print_name_header(filename, leading_blank=i != 0)
-            content = file.content(byte_range=(0, byte_count))
-            str_rep = content.decode(errors='backslashreplace')
-            print(str_rep, end='' if str_rep[-1] == '\n' else '\n')
+                print_name_header(file.name, leading_blank=i != 0)
+            if options.tail is not None:
+                start, end = max(file.size - options.tail, 0), file.size
+            elif options.all:
+                start, end = min(options.offset, file.size), file.size
+            else:
+                start = min(options.offset, file.size)
+                end = min(start + options.byte_count, file.size)
+            sys.stdout.flush()
+            last_byte = stream_file_range(file, out, start, end)
+            if options.follow:
+                last_byte = follow_file(file, out, options.sleep_interval) or last_byte
+            # Finish off a partial line for the terminal, but leave piped bytes untouched
+            if last_byte and last_byte != b'\n' and out.isatty():
+                out.write(b'\n')
+                out.flush()
         else:
             print(f"You cannot cat a {_type}")
 
+# Handles `cat --follow`: polls `file` for new versions, and writes whatever bytes have been
+# added beyond the end of the previous version. Returns the last byte written.
+def follow_file(file, out, interval):
+    size = file.size
+    last_byte = b''
+    try:
+        while True:
+            time.sleep(interval)
+            new_size = file.get(fields=['size']).size
+            if new_size < size:
+                print(f"\n** {file.name}: file truncated **", file=sys.stderr)
+            elif new_size > size:
+                last_byte = stream_file_range(file, out, size, new_size)
+            size = new_size
+    except KeyboardInterrupt:
+        pass
+    return last_byte
+
 def rm_cmd(args):  # {{{2
     cli_parser = argparse.ArgumentParser(exit_on_error=False,
                                          prog=progname, usage='%(prog)s rm [options] ids...',
@@ -1615,8 +3907,7 @@ def mkdir_cmd(args):  # {{{2
     newfolder = folder.create_subfolder(foldername)
     print('ID:', newfolder.id)
     add_history_item(newfolder, folder)
-    global current_cmd_last_id
-    current_cmd_last_id = newfolder.id
+    current_cmd_last_id.set(newfolder.id)
 
 def mv_cmd(args):  # {{{2
     cli_parser = argparse.ArgumentParser(exit_on_error=False,
@@ -1953,7 +4244,7 @@ def ver_cmd(args):  # {{{2
     elif do_restore:
         # We're going to have to do this manually, like the titans of old.
         try:
-            response = client.session.put(f'https://api.box.com/2.0/files/{file_id}/versions/{version_id}',
+            response = client.session.put(client.session.get_url('files', file_id, 'versions', version_id),
                                           data='{ "trashed_at" : null }')
         except BoxAPIException as e:
             raise  # Send it upward for handling
@@ -1981,7 +4272,13 @@ def ver_cmd(args):  # {{{2
 
 def shell_cmd(args):  # {{{2
     print("Type q(uit)/e(xit) to exit the shell, and h(elp)/? for general usage.")
+    with routed_output():
+        _shell_loop()
+
+def _shell_loop():
+    warned_of_jobs = False
     while True:
+        report_ended_jobs()
         try:
             cmdline = input("> ").strip()
         except KeyboardInterrupt:
@@ -1990,9 +4287,14 @@ def shell_cmd(args):  # {{{2
         except EOFError:
             print()
             break
+        listing_prefetcher.cancel()
         if len(cmdline) == 0 or cmdline.isspace():
             continue
         elif cmdline in ('quit', 'q', 'exit', 'x'):
+            if any(job.state == 'Running' for job in shell_jobs.values()) and not warned_of_jobs:
+                print("There are running jobs; quit again to exit anyway")
+                warned_of_jobs = True
+                continue
             break
         elif cmdline in ('help', 'h', '?'):
             print(general_usage, end="")
@@ -2013,19 +4315,44 @@ def shell_cmd(args):  # {{{2
                 print(err)
         elif cmdline == "pwd":
             print(os.getcwd())
+        elif (cmd := cmdline.split(maxsplit=1)[0]) in shell_builtins:
+            shell_builtins[cmd](cmdline.split()[1:])
         elif cmdline[0] == '!':
             subprocess.run(cmdline[1:], shell=True)
         else:
+            if cmdline.endswith('&'):
+                try:
+                    tokens = shlex.split(cmdline[:-1])
+                except ValueError as ex:
+                    print('shlex error:', ex)
+                    continue
+                if tokens:
+                    start_job(tokens)
+                continue
             # If a KeyboardInterrupt occurs during process_cmdline(), we allow it to terminate
             # the program, so that if an API call spazzes out the user can stop it.
+            prefetch_candidates.clear()
             process_cmdline(cmdline)
+            if prefetch_candidates:
+                listing_prefetcher.start(prefetch_candidates)
+
+shell_builtins = {'jobs': jobs_builtin, 'fg': fg_builtin, 'kill': kill_builtin}
 
 def source_cmd(args):  # {{{2
-    if len(args) != 1 or '-h' in args or '--help' in args:
-        print(f"usage: {os.path.basename(sys.argv[0])} source file\n\n"
-               "Read commands from a given file. Use '-' for stdin.")
-        return
-    cmdfile = expand_all(args[0])
+    cli_parser = argparse.ArgumentParser(exit_on_error=False,
+                    prog=progname, usage='%(prog)s source [options] file',
+                    description="Read commands from a given file. Use '-' for stdin.")
+    cli_parser.add_argument('file', help='File of commands, one per line')
+    cli_parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                            help='Run up to N independent lines at once (see below)')
+    cli_parser.epilog = ("With -j, lines are run concurrently, and the output of each is printed "
+                         "in the order of the lines. Lines that refer to earlier commands' results "
+                         "(using @, @@, @alias, numeric references like 3 or 1-5, '.', '..', or "
+                         "history searches like %term%), alias definitions, and ls, search, tree, "
+                         "grep, dupes and stash commands, whose results later lines may refer to, "
+                         "wait for the lines before them to finish, and run alone.")
+    options = cli_parser.parse_args(args)
+    cmdfile = expand_all(options.file)
     if cmdfile == '-':
         lines = sys.stdin.readlines()
     else:
@@ -2034,11 +4361,62 @@ def source_cmd(args):  # {{{2
             return
         with open(cmdfile, "rt") as f:
             lines = f.readlines()
-    for cmdline in lines:
-        cmdline = cmdline.strip()
-        if len(cmdline) == 0 or cmdline[0] == '#':
+    lines = [cmdline.strip() for cmdline in lines]
+    lines = [cmdline for cmdline in lines if cmdline and cmdline[0] != '#']
+    if options.jobs <= 1:
+        for cmdline in lines:
+            process_cmdline(cmdline)
+        return
+    with routed_output():
+        batch = []
+        for cmdline in lines:
+            if is_independent_cmdline(cmdline):
+                batch.append(cmdline)
+            else:
+                _run_source_batch(batch, options.jobs)
+                batch = []
+                process_cmdline(cmdline)
+        _run_source_batch(batch, options.jobs)
+
+# Returns whether a command line can run at the same time as those around it, i.e. it doesn't use
+# the results of earlier commands (through the last ID, stash, aliases, or ls/item history), isn't
+# an alias definition, and its command isn't one of sequential_command_funcs.
+def is_independent_cmdline(cmdline):
+    try:
+        tokens = shlex.split(cmdline)
+    except ValueError:
+        return False
+    while tokens and tokens[0] in GLOBAL_OPTIONS:
+        del tokens[:1 + GLOBAL_OPTIONS[tokens[0]]]
+    if not tokens or command_funcs.get(tokens[0]) in sequential_command_funcs:
+        return False
+    for token in tokens:
+        token = token.removesuffix('!')
+        if not token:
             continue
-        process_cmdline(cmdline)
+        if token[0] in '@%=^$' or token[-1] in '%=^$' or token in ('.', '..'):
+            return False
+        if (token.isdigit() and token != '0' and len(token) <= 4) or NUMERIC_RANGE_REGEX.fullmatch(token):
+            return False
+    return True
+
+# Runs the command lines in `batch` on up to num_threads threads, printing the output of each, in
+# order, once it and those before it are done.
+def _run_source_batch(batch, num_threads):
+    global last_id
+    def _run(cmdline):
+        output, last_ids = JobOutput(), []
+        job_output.set(output)
+        deferred_last_ids.set(last_ids)
+        try:
+            process_cmdline(cmdline)
+        except Exception as ex:
+            print(f"** {type(ex).__name__}: {ex} **")
+        return output, last_ids
+    for _cmdline, (output, last_ids) in bounded_map(_run, batch, num_threads, ordered=True):
+        output.attach(sys.stdout, sys.stderr)
+        if last_ids:
+            last_id = last_ids[-1]
 
 # Map command names to the implementing command function  # {{{2
 command_funcs = {
@@ -2050,9 +4428,14 @@ command_funcs = {
     'ls'       : ls_cmd, 'list' : ls_cmd,
     'fd'       : search_cmd, 'search' : search_cmd, 'find' : search_cmd,
     'tree'     : tree_cmd,
+    'du'       : du_cmd,
+    'snapshot' : snapshot_cmd,
+    'dupes'    : dupes_cmd,
+    'diff'     : diff_cmd,
     'unspace'  : unspace_cmd,
     'stash'    : stash_cmd,
     'get'      : get_cmd,
+    'grep'     : grep_cmd,
     'zip'      : zip_cmd,
     'repr'     : repr_cmd,
     'put'      : put_cmd,
@@ -2072,6 +4455,16 @@ command_funcs = {
     'shell'    : shell_cmd,
     'source'   : source_cmd,
 }
+
+# Commands that can change folder listings, after which the listing cache is invalidated
+mutating_command_funcs = {
+    put_cmd, rm_cmd, mkdir_cmd, mv_cmd, cp_cmd, rn_cmd, desc_cmd, trash_cmd, ver_cmd, unspace_cmd,
+}
+# Commands that can change the ls history, numbered item list, or stash, which later commands
+# may refer to, or that run other commands; `source -j` runs these one at a time, in order
+sequential_command_funcs = {
+    ls_cmd, search_cmd, tree_cmd, grep_cmd, dupes_cmd, stash_cmd, source_cmd, shell_cmd,
+}
 # End command functions }}}1
 
 # main {{{1
@@ -2084,5 +4477,7 @@ if __name__ == '__main__':
         process_cmdline(cmdline)
     finally:
         save_state()
+        write_metrics()
+        save_recording()
 
 # }}}1
@@ -0,0 +1,922 @@
+import os, sys, re, json, time, random, hashlib, base64, argparse, io, threading, zipfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from email.parser import BytesParser
+from email.policy import HTTP
+
+# A local stand-in for the subset of the Box API that boxcli uses, so that commands can
+# be exercised (and timed) without a Box account. Run it with
+#
+#   python -m boxtools.fakebox [options]
+#
+# and point boxcli at it by setting $BOXTOOLS_API_URL (or api-base-url in boxtools.toml) to the
+# URL it prints. The server accepts any access token, so the auth-tokens file only needs to exist,
+# holding for instance {"access_token": "fake", "refresh_token": "fake"}.
+#
+# The synthetic tree it serves is generated from a seed, so runs against it are reproducible, and
+# latency, jitter, throttling (429 responses), and download bandwidth can be configured in order
+# to measure how commands behave against a slow or busy server.
+
+# Synthetic content {{{1
+
+_WORDS = ('alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike '
+          'november oscar papa quebec romeo sierra tango uniform victor whiskey xray yankee '
+          'zulu box cloud file folder backup report invoice draft final notes').split()
+
+_EXTENSIONS = ('txt', 'txt', 'log', 'csv', 'md', 'pdf', 'docx', 'jpg', 'png', 'bin')
+
+# Returns `size` bytes of deterministic, line-oriented text derived from `seed`
+def synthetic_content(seed, size):
+    rng = random.Random(seed)
+    out = io.StringIO()
+    n = 0
+    while n < size:
+        line = ' '.join(rng.choices(_WORDS, k=10)) + '\n'
+        out.write(line)
+        n += len(line)
+    return out.getvalue().encode()[:size]
+
+def _timestamp(t=None):
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(t or time.time()))
+
+# FakeBox {{{1
+
+class ApiError(Exception):
+    def __init__(self, status, code, message='', context_info=None, headers=None):
+        super().__init__(message)
+        self.status, self.code, self.message = status, code, message or code
+        self.context_info = context_info
+        self.headers = headers or {}
+
+# The in-memory state of the fake account. All access goes through `lock`.
+
+class FakeBox:
+
+    def __init__(self, part_size=8*1024*1024, search_lag=0.0, pending_polls=1):
+        self.lock = threading.RLock()
+        self.items = {}
+        self.trash = {}
+        self.events = []
+        self.upload_sessions = {}
+        self.zips = {}
+        self.repr_polls = {}
+        self.sha1_cache = {}
+        self.next_id = 100000
+        self.part_size = part_size
+        self.search_lag = search_lag
+        self.pending_polls = pending_polls
+        root = self._new_item('folder', 'All Files', None, item_id='0')
+        root['created_at'] = root['modified_at'] = None
+
+    # Item management {{{2
+
+    def _new_id(self):
+        self.next_id += 1
+        return str(self.next_id)
+
+    def _new_item(self, type_, name, parent_id, item_id=None, t=None):
+        now = _timestamp(t)
+        item = {'type': type_, 'id': item_id or self._new_id(), 'name': name, 'parent_id': parent_id,
+                'created_at': now, 'modified_at': now, 'created': t or time.time(),
+                'description': '', 'size': 0, 'etag': '0', 'trashed_at': None, 'shared_link': None}
+        if type_ == 'folder':
+            item['children'] = {}
+        else:
+            item.update(content_created_at=now, content_modified_at=now, versions=[],
+                        version_id=self._new_id(), data=None, seed=None)
+        self.items[item['id']] = item
+        if parent_id is not None:
+            parent = self.items[parent_id]
+            parent['children'][item['id']] = None
+        return item
+
+    def create_folder(self, parent_id, name, t=None):
+        parent = self.folder(parent_id)
+        self._check_name(parent, name, folder_conflict=True)
+        folder = self._new_item('folder', name, parent_id, t=t)
+        self._event('ITEM_CREATE', folder)
+        return folder
+
+    def create_file(self, parent_id, name, data=None, seed=None, size=None, t=None):
+        parent = self.folder(parent_id)
+        self._check_name(parent, name)
+        f = self._new_item('file', name, parent_id, t=t)
+        self._set_content(f, data, seed, size)
+        self._event('ITEM_UPLOAD', f)
+        return f
+
+    def new_version(self, file_id, data, name=None):
+        f = self.file(file_id)
+        f['versions'].append({'id': f['version_id'], 'sha1': self.sha1(f), 'size': f['size'], 'name': f['name'],
+                              'data': f['data'], 'seed': f['seed'], 'created_at': f['modified_at'],
+                              'modified_at': f['modified_at'], 'trashed_at': None})
+        f['version_id'] = self._new_id()
+        self._set_content(f, data, None, None)
+        if name:
+            f['name'] = name
+        f['modified_at'] = f['content_modified_at'] = _timestamp()
+        f['etag'] = str(int(f['etag']) + 1)
+        self._event('ITEM_UPLOAD', f)
+        return f
+
+    def _set_content(self, f, data, seed, size):
+        old_size = f['size']
+        if data is not None:
+            f['data'], f['seed'], f['size'] = data, None, len(data)
+        else:
+            f['data'], f['seed'], f['size'] = None, seed, size
+        self._add_size(f['parent_id'], f['size'] - old_size)
+
+    def _add_size(self, folder_id, delta):
+        while folder_id is not None and delta:
+            folder = self.items[folder_id]
+            folder['size'] += delta
+            folder_id = folder['parent_id']
+
+    def _check_name(self, parent, name, folder_conflict=False, exclude=None):
+        lname = name.lower()
+        for cid in parent['children']:
+            child = self.items[cid]
+            if child['name'].lower() == lname and cid != exclude:
+                conflicts = self.mini(child)
+                raise ApiError(409, 'item_name_in_use', 'Item with the same name already exists',
+                               {'conflicts': [conflicts] if folder_conflict else conflicts})
+
+    def content(self, f, version_id=None):
+        src = f
+        if version_id and version_id != f['version_id']:
+            src = next((v for v in f['versions'] if v['id'] == version_id), None)
+            if src is None:
+                raise ApiError(404, 'not_found', 'Version not found')
+        if src['data'] is not None:
+            return src['data']
+        return synthetic_content(src['seed'], src['size'])
+
+    def sha1(self, f):
+        if f['data'] is not None:
+            return hashlib.sha1(f['data']).hexdigest()
+        key = (f['seed'], f['size'])
+        if (h := self.sha1_cache.get(key)) is None:
+            h = self.sha1_cache[key] = hashlib.sha1(synthetic_content(*key)).hexdigest()
+        return h
+
+    def get(self, item_id, type_=None):
+        item = self.items.get(item_id)
+        if item is None or (type_ and item['type'] != type_):
+            raise ApiError(404, 'not_found', f'Not Found: {type_ or "item"} {item_id}')
+        return item
+
+    def folder(self, item_id):
+        return self.get(item_id, 'folder')
+
+    def file(self, item_id):
+        return self.get(item_id, 'file')
+
+    def children(self, folder, sort=None, direction=None):
+        kids = [self.items[cid] for cid in folder['children']]
+        key = {'name': lambda it: it['name'].lower(),
+               'date': lambda it: it['modified_at'],
+               'size': lambda it: it['size']}.get(sort, lambda it: int(it['id']))
+        kids.sort(key=key, reverse=direction == 'DESC')
+        kids.sort(key=lambda it: it['type'] != 'folder')   # stable: folders first
+        return kids
+
+    def path(self, item):
+        entries = []
+        pid = item['parent_id']
+        while pid is not None:
+            parent = self.items[pid]
+            entries.append(parent)
+            pid = parent['parent_id']
+        entries.reverse()
+        return entries
+
+    def ancestors(self, item):
+        return {p['id'] for p in self.path(item)}
+
+    def move(self, item, parent_id=None, name=None):
+        old_parent = item['parent_id']
+        new_parent = parent_id or old_parent
+        target = self.folder(new_parent)
+        if item['type'] == 'folder' and (item['id'] == new_parent or item['id'] in self.ancestors(target)):
+            raise ApiError(400, 'bad_request', 'Cannot move a folder into itself')
+        self._check_name(target, name or item['name'], exclude=item['id'])
+        if name and name != item['name']:
+            item['name'] = name
+            self._event('ITEM_RENAME', item)
+        if new_parent != old_parent:
+            size = self.tree_size(item)
+            del self.items[old_parent]['children'][item['id']]
+            self._add_size(old_parent, -size)
+            target['children'][item['id']] = None
+            item['parent_id'] = new_parent
+            self._add_size(new_parent, size)
+            self._event('ITEM_MOVE', item)
+        item['etag'] = str(int(item['etag']) + 1)
+
+    def tree_size(self, item):
+        return item['size']
+
+    def copy(self, item, parent_id, name=None):
+        target = self.folder(parent_id)
+        name = name or item['name']
+        self._check_name(target, name)
+        if item['type'] == 'file':
+            f = self._new_item('file', name, parent_id)
+            self._set_content(f, item['data'], item['seed'], item['size'])
+            self._event('ITEM_COPY', f)
+            return f
+        folder = self._new_item('folder', name, parent_id)
+        for cid in list(item['children']):
+            self.copy(self.items[cid], folder['id'])
+        self._event('ITEM_COPY', folder)
+        return folder
+
+    def delete(self, item):
+        if item['id'] == '0':
+            raise ApiError(403, 'access_denied', 'Cannot delete the root folder')
+        parent_id = item['parent_id']
+        del self.items[parent_id]['children'][item['id']]
+        self._add_size(parent_id, -item['size'])
+        item['trashed_at'] = _timestamp()
+        item['subtree'] = self._detach(item, [])
+        self.trash[item['id']] = item
+        self._event('ITEM_TRASH', item)
+
+    def _detach(self, item, detached):
+        del self.items[item['id']]
+        for cid in item.get('children', ()):
+            detached.append(self.items[cid])
+            self._detach(self.items[cid], detached)
+        return detached
+
+    def restore(self, item_id, name=None, parent_id=None):
+        item = self.trash.get(item_id)
+        if item is None:
+            raise ApiError(404, 'not_found', 'Item not in trash')
+        parent_id = parent_id or item['parent_id']
+        if parent_id not in self.items:
+            parent_id = '0'
+        target = self.folder(parent_id)
+        self._check_name(target, name or item['name'])
+        del self.trash[item_id]
+        for it in [item] + item.pop('subtree'):
+            self.items[it['id']] = it
+        if name:
+            item['name'] = name
+        item['parent_id'] = parent_id
+        item['trashed_at'] = None
+        target['children'][item_id] = None
+        self._add_size(parent_id, item['size'])
+        self._event('ITEM_UNDELETE_VIA_TRASH', item)
+        return item
+
+    def purge(self, item_id):
+        if self.trash.pop(item_id, None) is None:
+            raise ApiError(404, 'not_found', 'Item not in trash')
+
+    def _event(self, event_type, item):
+        self.events.append({'type': 'event', 'event_id': str(len(self.events) + 1),
+                            'event_type': event_type, 'created_at': _timestamp(),
+                            'source': self.mini(item, with_parent=True)})
+
+    # JSON rendering {{{2
+
+    def mini(self, item, with_parent=False):
+        d = {'type': item['type'], 'id': item['id'], 'sequence_id': item['etag'],
+             'etag': item['etag'], 'name': item['name']}
+        if item['type'] == 'file':
+            d['sha1'] = self.sha1(item)
+            d['file_version'] = {'type': 'file_version', 'id': item['version_id'], 'sha1': d['sha1']}
+        if with_parent and item['parent_id'] is not None and item['parent_id'] in self.items:
+            d['parent'] = self.mini(self.items[item['parent_id']])
+        return d
+
+    def render(self, item, fields=None, limit=100):
+        def _want(field):
+            return fields is None or field in fields
+        d = {'type': item['type'], 'id': item['id'], 'etag': item['etag']}
+        def _set(field, value_func):
+            if _want(field):
+                d[field] = value_func()
+        _set('sequence_id', lambda: item['etag'])
+        _set('name', lambda: item['name'])
+        _set('description', lambda: item['description'])
+        _set('size', lambda: item['size'])
+        _set('created_at', lambda: item['created_at'])
+        _set('modified_at', lambda: item['modified_at'])
+        _set('trashed_at', lambda: item['trashed_at'])
+        _set('item_status', lambda: 'trashed' if item['trashed_at'] else 'active')
+        _set('shared_link', lambda: item['shared_link'])
+        _set('owned_by', lambda: OWNER)
+        _set('created_by', lambda: OWNER)
+        _set('modified_by', lambda: OWNER)
+        _set('parent', lambda: self.mini(self.items[item['parent_id']])
+                               if item['parent_id'] in self.items else None)
+        _set('path_collection', lambda: {'total_count': len(p := self.path(item)),
+                                         'entries': [self.mini(e) for e in p]})
+        if item['type'] == 'file':
+            _set('sha1', lambda: self.sha1(item))
+            _set('file_version', lambda: {'type': 'file_version', 'id': item['version_id'],
+                                          'sha1': self.sha1(item)})
+            _set('content_created_at', lambda: item['content_created_at'])
+            _set('content_modified_at', lambda: item['content_modified_at'])
+            _set('extension', lambda: os.path.splitext(item['name'])[1].lstrip('.'))
+        else:
+            _set('item_collection', lambda: self.page(item, None, 0, limit))
+        return d
+
+    def page(self, folder, fields, offset, limit, sort=None, direction=None):
+        kids = self.children(folder, sort, direction)
+        entries = [self.render(k, fields) if fields else self.mini(k) for k in kids[offset:offset+limit]]
+        return {'total_count': len(kids), 'entries': entries, 'offset': offset, 'limit': limit,
+                'order': [{'by': sort or 'type', 'direction': direction or 'ASC'}]}
+
+OWNER = {'type': 'user', 'id': '1', 'name': 'Fake User', 'login': 'fake@example.com'}
+
+# Synthetic tree generator {{{2
+
+# Populates `box` with `num_items` items under the root folder, deterministically from `seed`.
+#
+#   max_depth    : maximum folder nesting depth
+#   folder_ratio : fraction of generated items that are folders
+#   mean_size    : mean file size in bytes (sizes are exponentially distributed)
+#   dup_ratio    : fraction of files whose content duplicates an earlier file
+#   root_id      : the folder under which the tree is generated
+
+def generate_tree(box, num_items, seed=0, max_depth=6, folder_ratio=0.1, mean_size=4096,
+                  dup_ratio=0.05, root_id='0'):
+    rng = random.Random(seed)
+    folders = [(root_id, 0)]
+    contents = []
+    with box.lock:
+        for n in range(num_items):
+            parent_id, depth = folders[int(len(folders) * rng.random() ** 2)]
+            if rng.random() < folder_ratio and depth < max_depth:
+                folder = box._new_item('folder', f'dir-{n}', parent_id)
+                folders.append((folder['id'], depth + 1))
+            else:
+                name = f'{rng.choice(_WORDS)}-{n}.{rng.choice(_EXTENSIONS)}'
+                if contents and rng.random() < dup_ratio:
+                    cseed, size = rng.choice(contents)
+                else:
+                    cseed, size = (seed, n), int(rng.expovariate(1 / mean_size)) if mean_size else 0
+                    contents.append((cseed, size))
+                f = box._new_item('file', name, parent_id)
+                box._set_content(f, None, hash(cseed) & 0xffffffff, size)
+        box.events.clear()
+
+# HTTP handling {{{1
+
+class FakeBoxHandler(BaseHTTPRequestHandler):
+    server_version = "fakebox/0.1"
+    protocol_version = "HTTP/1.1"
+    # Responses are written in several pieces; with keep-alive, Nagle's algorithm would hold the
+    # last of them back until the client's delayed ACK, adding tens of milliseconds to each request.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):     self._dispatch('GET')
+    def do_POST(self):    self._dispatch('POST')
+    def do_PUT(self):     self._dispatch('PUT')
+    def do_DELETE(self):  self._dispatch('DELETE')
+    def do_OPTIONS(self): self._dispatch('OPTIONS')
+
+    def _dispatch(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        path = url.path
+        for prefix in ('/api/2.0', '/2.0'):
+            if path.startswith(prefix):
+                path = path[len(prefix):]
+                break
+        server.request_count += 1
+        try:
+            if server.latency:
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+            if server.throttle():
+                raise ApiError(429, 'rate_limit_exceeded', 'Request rate limit exceeded',
+                               headers={'Retry-After': '1'})
+            for regex, route_method, handler in ROUTES:
+                if route_method == method and (mo := regex.fullmatch(path)):
+                    with server.box.lock:
+                        result = handler(self, server.box, *mo.groups())
+                    break
+            else:
+                raise ApiError(404, 'not_found', f'No route for {method} {path}')
+            if isinstance(result, Response):
+                result.send(self)
+            else:
+                Response(result).send(self)
+        except ApiError as ex:
+            body = {'type': 'error', 'status': ex.status, 'code': ex.code, 'message': ex.message,
+                    'request_id': 'fake'}
+            if ex.context_info:
+                body['context_info'] = ex.context_info
+            Response(body, status=ex.status, headers=ex.headers).send(self)
+
+    @property
+    def base_url(self):
+        return self.server.base_url
+
+    def json_body(self):
+        return json.loads(self.body) if self.body else {}
+
+    def fields(self):
+        f = self.query.get('fields')
+        return set(f.split(',')) if f else None
+
+    def multipart(self):
+        ctype = self.headers['Content-Type']
+        msg = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + ctype.encode() + b'\r\n\r\n' + self.body)
+        return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                for part in msg.iter_parts()}
+
+# A response with either a JSON body or raw bytes, optionally delivered at a limited rate
+
+class Response:
+
+    def __init__(self, body=None, status=200, headers=None, raw=None, content_type='application/json'):
+        self.status = status
+        self.headers = headers or {}
+        if raw is not None:
+            self.data = raw
+            self.content_type = content_type
+        else:
+            self.data = b'' if body is None else json.dumps(body).encode()
+            self.content_type = 'application/json'
+
+    def send(self, handler):
+        handler.send_response(self.status)
+        handler.send_header('Content-Type', self.content_type)
+        handler.send_header('Content-Length', str(len(self.data)))
+        for k, v in self.headers.items():
+            handler.send_header(k, v)
+        handler.end_headers()
+        bandwidth = handler.server.bandwidth
+        if not bandwidth or self.content_type == 'application/json':
+            handler.wfile.write(self.data)
+        else:
+            step = max(1024, bandwidth // 20)
+            for i in range(0, len(self.data), step):
+                handler.wfile.write(self.data[i:i+step])
+                time.sleep(step / bandwidth)
+
+# Route handlers {{{2
+
+ROUTES = []
+
+def route(method, pattern):
+    def _decorator(func):
+        ROUTES.append((re.compile(pattern), method, func))
+        return func
+    return _decorator
+
+def _int_param(handler, name, default, maximum=None):
+    val = int(handler.query.get(name, default))
+    return min(val, maximum) if maximum else val
+
+@route('POST', r'/oauth2/token')
+def _oauth_token(handler, box):
+    return {'access_token': 'fake-access-' + box._new_id(), 'refresh_token': 'fake-refresh-' + box._new_id(),
+            'expires_in': 3600, 'token_type': 'bearer', 'restricted_to': []}
+
+@route('GET', r'/users/me')
+def _users_me(handler, box):
+    return dict(OWNER, space_amount=10**12, space_used=box.items['0']['size'])
+
+@route('GET', r'/folders/(\w+)')
+def _get_folder(handler, box, folder_id):
+    return box.render(box.folder(folder_id), handler.fields())
+
+@route('GET', r'/folders/(\w+)/items')
+def _get_folder_items(handler, box, folder_id):
+    folder = box.folder(folder_id)
+    return box.page(folder, handler.fields(), _int_param(handler, 'offset', 0),
+                    _int_param(handler, 'limit', 100, 1000),
+                    handler.query.get('sort'), handler.query.get('direction'))
+
+@route('POST', r'/folders')
+def _create_folder(handler, box):
+    body = handler.json_body()
+    return Response(box.render(box.create_folder(body['parent']['id'], body['name'])), status=201)
+
+@route('GET', r'/files/(\w+)')
+def _get_file(handler, box, file_id):
+    f = box.file(file_id)
+    fields = handler.fields()
+    if fields and 'representations' in fields:
+        return {'type': 'file', 'id': file_id, 'etag': f['etag'],
+                'representations': {'entries': _representations(handler, box, f)}}
+    return box.render(f, fields)
+
+@route('GET', r'/files/(\w+)/content')
+def _get_content(handler, box, file_id):
+    f = box.file(file_id)
+    data = box.content(f, handler.query.get('version'))
+    if rng := handler.headers.get('Range'):
+        mo = re.fullmatch(r'bytes=(\d*)-(\d*)', rng.strip())
+        if not mo:
+            raise ApiError(416, 'requested_range_not_satisfiable', 'Bad range')
+        size = len(data)
+        if mo[1]:
+            start = int(mo[1])
+            end = min(int(mo[2]), size - 1) if mo[2] else size - 1
+        else:
+            start, end = max(0, size - int(mo[2])), size - 1
+        if start >= size and size:
+            raise ApiError(416, 'requested_range_not_satisfiable', 'Range not satisfiable')
+        return Response(raw=data[start:end+1], status=206, content_type='application/octet-stream',
+                        headers={'Content-Range': f'bytes {start}-{end}/{size}'})
+    return Response(raw=data, content_type='application/octet-stream')
+
+@route('OPTIONS', r'/files/content')
+def _preflight(handler, box):
+    body = handler.json_body()
+    box._check_name(box.folder(body['parent']['id']), body['name'])
+    return {'upload_url': handler.base_url + '/api/2.0/files/content', 'upload_token': None}
+
+@route('POST', r'/files/content')
+def _upload(handler, box):
+    parts = handler.multipart()
+    attributes = json.loads(parts['attributes'])
+    f = box.create_file(attributes['parent']['id'], attributes['name'], data=parts['file'])
+    return Response({'total_count': 1, 'entries': [box.render(f)]}, status=201)
+
+@route('POST', r'/files/(\w+)/content')
+def _upload_version(handler, box, file_id):
+    parts = handler.multipart()
+    attributes = json.loads(parts.get('attributes') or '{}')
+    f = box.new_version(file_id, parts['file'], attributes.get('name'))
+    return Response({'total_count': 1, 'entries': [box.render(f)]}, status=201)
+
+@route('PUT', r'/(file|folder)s/(\w+)')
+def _update_item(handler, box, type_, item_id):
+    item = box.get(item_id, type_)
+    body = handler.json_body()
+    if 'parent' in body or 'name' in body:
+        box.move(item, body.get('parent', {}).get('id'), body.get('name'))
+    if 'description' in body:
+        item['description'] = body['description']
+    if 'shared_link' in body:
+        if body['shared_link'] is None:
+            item['shared_link'] = None
+        else:
+            url = f"{handler.base_url}/s/{item_id}"
+            item['shared_link'] = {'url': url, 'download_url': url + '/download',
+                                   'access': body['shared_link'].get('access', 'open')}
+    return box.render(item, handler.fields())
+
+@route('POST', r'/(file|folder)s/(\w+)/copy')
+def _copy_item(handler, box, type_, item_id):
+    body = handler.json_body()
+    return Response(box.render(box.copy(box.get(item_id, type_), body['parent']['id'], body.get('name'))),
+                    status=201)
+
+@route('DELETE', r'/(file|folder)s/(\w+)')
+def _delete_item(handler, box, type_, item_id):
+    item = box.get(item_id, type_)
+    if type_ == 'folder' and item['children'] and handler.query.get('recursive') != 'true':
+        raise ApiError(400, 'folder_not_empty', 'Folder is not empty')
+    box.delete(item)
+    return Response(status=204)
+
+# Representations {{{2
+
+_REPRESENTATIONS = {
+    'extracted_text': ('extracted_text', '.pdf .docx .doc .pptx .xlsx .txt .md .csv .log'),
+    'jpg_thumb_32x32': ('jpg', '*'),
+    'jpg_1024x1024': ('jpg', '.pdf .docx .jpg .png'),
+    'png_paged_2048x2048': ('png', '.pdf .docx .pptx'),
+}
+
+def _representations(handler, box, f):
+    ext = os.path.splitext(f['name'])[1].lower()
+    base = f"{handler.base_url}/2.0/internal_files/{f['id']}/versions/{f['version_id']}/representations"
+    entries = []
+    for name, (repformat, exts) in _REPRESENTATIONS.items():
+        if exts == '*' or ext in exts.split():
+            entries.append({'representation': repformat,
+                            'properties': {'paged': 'true'} if 'paged' in name else {},
+                            'info': {'url': f'{base}/{name}'},
+                            'status': {'state': 'pending'},
+                            'content': {'url_template': f'{base}/{name}/content/{{+asset_path}}'}})
+    return entries
+
+@route('GET', r'/internal_files/(\w+)/versions/(\w+)/representations/(\w+)')
+def _representation_info(handler, box, file_id, version_id, name):
+    f = box.file(file_id)
+    key = (file_id, version_id, name)
+    polls = box.repr_polls[key] = box.repr_polls.get(key, 0) + 1
+    state = 'pending' if polls <= box.pending_polls else 'success'
+    base = handler.base_url + handler.path.split('?')[0]
+    info = {'representation': name, 'status': {'state': state},
+            'content': {'url_template': base + '/content/{+asset_path}'}, 'metadata': {}}
+    if 'paged' in name:
+        info['metadata']['pages'] = 1 + f['size'] // 2048
+    return info
+
+@route('GET', r'/internal_files/(\w+)/versions/(\w+)/representations/(\w+)/content/(.*)')
+def _representation_content(handler, box, file_id, version_id, name, asset_path):
+    f = box.file(file_id)
+    if name == 'extracted_text':
+        return Response(raw=box.content(f), content_type='text/plain')
+    return Response(raw=f"{name}:{file_id}:{asset_path}".encode(), content_type='image/' + name[:3])
+
+# Chunked upload sessions {{{2
+
+@route('POST', r'/files/upload_sessions')
+def _create_upload_session(handler, box):
+    body = handler.json_body()
+    box._check_name(box.folder(body['folder_id']), body['file_name'])
+    return Response(_new_upload_session(handler, box, body), status=201)
+
+@route('POST', r'/files/(\w+)/upload_sessions')
+def _create_version_upload_session(handler, box, file_id):
+    body = handler.json_body()
+    box.file(file_id)
+    body['file_id'] = file_id
+    return Response(_new_upload_session(handler, box, body), status=201)
+
+def _new_upload_session(handler, box, body):
+    session_id = 'S' + box._new_id()
+    size = int(body['file_size'])
+    box.upload_sessions[session_id] = dict(body, parts={})
+    total_parts = max(1, -(-size // box.part_size))
+    base = f"{handler.base_url}/api/2.0/files/upload_sessions/{session_id}"
+    return {'type': 'upload_session', 'id': session_id, 'part_size': box.part_size,
+            'total_parts': total_parts, 'num_parts_processed': 0,
+            'session_expires_at': _timestamp(time.time() + 86400),
+            'session_endpoints': {'upload_part': base, 'commit': base + '/commit', 'abort': base,
+                                  'list_parts': base + '/parts', 'status': base}}
+
+def _upload_session(box, session_id):
+    if (session := box.upload_sessions.get(session_id)) is None:
+        raise ApiError(404, 'not_found', 'Upload session not found')
+    return session
+
+@route('PUT', r'/files/upload_sessions/(\w+)')
+def _upload_part(handler, box, session_id):
+    session = _upload_session(box, session_id)
+    mo = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', handler.headers.get('Content-Range', ''))
+    if not mo:
+        raise ApiError(400, 'bad_request', 'Missing Content-Range')
+    start, end, total = map(int, mo.groups())
+    data = handler.body
+    if total != int(session['file_size']) or end - start + 1 != len(data) or start % box.part_size:
+        raise ApiError(416, 'range_mismatch', 'Content-Range does not match the part')
+    if len(data) != box.part_size and end != total - 1:
+        raise ApiError(416, 'range_mismatch', 'Parts other than the last must be part_size bytes')
+    digest = hashlib.sha1(data).digest()
+    if (hdr := handler.headers.get('Digest')) and hdr != 'SHA=' + base64.b64encode(digest).decode():
+        raise ApiError(412, 'precondition_failed', 'Part digest mismatch')
+    part = {'part_id': f'{start:08X}', 'offset': start, 'size': len(data), 'sha1': digest.hex()}
+    session['parts'][start] = (part, data)
+    return {'part': part}
+
+@route('GET', r'/files/upload_sessions/(\w+)/parts')
+def _list_parts(handler, box, session_id):
+    parts = [p for p, _ in sorted(_upload_session(box, session_id)['parts'].values(), key=lambda p: p[0]['offset'])]
+    return {'entries': parts, 'total_count': len(parts), 'offset': 0, 'limit': 1000}
+
+@route('POST', r'/files/upload_sessions/(\w+)/commit')
+def _commit_upload_session(handler, box, session_id):
+    session = _upload_session(box, session_id)
+    data = b''.join(d for _, (p, d) in sorted(session['parts'].items()))
+    if len(data) != int(session['file_size']):
+        raise ApiError(400, 'bad_request', 'Uploaded parts do not cover the file')
+    digest = base64.b64encode(hashlib.sha1(data).digest()).decode()
+    if handler.headers.get('Digest') != 'SHA=' + digest:
+        raise ApiError(422, 'unprocessable_entity', 'Whole-file digest mismatch')
+    del box.upload_sessions[session_id]
+    if file_id := session.get('file_id'):
+        f = box.new_version(file_id, data, session.get('file_name'))
+    else:
+        f = box.create_file(session['folder_id'], session['file_name'], data=data)
+    return Response({'total_count': 1, 'entries': [box.render(f)]}, status=201)
+
+@route('DELETE', r'/files/upload_sessions/(\w+)')
+def _abort_upload_session(handler, box, session_id):
+    _upload_session(box, session_id)
+    del box.upload_sessions[session_id]
+    return Response(status=204)
+
+# Search, trash, versions, events, zip {{{2
+
+@route('GET', r'/search')
+def _search(handler, box):
+    q = handler.query
+    term = q.get('query', '').lower()
+    type_ = q.get('type')
+    exts = {'.' + e for e in q['file_extensions'].split(',')} if q.get('file_extensions') else None
+    ancestors = set(q['ancestor_folder_ids'].split(',')) if q.get('ancestor_folder_ids') else None
+    cutoff = time.time() - box.search_lag
+    offset, limit = _int_param(handler, 'offset', 0), _int_param(handler, 'limit', 30, 200)
+    matches = []
+    for item in box.items.values():
+        if item['id'] == '0' or item['created'] > cutoff or term not in item['name'].lower():
+            continue
+        if type_ and item['type'] != type_:
+            continue
+        if exts and os.path.splitext(item['name'])[1] not in exts:
+            continue
+        if ancestors and not ancestors & box.ancestors(item):
+            continue
+        matches.append(item)
+    fields = handler.fields()
+    return {'total_count': len(matches), 'offset': offset, 'limit': limit,
+            'entries': [box.render(it, fields) for it in matches[offset:offset+limit]]}
+
+@route('GET', r'/folders/trash/items')
+def _trash_items(handler, box):
+    items = list(box.trash.values())
+    offset, limit = _int_param(handler, 'offset', 0), _int_param(handler, 'limit', 100, 1000)
+    if handler.query.get('sort') == 'name':
+        items.sort(key=lambda it: it['name'].lower())
+    elif handler.query.get('sort') == 'date':
+        items.sort(key=lambda it: it['trashed_at'])
+    if handler.query.get('direction') == 'DESC':
+        items.reverse()
+    return {'total_count': len(items), 'offset': offset, 'limit': limit,
+            'entries': [box.render(it, handler.fields()) for it in items[offset:offset+limit]]}
+
+@route('GET', r'/(file|folder)s/(\w+)/trash')
+def _get_trashed(handler, box, type_, item_id):
+    if (item := box.trash.get(item_id)) is None:
+        raise ApiError(404, 'not_found', 'Item not in trash')
+    d = box.render(item, handler.fields())
+    d['parent'] = box.mini(box.items[item['parent_id']]) if item['parent_id'] in box.items else None
+    return d
+
+@route('POST', r'/(file|folder)s/(\w+)')
+def _restore(handler, box, type_, item_id):
+    body = handler.json_body()
+    item = box.restore(item_id, body.get('name'), body.get('parent', {}).get('id'))
+    return Response(box.render(item), status=201)
+
+@route('DELETE', r'/(file|folder)s/(\w+)/trash')
+def _purge(handler, box, type_, item_id):
+    box.purge(item_id)
+    return Response(status=204)
+
+def _version_json(v):
+    return {'type': 'file_version', 'id': v['id'], 'sha1': v['sha1'], 'name': v['name'], 'size': v['size'],
+            'created_at': v['created_at'], 'modified_at': v['modified_at'], 'trashed_at': v['trashed_at']}
+
+@route('GET', r'/files/(\w+)/versions')
+def _versions(handler, box, file_id):
+    versions = list(reversed(box.file(file_id)['versions']))
+    offset, limit = _int_param(handler, 'offset', 0), _int_param(handler, 'limit', 1000, 1000)
+    return {'total_count': len(versions), 'offset': offset, 'limit': limit,
+            'entries': [_version_json(v) for v in versions[offset:offset+limit]]}
+
+def _find_version(box, file_id, version_id):
+    for v in box.file(file_id)['versions']:
+        if v['id'] == version_id:
+            return v
+    raise ApiError(404, 'not_found', 'Version not found')
+
+@route('DELETE', r'/files/(\w+)/versions/(\w+)')
+def _delete_version(handler, box, file_id, version_id):
+    _find_version(box, file_id, version_id)['trashed_at'] = _timestamp()
+    return Response(status=204)
+
+@route('PUT', r'/files/(\w+)/versions/(\w+)')
+def _restore_version(handler, box, file_id, version_id):
+    v = _find_version(box, file_id, version_id)
+    v['trashed_at'] = None
+    return _version_json(v)
+
+@route('POST', r'/files/(\w+)/versions/current')
+def _promote_version(handler, box, file_id):
+    v = _find_version(box, file_id, handler.json_body()['id'])
+    f = box.file(file_id)
+    data = box.content(f, v['id'])
+    box.new_version(file_id, data)
+    return Response(_version_json(dict(v, id=f['version_id'], name=f['name'])), status=201)
+
+@route('GET', r'/events')
+def _events(handler, box):
+    pos = handler.query.get('stream_position', '0')
+    if pos == 'now':
+        return {'chunk_size': 0, 'next_stream_position': len(box.events), 'entries': []}
+    start = int(pos)
+    limit = _int_param(handler, 'limit', 100, 500)
+    entries = box.events[start:start+limit]
+    return {'chunk_size': len(entries), 'next_stream_position': start + len(entries), 'entries': entries}
+
+@route('POST', r'/zip_downloads')
+def _create_zip(handler, box):
+    body = handler.json_body()
+    zip_id = 'Z' + box._new_id()
+    box.zips[zip_id] = body
+    base = f"{handler.base_url}/2.0/zip_downloads/{zip_id}"
+    return Response({'download_url': base + '/content', 'status_url': base + '/status',
+                     'expires_at': _timestamp(time.time() + 600), 'name_conflicts': []}, status=202)
+
+def _zip_walk(box, item, prefix):
+    if item['type'] == 'file':
+        yield prefix + item['name'], item
+    elif item['type'] == 'folder':
+        for child in box.children(item):
+            yield from _zip_walk(box, child, prefix + item['name'] + '/')
+
+@route('GET', r'/zip_downloads/(\w+)/content')
+def _zip_content(handler, box, zip_id):
+    request = box.zips[zip_id]
+    buf = io.BytesIO()
+    count = 0
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for entry in request['items']:
+            for path, f in _zip_walk(box, box.get(entry['id'], entry['type']), ''):
+                zf.writestr(path, box.content(f))
+                count += 1
+    request['count'] = count
+    return Response(raw=buf.getvalue(), content_type='application/zip')
+
+@route('GET', r'/zip_downloads/(\w+)/status')
+def _zip_status(handler, box, zip_id):
+    count = box.zips[zip_id].get('count', 0)
+    return {'total_file_count': count, 'downloaded_file_count': count, 'skipped_file_count': 0,
+            'skipped_folder_count': 0, 'state': 'succeeded'}
+
+# Server {{{1
+
+class FakeBoxServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # latency    : seconds added to every request, plus up to `jitter` random seconds
+    # rate_limit : requests per second allowed before responding 429 (0 = unlimited)
+    # bandwidth  : bytes per second for content downloads (0 = unlimited)
+
+    def __init__(self, box, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, rate_limit=0,
+                 bandwidth=0, verbose=False):
+        super().__init__(address, FakeBoxHandler)
+        self.box = box
+        self.latency, self.jitter = latency, jitter
+        self.rate_limit = rate_limit
+        self.bandwidth = bandwidth
+        self.verbose = verbose
+        self.request_count = 0
+        self._tokens, self._token_time = float(rate_limit), time.monotonic()
+        self._throttle_lock = threading.Lock()
+        self.base_url = f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    # Returns True if the request should be throttled
+    def throttle(self):
+        if not self.rate_limit:
+            return False
+        with self._throttle_lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._token_time) * self.rate_limit)
+            self._token_time = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+# Starts a server in a daemon thread and returns it; its API lives at server.base_url
+
+def start_server(box=None, **kwargs):
+    server = FakeBoxServer(box or FakeBox(), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    cli_parser = argparse.ArgumentParser(prog='fakebox', description='Run a local stand-in for the Box API')
+    cli_parser.add_argument('-p', '--port', type=int, default=18555, help='Port to listen on (default %(default)s)')
+    cli_parser.add_argument('-n', '--num-items', type=int, default=1000,
+                            help='Number of synthetic items to generate (default %(default)s)')
+    cli_parser.add_argument('-s', '--seed', type=int, default=0, help='Seed for the synthetic tree')
+    cli_parser.add_argument('-D', '--max-depth', type=int, default=6, help='Maximum folder depth')
+    cli_parser.add_argument('-z', '--mean-size', type=int, default=4096, help='Mean file size in bytes')
+    cli_parser.add_argument('-l', '--latency', type=float, default=0.0, help='Seconds of latency per request')
+    cli_parser.add_argument('-j', '--jitter', type=float, default=0.0, help='Random extra latency, in seconds')
+    cli_parser.add_argument('-r', '--rate-limit', type=float, default=0,
+                            help='Requests per second before responding 429 (default unlimited)')
+    cli_parser.add_argument('-b', '--bandwidth', type=int, default=0, help='Download bytes per second')
+    cli_parser.add_argument('-P', '--part-size', type=int, default=8*1024*1024,
+                            help='Part size for chunked upload sessions')
+    cli_parser.add_argument('-S', '--search-lag', type=float, default=0.0,
+                            help='Seconds before new items appear in search results')
+    cli_parser.add_argument('-v', '--verbose', action='store_true', help='Log requests to stderr')
+    options = cli_parser.parse_args()
+    box = FakeBox(part_size=options.part_size, search_lag=options.search_lag)
+    generate_tree(box, options.num_items, seed=options.seed, max_depth=options.max_depth,
+                  mean_size=options.mean_size)
+    server = FakeBoxServer(box, ('127.0.0.1', options.port), latency=options.latency, jitter=options.jitter,
+                           rate_limit=options.rate_limit, bandwidth=options.bandwidth, verbose=options.verbose)
+    print(f"Serving {options.num_items} synthetic items at {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import os
+import tempfile
+import threading
+import time
+
+# A small metrics registry that can be written out in the Prometheus text exposition format, for
+# node_exporter's textfile collector (https://github.com/prometheus/node_exporter#textfile-collector).
+#
+# Metrics are created through a MetricsRegistry, and values for a particular set of label values
+# are updated through metric.labels(...), as with the official Prometheus client:
+#
+#   requests = registry.counter('requests_total', 'Requests made', ('method',))
+#   requests.labels('GET').inc()
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}   # tuple of label values -> child
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        values = tuple(str(v) for v in values)
+        with self.lock:
+            if (child := self.children.get(values)) is None:
+                child = self.children[values] = self._new_child()
+            return child
+
+    def _label_str(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            children = sorted(self.children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+class _Value:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+class Counter(_Metric):
+    kind = 'counter'
+    _new_child = _Value
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_str(values)} {_format_value(child.value)}"]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        with child.lock:
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._label_str(values, [('le', _format_value(bound))])} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_bucket{self._label_str(values, [('le', '+Inf')])} {child.count}")
+            lines.append(f"{self.name}_sum{self._label_str(values)} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{self._label_str(values)} {child.count}")
+        return lines
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    # Writes the metrics to `path` atomically, so that a collector never reads a partial file.
+    # The temporary file doesn't end in .prom, so node_exporter ignores it.
+    def write(self, path):
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmppath, 0o644)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+# The metrics boxcli reports. An instance is also an observer of an ObservedNetwork (see
+# network.py), through which it counts API requests, throttled requests, and retries.
+
+class BoxMetrics(MetricsRegistry):
+    def __init__(self):
+        super().__init__()
+        self.api_requests = self.counter(
+            'boxcli_api_requests_total', 'Box API requests made, by response status',
+            ('method', 'endpoint', 'status'))
+        self.api_request_seconds = self.histogram(
+            'boxcli_api_request_duration_seconds', 'Latency of Box API requests',
+            ('method', 'endpoint'))
+        self.api_throttles = self.counter(
+            'boxcli_api_throttled_total', 'Box API requests rejected with 429 Too Many Requests')
+        self.api_retries = self.counter(
+            'boxcli_api_retries_total', 'Box API requests retried after an error or throttling')
+        self.transfer_bytes = self.counter(
+            'boxcli_transfer_bytes_total', 'Bytes of file content transferred', ('direction',))
+        self.commands = self.counter(
+            'boxcli_commands_total', 'Commands run, by outcome', ('command', 'outcome'))
+        self.command_seconds = self.histogram(
+            'boxcli_command_duration_seconds', 'Time taken by commands', ('command',))
+        self.last_run = self.gauge(
+            'boxcli_last_run_timestamp_seconds', 'When the run that wrote these metrics finished')
+        self.api_throttles.labels()
+        self.api_retries.labels()
+
+    def request_finished(self, record):
+        self.api_requests.labels(record.method, record.endpoint, record.status or 'error').inc()
+        self.api_request_seconds.labels(record.method, record.endpoint).observe(record.latency)
+        if record.status == 429:
+            self.api_throttles.labels().inc()
+
+    def request_retried(self, delay):
+        self.api_retries.labels().inc()
+
+    def write(self, path):
+        self.last_run.labels().set(time.time())
+        super().write(path)
@@ -0,0 +1,162 @@
+import contextvars
+import re
+import threading
+import time
+from collections import namedtuple
+
+from boxsdk.network.default_network import DefaultNetwork
+
+# One completed API request, as reported to observers of an ObservedNetwork.
+#
+#   endpoint   : the URL path with item IDs replaced by {id}, e.g. "/2.0/folders/{id}/items"
+#   status     : the HTTP status code, or None if the request raised an exception
+#   bytes_sent : the size of the request body, if known
+#   bytes_recv : the Content-Length of the response, if given
+#   latency    : seconds until the response headers arrived (streamed bodies are read later)
+
+RequestRecord = namedtuple('RequestRecord',
+                           'method url endpoint status bytes_sent bytes_recv start latency thread_id')
+
+_ID_SEGMENT_REGEX = re.compile(r'/(?:\d+|[0-9A-Fa-f]{16,})(?=/|$)')
+
+def endpoint_for_url(url):
+    path = re.sub(r'^\w+://[^/]+', '', url).split('?', 1)[0]
+    return _ID_SEGMENT_REGEX.sub('/{id}', path)
+
+def _body_size(kwargs):
+    data = kwargs.get('data')
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    return getattr(data, 'len', 0) or 0
+
+# Observers of just the requests made in the current context, and by worker threads that run in
+# copies of it, like those of a command run with --profile. They're told about requests in
+# addition to an ObservedNetwork's own observers.
+
+context_observers = contextvars.ContextVar('context_observers', default=())
+
+# A DefaultNetwork that tells its observers about every request it makes. `observers` is a list
+# that the owner may change at any time (from the thread that issues commands); each observer may
+# implement any of:
+#
+#   request_started()            - called before a request is sent
+#   request_finished(record)     - called with a RequestRecord when the request completes or fails
+#   request_retried(delay)       - called when boxsdk is about to retry a request after `delay` secs
+#
+# Observers are called on whatever thread made the request, so they must be thread-safe.
+#
+# If a RequestScheduler (see scheduler.py) is given, each request (and each retry of it) waits
+# for a slot from it before the observers are told it started.
+#
+# Subclasses that change how requests are carried out (see cassette.py) override _send().
+
+class ObservedNetwork(DefaultNetwork):
+    def __init__(self, observers, scheduler=None):
+        super().__init__()
+        self.observers = observers
+        self.scheduler = scheduler
+
+    def _notify(self, method, *args, observers=None):
+        if observers is None:
+            observers = tuple(self.observers) + context_observers.get()
+        for observer in observers:
+            if (func := getattr(observer, method, None)):
+                func(*args)
+
+    def _send(self, method, url, access_token, **kwargs):
+        return super().request(method, url, access_token, **kwargs)
+
+    def request(self, method, url, access_token, **kwargs):
+        if self.scheduler is None:
+            return self._observed_request(method, url, access_token, **kwargs)
+        with self.scheduler.slot():
+            return self._observed_request(method, url, access_token, **kwargs)
+
+    def _observed_request(self, method, url, access_token, **kwargs):
+        # The observers told that a request started are the ones told that it finished, even if
+        # the list changes in the meantime.
+        observers = tuple(self.observers) + context_observers.get()
+        if not observers:
+            return self._send(method, url, access_token, **kwargs)
+        self._notify('request_started', observers=observers)
+        start = time.time()
+        t0 = time.monotonic()
+        status, bytes_recv = None, 0
+        try:
+            response = self._send(method, url, access_token, **kwargs)
+            status = response.status_code
+            bytes_recv = int(response.headers.get('Content-Length') or 0)
+            return response
+        finally:
+            record = RequestRecord(method.upper(), url, endpoint_for_url(url), status, _body_size(kwargs),
+                                   bytes_recv, start, time.monotonic() - t0, threading.get_ident())
+            self._notify('request_finished', record, observers=observers)
+
+    def retry_after(self, delay, request_method, *args, **kwargs):
+        self._notify('request_retried', delay)
+        return super().retry_after(delay, request_method, *args, **kwargs)
+
+# An observer that gathers per-endpoint statistics for `--profile`.
+#
+# Besides the total time spent in requests (which can exceed the wall time when requests run
+# concurrently), it tracks `network_time`: the wall time during which at least one request was
+# in flight.
+
+class RequestProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.endpoints = {}   # (method, endpoint) -> dict of counts and totals
+        self.retries = 0
+        self.in_flight = 0
+        self.busy_since = None
+        self.past_network_time = 0.0
+
+    def request_started(self):
+        with self.lock:
+            if self.in_flight == 0:
+                self.busy_since = time.monotonic()
+            self.in_flight += 1
+
+    def request_finished(self, record):
+        with self.lock:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.past_network_time += time.monotonic() - self.busy_since
+            stats = self.endpoints.setdefault((record.method, record.endpoint),
+                                              {'calls': 0, 'errors': 0, 'time': 0.0, 'max': 0.0,
+                                               'sent': 0, 'recv': 0})
+            stats['calls'] += 1
+            if record.status is None or record.status >= 400:
+                stats['errors'] += 1
+            stats['time'] += record.latency
+            stats['max'] = max(stats['max'], record.latency)
+            stats['sent'] += record.bytes_sent
+            stats['recv'] += record.bytes_recv
+
+    def request_retried(self, delay):
+        with self.lock:
+            self.retries += 1
+
+    # Includes the current period of activity, if requests are still in flight
+    @property
+    def network_time(self):
+        with self.lock:
+            current = time.monotonic() - self.busy_since if self.in_flight else 0.0
+            return self.past_network_time + current
+
+    @property
+    def wall_time(self):
+        return time.monotonic() - self.start
+
+    @property
+    def num_requests(self):
+        return sum(stats['calls'] for stats in self.endpoints.values())
+
+    @property
+    def request_time(self):
+        return sum(stats['time'] for stats in self.endpoints.values())
+
+    # Returns a list of ((method, endpoint), stats) sorted by total time, most first
+    def endpoint_stats(self):
+        return sorted(self.endpoints.items(), key=lambda kv: kv[1]['time'], reverse=True)
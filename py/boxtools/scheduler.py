@@ -0,0 +1,104 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Priority classes of API requests, most urgent first. `request_priority` holds the class of the
+# requests made in the current context: whatever starts background work sets it in the thread
+# doing that work, and worker threads inherit it by running in copies of that thread's context.
+#
+#   interactive : commands the user is waiting on (the default)
+#   background  : shell jobs
+#   prefetch    : listings fetched by the shell in case they're wanted next
+
+PRIORITY_CLASSES = ('interactive', 'background', 'prefetch')
+
+request_priority = contextvars.ContextVar('request_priority', default='interactive')
+
+# If set to a list, the seconds each request made in the current context waited for its slot are
+# appended to it, so that the caller can tell time spent queueing from time spent on the network.
+request_waits = contextvars.ContextVar('request_waits', default=None)
+
+# Decides when each API request may be sent, so that bulk work in the background can't starve
+# the requests of an interactive command.
+#
+# At most `max_requests` requests are in flight at once, and, if `rate` is nonzero, no more than
+# `rate` are started per second (with bursts of up to a second's worth). Each priority class may
+# also have fewer in flight than that, as given by `budgets` (class -> max requests). When the
+# shared limits are reached, waiting requests are admitted by weighted fair queueing: the class
+# whose admitted requests, divided by its weight in `weights`, are fewest goes next, so that each
+# busy class gets a share of the capacity in proportion to its weight, and an idle class can't
+# bank credit to swamp the others later. Requests of the same class are admitted in FIFO order.
+#
+# A request holds its slot until its response headers arrive, or for uploads until the body has
+# been sent; the body of a streamed download is read after its slot is released.
+
+class RequestScheduler:
+    def __init__(self, max_requests, budgets=None, weights=None, rate=0):
+        self.cond = threading.Condition()
+        self.max_requests = max_requests
+        self.budgets = {c: (budgets or {}).get(c) or max_requests for c in PRIORITY_CLASSES}
+        self.weights = {c: (weights or {}).get(c, 1) for c in PRIORITY_CLASSES}
+        self.rate = rate
+        self.allowance = max(1.0, rate)
+        self.last = time.monotonic()
+        self.queues = {c: deque() for c in PRIORITY_CLASSES}     # tickets of waiting requests
+        self.in_flight = {c: set() for c in PRIORITY_CLASSES}    # tickets of admitted requests
+        self.vtime = dict.fromkeys(PRIORITY_CLASSES, 0.0)   # admitted requests / weight
+
+    # Returns the class whose first waiting request should be admitted next, or None
+    def _next_class(self):
+        if sum(len(tickets) for tickets in self.in_flight.values()) >= self.max_requests:
+            return None
+        candidates = [c for c in PRIORITY_CLASSES if self.queues[c] and len(self.in_flight[c]) < self.budgets[c]]
+        return min(candidates, key=self.vtime.get, default=None)   # ties go to the more urgent
+
+    # Takes one request's worth of the rate allowance, returning 0; or if there isn't enough,
+    # returns how long to wait until there is.
+    def _take_allowance(self):
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.allowance = min(max(1.0, self.rate), self.allowance + (now - self.last) * self.rate)
+        self.last = now
+        if self.allowance < 1.0:
+            return (1.0 - self.allowance) / self.rate
+        self.allowance -= 1.0
+        return 0
+
+    # A request's ticket is always in its class's queue or its in_flight set (or, for a moment, in
+    # neither), and is taken out of both when the slot is given up, so that even an exception raised
+    # asynchronously in the request's thread (see Job.kill() in cli.py) can't leak a slot.
+    @contextmanager
+    def slot(self):
+        priority = request_priority.get()
+        queue, in_flight = self.queues[priority], self.in_flight[priority]
+        ticket = object()
+        t0 = time.monotonic()
+        try:
+            with self.cond:
+                if not queue:
+                    backlogged = [self.vtime[c] for c in PRIORITY_CLASSES if self.queues[c]]
+                    self.vtime[priority] = max(self.vtime[priority], min(backlogged, default=0.0))
+                queue.append(ticket)
+                while True:
+                    if queue[0] is ticket and self._next_class() == priority:
+                        if (delay := self._take_allowance()) == 0:
+                            break
+                        self.cond.wait(delay)
+                    else:
+                        self.cond.wait()
+                in_flight.add(ticket)
+                queue.popleft()
+                self.vtime[priority] += 1 / self.weights[priority]
+                self.cond.notify_all()
+            if (waits := request_waits.get()) is not None:
+                waits.append(time.monotonic() - t0)
+            yield
+        finally:
+            with self.cond:
+                in_flight.discard(ticket)
+                if ticket in queue:
+                    queue.remove(ticket)
+                self.cond.notify_all()
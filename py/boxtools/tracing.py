@@ -0,0 +1,88 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Records a timeline of what a command does, and writes it in the Chrome Trace Event format
+# (https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h8I0nSsKchNAySU), which can be
+# opened offline in chrome://tracing or https://ui.perfetto.dev.
+#
+# Each span becomes a "complete" event on the track of the thread that ran it, so work done by
+# worker threads shows up on tracks of its own. A Tracer is also an observer of an ObservedNetwork
+# (see network.py), which adds a span for every API request.
+
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.events = []
+        self.thread_names = {}   # thread ID -> name
+
+    def _thread_id(self):
+        tid = threading.get_ident()
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+        return tid
+
+    # Adds a span, on the current thread's track, that started at `start` (from time.time()) and
+    # lasted `duration` seconds
+    def add_span(self, name, cat, start, duration, args=None):
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid,
+                 'ts': round(start * 1e6), 'dur': round(duration * 1e6)}
+        if args:
+            event['args'] = args
+        with self.lock:
+            event['tid'] = self._thread_id()
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        start = time.time()
+        t0 = time.monotonic()
+        try:
+            yield args
+        finally:
+            self.add_span(name, cat, start, time.monotonic() - t0, args=args)
+
+    # ObservedNetwork observer methods
+
+    def request_finished(self, record):
+        args = {'url': record.url, 'status': record.status}
+        if record.bytes_sent:
+            args['bytes_sent'] = record.bytes_sent
+        if record.bytes_recv:
+            args['bytes_recv'] = record.bytes_recv
+        self.add_span(f"{record.method} {record.endpoint}", 'api', record.start, record.latency, args)
+
+    def request_retried(self, delay):
+        with self.lock:
+            tid = self._thread_id()
+            self.events.append({'name': 'retry', 'cat': 'api', 'ph': 'i', 's': 't', 'pid': self.pid,
+                                'tid': tid, 'ts': round(time.time() * 1e6), 'args': {'delay': delay}})
+
+    def write(self, path):
+        with self.lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                        for tid, name in self.thread_names.items()]
+            metadata.append({'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': 0,
+                             'args': {'name': 'boxcli'}})
+            events = sorted(self.events, key=lambda e: e['ts'])
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+
+# The Tracer for the command being traced, if any. It's a context variable, so that it covers the
+# worker threads of the traced command but not other commands running at the same time. Code that
+# wants its work to appear in the trace wraps it in `with span(...)`, which does nothing when no
+# trace is being recorded.
+
+active_tracer = contextvars.ContextVar('active_tracer', default=None)
+
+@contextmanager
+def span(name, cat, **args):
+    if (tracer := active_tracer.get()) is None:
+        yield args
+    else:
+        with tracer.span(name, cat, **args) as span_args:
+            yield span_args
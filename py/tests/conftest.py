@@ -0,0 +1,55 @@
+import os, sys, json, threading, subprocess
+import pytest
+
+# Tests run boxcli against an in-process fakebox (see boxtools/fakebox.py), with a throwaway
+# configuration directory set up the same way `python -m boxtools.bench` does.
+
+PY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PY_DIR)
+
+from boxtools.fakebox import FakeBox, FakeBoxServer
+
+@pytest.fixture
+def fakebox():
+    box = FakeBox()
+    server = FakeBoxServer(box, ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield box, server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def boxcli_env(fakebox, tmp_path):
+    _, server = fakebox
+    config_dir = tmp_path / 'config'
+    config_dir.mkdir()
+    with open(os.path.join(PY_DIR, 'resources/boxtools.toml')) as f:
+        config = f.read().replace('(your client-id)', 'test').replace('(your client-secret)', 'test')
+    (config_dir / 'boxtools.toml').write_text(config)
+    (config_dir / 'auth-tokens.json').write_text(json.dumps({'access_token': 'test', 'refresh_token': 'test'}))
+    env = dict(os.environ, BOXTOOLS_APP_DIR=PY_DIR, BOXTOOLS_DIR=str(config_dir), BOXTOOLS_PROGNAME='boxcli',
+               BOXTOOLS_API_URL=server.base_url)
+    env.pop('BOXTOOLS_AUTH_NAME', None)
+    env['PYTHONPATH'] = PY_DIR + (os.pathsep + env['PYTHONPATH'] if env.get('PYTHONPATH') else '')
+    return env
+
+# Returns a function that runs boxcli with `args`, feeding it `input` (shell commands, when no
+# args are given), and returns the CompletedProcess, whose stdout and stderr are bytes.
+@pytest.fixture
+def boxcli(boxcli_env):
+    def run(*args, input=b'', timeout=60):
+        if isinstance(input, str):
+            input = input.encode()
+        return subprocess.run([sys.executable, '-m', 'boxtools.cli', *args], input=input, env=boxcli_env,
+                              capture_output=True, timeout=timeout)
+    return run
+
+# Runs the Python `code` in a subprocess with the same environment boxcli gets, and returns its
+# CompletedProcess (output as text)
+@pytest.fixture
+def run_python(boxcli_env):
+    def run(code, timeout=60):
+        return subprocess.run([sys.executable, '-c', code], env=boxcli_env, capture_output=True, text=True,
+                              timeout=timeout)
+    return run
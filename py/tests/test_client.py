@@ -0,0 +1,24 @@
+import textwrap
+
+def test_ops_client_created_once(run_python):
+    # Many threads asking for the client at once should all get the same one, and only one should
+    # be created (with its own network layer and scheduler).
+    result = run_python(textwrap.dedent('''
+        import sys, time, threading
+        sys.argv = ['boxcli']
+        from boxtools import auth, cli
+        calls = []
+        real_get_client = auth.get_client
+        def slow_get_client(*args, **kwargs):
+            calls.append(1)
+            time.sleep(0.2)
+            return real_get_client(*args, **kwargs)
+        auth.get_client = slow_get_client
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(cli.get_ops_client())) for _ in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        print(len(calls), len({id(c) for c in clients}))
+    '''))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ['1', '1']
@@ -0,0 +1,44 @@
+import textwrap
+
+def test_jobs_share_one_scheduler(run_python):
+    # Jobs started before any foreground command has created the client must still end up
+    # sharing one client, and so one RequestScheduler.
+    result = run_python(textwrap.dedent('''
+        import sys
+        sys.argv = ['boxcli']
+        from boxtools import cli, scheduler
+        schedulers = []
+        class CountedScheduler(scheduler.RequestScheduler):
+            def __init__(self, *args, **kwargs):
+                schedulers.append(self)
+                super().__init__(*args, **kwargs)
+        scheduler.RequestScheduler = CountedScheduler
+        jobs = [cli.start_job(['ls', '0']) for _ in range(4)]
+        for job in jobs:
+            job.thread.join()
+        print(len(schedulers), *(job.state for job in jobs))
+    '''))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines()[-1].split() == ['1'] + ['Done'] * 4
+
+# Not valid UTF-8, and no trailing newline (which has `cat` check whether stdout is a terminal)
+BINARY_DATA = bytes(range(256)) * 4 + b'\xff\xfe\x80 no newline'
+
+def test_binary_output_of_jobs(fakebox, boxcli):
+    box, _ = fakebox
+    file_id = box.create_file('0', 'data.bin', data=BINARY_DATA)['id']
+    result = boxcli(input=f'cat -a {file_id} &\nget {file_id} - &\nfg 1\nfg 2\n')
+    assert b'Error' not in result.stdout + result.stderr
+    assert result.stdout.count(BINARY_DATA) == 2
+
+def test_jobs_leave_numbered_items_alone(fakebox, boxcli):
+    # Item numbers refer to the last foreground listing, even after a job lists another folder
+    box, _ = fakebox
+    first = box.create_folder('0', 'first')['id']
+    box.create_file(first, 'in-first.txt', data=b'1')
+    second = box.create_folder('0', 'second')['id']
+    box.create_file(second, 'in-second.txt', data=b'2')
+    result = boxcli(input=f'ls {first}\nls {second} &\nfg 1\npath 1\n')
+    assert b'Error' not in result.stdout + result.stderr
+    assert b'/first/in-first.txt' in result.stdout
+    assert b'/second/in-second.txt' not in result.stdout